@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from peer import Peer
+from tracker import Tracker
+
+# How often the resident set size is sampled during a run
+RSS_SAMPLE_INTERVAL = 0.01
+
+def free_port():
+    """
+    Returns:
+        int: A loopback port nothing is listening on right now.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def parse_size(text):
+    """
+    Args:
+        text (str): A size such as '512', '64K', '8M' or '1G'.
+
+    Returns:
+        int: The size in bytes.
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def current_rss():
+    """
+    Returns:
+        int: The resident set size of this process in bytes, or 0 if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+class RssSampler:
+    """
+    Track the peak resident set size while a block of code runs.
+
+    getrusage only reports the peak over the whole life of the process,
+    which is useless once an earlier run has raised it, so /proc is polled
+    from a background thread instead.
+    """
+    def __init__(self):
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+def git_commit():
+    """
+    Returns:
+        str or None: The commit the benchmark runs on, so results can be compared across commits.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def sha1_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def run_transfer(workdir, file_size, piece_length, seeders, leechers, server_mode, pipeline_depth):
+    """
+    Share one generated file from 'seeders' peers and download it with 'leechers' peers at once.
+
+    Everything runs in this process over loopback: a tracker, the seeders
+    and the leechers, each leecher writing to its own directory. The servers
+    are never shut down, so main() gives every run a process of its own
+    through run_isolated().
+
+    Args:
+        workdir (str): Empty directory for the run's files.
+        file_size (int): Size of the generated file in bytes.
+        piece_length (int): Piece size of the torrent.
+        seeders (int): Number of peers sharing the file.
+        leechers (int): Number of peers downloading it concurrently.
+        server_mode (str): 'threaded' or 'asyncio' for the peers' servers.
+        pipeline_depth (int): Piece requests in flight per connection.
+
+    Returns:
+        dict: The measurements of the run.
+    """
+    source = os.path.join(workdir, 'payload.bin')
+    with open(source, 'wb') as f:
+        remaining = file_size
+        while remaining:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            f.write(chunk)
+            remaining -= len(chunk)
+    expected = sha1_file(source)
+
+    tracker = Tracker('127.0.0.1', free_port(), data_dir=os.path.join(workdir, 'tracker'))
+    tracker.start()
+    time.sleep(0.2)  # Give the servers time to start
+    seeding = []
+    for _ in range(seeders):
+        seeder = Peer('127.0.0.1', free_port(), pipeline_depth=pipeline_depth)
+        seeder.start_server(server_mode)
+        seeder.connect_to_tracker('127.0.0.1', tracker.port)
+        info_hash = seeder.share_file(source, piece_length)
+        seeding.append(seeder)
+    downloading = []
+    for number in range(leechers):
+        download_dir = os.path.join(workdir, f"leecher{number}")
+        os.makedirs(download_dir)
+        leecher = Peer('127.0.0.1', free_port(), pipeline_depth=pipeline_depth, download_dir=download_dir)
+        leecher.start_server(server_mode)
+        leecher.connect_to_tracker('127.0.0.1', tracker.port)
+        downloading.append(leecher)
+    time.sleep(0.2)
+
+    def download(leecher):
+        t_info = leecher.get_torrent_details(info_hash)
+        leecher.download_swarm(info_hash, t_info, t_info['peers'])
+
+    threads = [threading.Thread(target=download, args=(leecher,)) for leecher in downloading]
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+
+    verified = all(
+        os.path.exists(path) and sha1_file(path) == expected
+        for path in (os.path.join(leecher.download_dir, 'downloaded_payload.bin') for leecher in downloading))
+    for leecher in downloading:
+        leecher.stop_all_transfers()
+    for seeder in seeding:
+        seeder.stop_all_transfers()
+    tracker.stop()
+    moved = file_size * leechers
+    return {
+        'seconds': round(elapsed, 4),
+        'mb_per_s': round(moved / elapsed / 1e6, 2) if elapsed else None,
+        'cpu_seconds': round(cpu, 4),
+        'cpu_seconds_per_gb': round(cpu / (moved / 1e9), 3) if moved else None,
+        'peak_rss_mb': round(rss.peak / 1e6, 1),
+        'connections_accepted': sum(seeder.stats['accepted'] for seeder in seeding),
+        'peak_connections': sum(seeder.stats['peak_active'] for seeder in seeding),
+        'sessions_opened': sum(leecher.stats['opened'] for leecher in downloading),
+        'cache_hits': sum(seeder.piece_cache.hits for seeder in seeding),
+        'cache_misses': sum(seeder.piece_cache.misses for seeder in seeding),
+        'requests_choked': sum(seeder.stats['choked'] for seeder in seeding),
+        'verified': verified,
+    }
+
+def run_isolated(params, verbose=False):
+    """
+    Run one transfer in a new interpreter, so its servers and threads end
+    with it and its memory and CPU figures include nothing from earlier runs.
+
+    Args:
+        params (dict): The keyword arguments of run_transfer() except 'workdir'.
+        verbose (bool, optional): Let the peers' own output through.
+
+    Returns:
+        dict: The measurements of the run.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--run', json.dumps(params)]
+    if verbose:
+        command.append('--verbose')
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL,
+                            text=True, check=True)
+    # The measurements are the last line; verbose runs print the peers' output before them
+    lines = result.stdout.splitlines()
+    if verbose:
+        print('\n'.join(lines[:-1]))
+    return json.loads(lines[-1])
+
+def run_one(params, verbose):
+    """
+    Body of the process started by run_isolated(): run the transfer in a
+    temporary directory and print its measurements as one JSON line.
+    """
+    with tempfile.TemporaryDirectory(prefix='bench-transfer-') as workdir:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            metrics = run_transfer(workdir, **params)
+    print(json.dumps(metrics), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark seeder-to-leecher transfers over loopback and record the results')
+    parser.add_argument('--sizes', default='8M,64M', help='Comma-separated file sizes, e.g. 8M,64M')
+    parser.add_argument('--piece-sizes', default='64K,256K,1M', help='Comma-separated piece sizes')
+    parser.add_argument('--seeders', default='1,3', help='Comma-separated seeder counts')
+    parser.add_argument('--leechers', default='1', help='Comma-separated concurrent leecher counts')
+    parser.add_argument('--server', default='threaded', help='Comma-separated server modes: threaded, asyncio')
+    parser.add_argument('--pipeline-depth', type=int, default=8,
+                        help='Piece requests kept in flight per peer connection')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per combination')
+    parser.add_argument('--output', default='bench_results.jsonl',
+                        help='File the results are appended to, one JSON object per run')
+    parser.add_argument('--verbose', action='store_true', help="Show the peers' own output")
+    # Used by run_isolated() to run a single transfer in a child process
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_one(json.loads(args.run), args.verbose)
+        # Skip joining the servers' threads, which never end
+        os._exit(0)
+
+    output = os.path.abspath(args.output)
+    commit = git_commit()
+    combos = list(itertools.product(
+        [parse_size(s) for s in args.sizes.split(',')],
+        [parse_size(s) for s in args.piece_sizes.split(',')],
+        [int(n) for n in args.seeders.split(',')],
+        [int(n) for n in args.leechers.split(',')],
+        args.server.split(','),
+        range(args.repeat)))
+    print(f"{'size':>10} {'piece':>8} {'seed':>4} {'leech':>5} {'server':>8} "
+          f"{'MB/s':>8} {'cpu s':>7} {'rss MB':>7} {'conns':>5} {'ok':>3}")
+    for file_size, piece_length, seeders, leechers, server_mode, _ in combos:
+        metrics = run_isolated({'file_size': file_size, 'piece_length': piece_length, 'seeders': seeders,
+                                'leechers': leechers, 'server_mode': server_mode,
+                                'pipeline_depth': args.pipeline_depth}, args.verbose)
+        record = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'file_size': file_size,
+            'piece_length': piece_length,
+            'seeders': seeders,
+            'leechers': leechers,
+            'server': server_mode,
+            'pipeline_depth': args.pipeline_depth,
+            **metrics,
+        }
+        with open(output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print(f"{file_size:>10} {piece_length:>8} {seeders:>4} {leechers:>5} {server_mode:>8} "
+              f"{metrics['mb_per_s']:>8} {metrics['cpu_seconds']:>7} {metrics['peak_rss_mb']:>7} "
+              f"{metrics['connections_accepted']:>5} {'yes' if metrics['verified'] else 'NO':>3}")
+    print(f"Results appended to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,265 @@
-import re
-import sys
 import hashlib
-import sys
+import io
+import json
 
+from hashing import pack_piece_hashes
 
-class file:
-    def __init__(self, filename):
-        self.filename = filename
+# Metainfo keys whose strings are raw bytes rather than text
+BINARY_KEYS = frozenset({'pieces'})
 
+class BencodeError(ValueError):
+    """
+    Raised when data is not valid bencode or a value cannot be bencoded.
+    """
+    pass
 
-class bytecode:
-    def __init__(self, code):
-        self.code = code
+def encode_to(obj, f):
+    """
+    Bencode a value straight into a binary file object.
 
-    def encode(self):
+    Nothing but the small length and integer prefixes is built in memory;
+    byte strings are written as they are, so a large value is never copied
+    into one buffer. Dict keys are sorted by their raw bytes, as bencode
+    requires.
+
+    Args:
+        obj: An int, str, bytes-like, list, tuple or dict (with str or bytes keys).
+        f (file): Where to write; anything with a write() method taking bytes.
+
+    Raises:
+        BencodeError: If the value, or anything inside it, cannot be bencoded.
+    """
+    write = f.write
+    if isinstance(obj, bool):
+        # bool is an int; bencode has no booleans, so refuse rather than guess
+        raise BencodeError("Cannot bencode a bool")
+    if isinstance(obj, int):
+        write(b'i%de' % obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        write(b'%d:' % len(data))
+        write(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        write(b'%d:' % len(obj))
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        write(b'l')
+        for item in obj:
+            encode_to(item, f)
+        write(b'e')
+    elif isinstance(obj, dict):
+        items = []
+        for key, value in obj.items():
+            if isinstance(key, str):
+                key = key.encode('utf-8')
+            elif not isinstance(key, bytes):
+                raise BencodeError(f"Cannot bencode a dict key of type {type(key).__name__}")
+            items.append((key, value))
+        items.sort(key=lambda item: item[0])
+        write(b'd')
+        for key, value in items:
+            write(b'%d:' % len(key))
+            write(key)
+            encode_to(value, f)
+        write(b'e')
+    else:
+        raise BencodeError(f"Cannot bencode a value of type {type(obj).__name__}")
+
+def encode(obj):
+    """
+    Args:
+        obj: A value accepted by encode_to().
+
+    Returns:
+        bytes: Its bencoding.
+    """
+    buffer = io.BytesIO()
+    encode_to(obj, buffer)
+    return buffer.getvalue()
+
+class _Decoder:
+    """
+    Single-pass bencode decoder over a bytes-like buffer.
+
+    Byte strings are cut out of a memoryview of the input, so the input is
+    never sliced as a whole, and the offsets of the top-level value of
+    'span_key' are remembered for hashing the original bytes.
+    """
+    def __init__(self, data, binary_keys, span_key):
+        # bytes, bytearray and mmap can be searched; anything else is copied once
+        self.raw = data if isinstance(data, (bytes, bytearray)) or hasattr(data, 'find') else bytes(data)
+        self.view = memoryview(self.raw)
+        self.binary_keys = binary_keys
+        self.span_key = span_key
+        self.span = None
+
+    def value(self, pos, binary, depth):
+        """
+        Decode the value starting at 'pos'.
+
+        Returns:
+            tuple: (value, position just after it).
+        """
+        try:
+            lead = self.raw[pos]
+        except IndexError:
+            raise BencodeError("Bencoded data ends early")
+        if lead == 0x69:                    # 'i'
+            end = self.raw.find(b'e', pos + 1)
+            return self._int(pos + 1, end), end + 1
+        if 0x30 <= lead <= 0x39:            # '0'-'9'
+            return self._string(pos, binary)
+        if lead == 0x6c:                    # 'l'
+            items = []
+            pos += 1
+            while self._peek(pos) != 0x65:  # 'e'
+                item, pos = self.value(pos, binary, depth + 1)
+                items.append(item)
+            return items, pos + 1
+        if lead == 0x64:                    # 'd'
+            result = {}
+            pos += 1
+            while self._peek(pos) != 0x65:
+                key, pos = self._string(pos, True)
+                try:
+                    key = key.decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+                start = pos
+                result[key], pos = self.value(pos, key in self.binary_keys, depth + 1)
+                if depth == 0 and key == self.span_key:
+                    self.span = (start, pos)
+            return result, pos + 1
+        raise BencodeError(f"Unexpected byte {bytes([lead])!r} at offset {pos}")
+
+    def _peek(self, pos):
+        try:
+            return self.raw[pos]
+        except IndexError:
+            raise BencodeError("Bencoded data ends early")
+
+    def _int(self, start, end):
+        if end < 0:
+            raise BencodeError("Unterminated integer")
+        digits = bytes(self.view[start:end])
+        body = digits[1:] if digits.startswith(b'-') else digits
+        # No sign without digits, no leading zeros and no negative zero
+        if not body.isdigit() or (body.startswith(b'0') and digits != b'0'):
+            raise BencodeError(f"Malformed integer {digits!r}")
+        return int(digits)
+
+    def _string(self, pos, binary):
+        colon = self.raw.find(b':', pos)
+        if colon < 0:
+            raise BencodeError("Unterminated string length")
+        length = self._int(pos, colon)
+        end = colon + 1 + length
+        if length < 0 or end > len(self.raw):
+            raise BencodeError("String runs past the end of the data")
+        data = bytes(self.view[colon + 1:end])
+        if not binary:
+            try:
+                return data.decode('utf-8'), end
+            except UnicodeDecodeError:
+                pass
+        return data, end
+
+def decode(data, binary_keys=frozenset(), span_key=None):
+    """
+    Decode a complete bencoded value.
+
+    Byte strings come back as str when they are valid UTF-8, except under
+    dict keys listed in 'binary_keys', whose strings (including those in
+    nested lists) always stay bytes. Dict keys are always str when valid
+    UTF-8.
+
+    Args:
+        data (bytes-like): The bencoded data; bytes, bytearray and mmap are read in place.
+        binary_keys (frozenset, optional): Dict keys whose strings are binary.
+        span_key (str, optional): A key of the top-level dict whose byte
+            range in 'data' should be reported.
+
+    Returns:
+        The decoded value, or (value, (start, end)) if 'span_key' is given;
+        the span is None if the key is missing.
+
+    Raises:
+        BencodeError: If the data is not exactly one valid bencoded value.
+    """
+    decoder = _Decoder(data, binary_keys, span_key)
+    try:
+        value, end = decoder.value(0, False, 0)
+    except RecursionError:
+        raise BencodeError("Bencoded data is nested too deeply")
+    if end != len(decoder.raw):
+        raise BencodeError("Trailing data after the bencoded value")
+    if span_key is not None:
+        return value, decoder.span
+    return value
+
+def info_hash(info):
+    """
+    Args:
+        info (dict): A torrent's info dictionary.
+
+    Returns:
+        str: The hex SHA-1 of its bencoding, which identifies the torrent.
+    """
+    digest = hashlib.sha1()
+    encode_to(info, _HashWriter(digest))
+    return digest.hexdigest()
+
+class _HashWriter:
+    """
+    File-like adapter that feeds written bytes to a hash instead of storing them.
+    """
+    def __init__(self, digest):
+        self.write = digest.update
+
+def write_torrent(path, torrent):
+    """
+    Save a torrent's metainfo as a bencoded .torrent file.
+
+    Args:
+        path (str): Where to write the file.
+        torrent (dict): The metainfo, with an 'info' dictionary.
+    """
+    with open(path, 'wb') as f:
+        encode_to(torrent, f)
+
+def read_torrent(path):
+    """
+    Load a .torrent file and compute its info_hash from the bytes on disk.
+
+    The info_hash is the SHA-1 of the 'info' value exactly as it appears
+    in the file, so it matches whatever produced the file even if that
+    encoder differed in details. Files written as JSON by older versions
+    are still read; their info_hash is that of the bencoded info.
+
+    Args:
+        path (str): The .torrent file.
+
+    Returns:
+        tuple: (metainfo dict, hex info_hash).
+
+    Raises:
+        BencodeError: If the file is neither valid bencode nor JSON, or has no info dictionary.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.lstrip()[:1] == b'{':
+        try:
+            torrent = json.loads(data)
+        except ValueError as e:
+            raise BencodeError(f"Unreadable torrent file {path}: {e}")
+        if not isinstance(torrent, dict) or not isinstance(torrent.get('info'), dict):
+            raise BencodeError(f"No info dictionary in {path}")
+        if 'pieces' in torrent['info']:
+            # JSON torrents list their piece hashes in hex
+            torrent['info']['pieces'] = pack_piece_hashes(torrent['info']['pieces'])
+        return torrent, info_hash(torrent['info'])
+    torrent, span = decode(data, binary_keys=BINARY_KEYS, span_key='info')
+    if not isinstance(torrent, dict) or span is None or not isinstance(torrent['info'], dict):
+        raise BencodeError(f"No info dictionary in {path}")
+    start, end = span
+    return torrent, hashlib.sha1(memoryview(data)[start:end]).hexdigest()
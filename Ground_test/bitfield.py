@@ -0,0 +1,68 @@
+class Bitfield:
+    """
+    A compact set of piece indices, one bit per piece (most significant bit
+    of the first byte is piece 0), as used in BitTorrent bitfield messages.
+    """
+    def __init__(self, length, data=None):
+        """
+        Args:
+            length (int): Number of pieces.
+            data (bytes, optional): Packed bits to start from. Defaults to all unset.
+        """
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self.bits = bytearray(size)
+        else:
+            if len(data) != size:
+                raise ValueError(f"Bitfield for {length} pieces needs {size} bytes, got {len(data)}")
+            self.bits = bytearray(data)
+            # Clear any spare bits past the last piece
+            if length % 8:
+                self.bits[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+
+    @classmethod
+    def full(cls, length):
+        """
+        Create a bitfield with every piece set.
+
+        Args:
+            length (int): Number of pieces.
+
+        Returns:
+            Bitfield: The filled bitfield.
+        """
+        return cls(length, b'\xff' * ((length + 7) // 8))
+
+    def set(self, index):
+        self.bits[index >> 3] |= 0x80 >> (index & 7)
+
+    def clear(self, index):
+        self.bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+    def __contains__(self, index):
+        return 0 <= index < self.length and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        """
+        Iterate over the indices of the set pieces.
+        """
+        for byte_index, byte in enumerate(self.bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield (byte_index << 3) + bit
+
+    def count(self):
+        """
+        Returns:
+            int: Number of set pieces.
+        """
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+    def is_complete(self):
+        return self.count() == self.length
+
+    def to_bytes(self):
+        return bytes(self.bits)
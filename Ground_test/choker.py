@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+
+# Peers served at once, chosen by the rate they trade with us
+UPLOAD_SLOTS = 4
+# Seconds between two choices of the peers to serve
+RECHOKE_INTERVAL = 10
+# The optimistic slot moves to another peer every this many rechokes
+OPTIMISTIC_ROUNDS = 3
+# A peer that has not asked for data this long is no longer a candidate
+INTEREST_TIMEOUT = 3 * RECHOKE_INTERVAL
+# How long a downloader waits before asking a peer that choked it again
+CHOKE_RETRY = RECHOKE_INTERVAL
+
+class Choker:
+    """
+    Decide which remote peers get served, so uplink goes to a few peers at a time.
+
+    Serving every requester at once splits the upload between all of them
+    and nobody finishes quickly. Instead, 'slots' peers are unchoked and
+    the rest are refused with a 'choke' reply straight away. Every
+    'interval' seconds the unchoked peers are chosen again among those that
+    recently asked for data. Peers that sent us the most data since the
+    last choice come first, so peers that upload to us are served in
+    return. Ties, which are the common case for a seed, go to the peers we
+    uploaded to fastest, so they finish and leave. One more peer, rotated
+    every 'optimistic_rounds' choices, is unchoked whatever its rate,
+    which lets newcomers show what they can give back.
+
+    A slot that is free between two choices, because few peers are
+    interested or an unchoked peer disconnected, goes to the next peer to
+    ask. Peers are identified by their listening (host, port) when their
+    handshake gives it, else by the address of the connection.
+    """
+    def __init__(self, slots=UPLOAD_SLOTS, interval=RECHOKE_INTERVAL, optimistic_rounds=OPTIMISTIC_ROUNDS):
+        """
+        Args:
+            slots (int, optional): Peers unchoked for their rate, besides the optimistic one.
+            interval (float, optional): Seconds between rechokes.
+            optimistic_rounds (int, optional): Rechokes between two moves of the optimistic slot.
+        """
+        self.slots = max(1, slots)
+        self.interval = interval
+        self.optimistic_rounds = max(1, optimistic_rounds)
+        self.unchoked = set()
+        self.optimistic = None
+        self.connections = {}       # {remote: open connections that asked for data}
+        self.seen = {}              # {remote: when it last asked for data}
+        self.downloaded = {}        # {remote: bytes received from it since the last rechoke}
+        self.uploaded = {}          # {remote: bytes sent to it since the last rechoke}
+        self.rates = {}             # {remote: (download rate, upload rate)} at the last rechoke
+        self.rounds = 0
+        self.last_rechoke = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allowed(self, remote):
+        """
+        Check whether a data request from a peer may be served.
+
+        Args:
+            remote (tuple): The peer's (host, port).
+
+        Returns:
+            bool: False if the peer is choked and should get a 'choke' reply.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.seen[remote] = now
+            if now - self.last_rechoke >= self.interval:
+                self._rechoke(now)
+            if remote in self.unchoked or remote == self.optimistic:
+                return True
+            if len(self.unchoked) < self.slots:
+                self.unchoked.add(remote)
+                return True
+            if self.optimistic is None:
+                self.optimistic = remote
+                return True
+            return False
+
+    def connect(self, remote):
+        """
+        Record a connection from a peer that asked for data.
+
+        Args:
+            remote (tuple): The peer's (host, port).
+        """
+        with self.lock:
+            self.connections[remote] = self.connections.get(remote, 0) + 1
+
+    def disconnect(self, remote):
+        """
+        Record the end of a connection passed to connect(), freeing the
+        peer's slot if it was its last one.
+
+        Args:
+            remote (tuple): The peer's (host, port).
+        """
+        with self.lock:
+            count = self.connections.get(remote, 0) - 1
+            if count > 0:
+                self.connections[remote] = count
+                return
+            self.connections.pop(remote, None)
+            if remote in self.unchoked or remote == self.optimistic:
+                # It was being served and left, most likely done; a choked
+                # peer that hangs up is still waiting to retry
+                self.seen.pop(remote, None)
+                self.unchoked.discard(remote)
+                if self.optimistic == remote:
+                    self.optimistic = None
+
+    def record_download(self, remote, num_bytes):
+        """
+        Args:
+            remote (tuple): The (host, port) data was downloaded from.
+            num_bytes (int): Amount received.
+        """
+        with self.lock:
+            self.downloaded[remote] = self.downloaded.get(remote, 0) + num_bytes
+
+    def record_upload(self, remote, num_bytes):
+        """
+        Args:
+            remote (tuple): The (host, port) data was sent to.
+            num_bytes (int): Amount sent.
+        """
+        with self.lock:
+            self.uploaded[remote] = self.uploaded.get(remote, 0) + num_bytes
+
+    def _rechoke(self, now):
+        """
+        Choose the unchoked and optimistic peers again. Must be called with self.lock held.
+        """
+        elapsed = max(now - self.last_rechoke, 1e-9)
+        for remote, when in list(self.seen.items()):
+            if now - when > INTEREST_TIMEOUT and remote not in self.connections:
+                del self.seen[remote]
+        self.rates = {remote: (self.downloaded.get(remote, 0) / elapsed, self.uploaded.get(remote, 0) / elapsed)
+                      for remote in self.seen}
+        self.downloaded.clear()
+        self.uploaded.clear()
+        ranked = sorted(self.seen, key=lambda remote: self.rates[remote], reverse=True)
+        self.unchoked = set(ranked[:self.slots])
+        self.rounds += 1
+        if self.optimistic not in self.seen or self.optimistic in self.unchoked \
+                or self.rounds % self.optimistic_rounds == 0:
+            candidates = ranked[self.slots:]
+            self.optimistic = random.choice(candidates) if candidates else None
+        self.last_rechoke = now
+
+    def stats(self):
+        """
+        Returns:
+            dict: The unchoked peers, the optimistic one and how many peers want data.
+        """
+        with self.lock:
+            return {'unchoked': sorted(self.unchoked), 'optimistic': self.optimistic,
+                    'interested': len(self.seen)}
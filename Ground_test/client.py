@@ -1,46 +1,286 @@
+import argparse
+import json
+import math
+import os
+import random
 import socket
+import tempfile
+import threading
 import time
-import argparse
 
-from threading import Thread
+from protocol import WIRE_BINARY, WIRE_PICKLE, send_msg, recv_msg
+
+# Message types the load generator knows how to send
+MESSAGE_TYPES = ('handshake', 'announce', 'get_torrents', 'get_catalog', 'get_torrent')
+DEFAULT_MIX = 'handshake=10,announce=80,get_torrents=10'
+PERCENTILES = (50, 95, 99)
+
+class VirtualPeer:
+    """
+    One simulated peer: an address and the torrents it takes part in.
+
+    Virtual peers are plain state; a small pool of worker threads sends
+    requests on their behalf, so thousands of them cost no more threads
+    than a handful.
+    """
+    def __init__(self, number, torrents):
+        """
+        Args:
+            number (int): Index of the peer, used to derive its address.
+            torrents (list): info_hashes this peer announces.
+        """
+        # Spread peers over 10.0.0.0/8 so compact peer lists see many distinct addresses
+        self.host = f"10.{(number >> 16) & 0xff}.{(number >> 8) & 0xff}.{number & 0xff}"
+        self.port = 6881 + number % 1000
+        self.torrents = torrents
+
+def parse_mix(text):
+    """
+    Parse a message mix such as 'announce=8,get_torrents=1'.
+
+    Args:
+        text (str): Comma-separated type=weight pairs.
+
+    Returns:
+        tuple: (list of message types, list of weights).
+    """
+    types, weights = [], []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in MESSAGE_TYPES:
+            raise ValueError(f"Unknown message type '{name}' in mix; expected one of {', '.join(MESSAGE_TYPES)}")
+        types.append(name)
+        weights.append(float(weight or 1))
+    return types, weights
 
-def new_connection(tid, host, port):
-    print('Thread ID {:d} connecting to {}:{:d}'.format(tid, host, port))
+def percentile(sorted_values, pct):
+    """
+    Args:
+        sorted_values (list): Samples in ascending order.
+        pct (float): The percentile, 0-100.
 
-    client_socket = socket.socket()
-    client_socket.connect((host, port))
-    
+    Returns:
+        float: The nearest-rank percentile, or 0.0 without samples.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
 
-    # Demo sleep time for fun (dummy command)
-    for i in range(0,3):
-       print('Let me, ID={:d} sleep in {:d}s'.format(tid,3-i))
-       time.sleep(1)
- 
-    print('OK! I am ID={:d} done here'.format(tid))
+class LoadGenerator:
+    """
+    Drive a tracker with a configurable mix of requests and record latencies.
 
+    With a target rate the load is open-loop: request k is due at
+    start + k / rate whatever happened to earlier requests, and its latency
+    is measured from that due time. A tracker that falls behind therefore
+    shows up as growing latency instead of being hidden by the generator
+    slowing down. Without a rate every worker sends back to back.
+    """
+    def __init__(self, host, port, peers, torrents, mix, rate=0, workers=64, wire=WIRE_BINARY):
+        """
+        Args:
+            host (str): The tracker's address.
+            port (int): The tracker's port.
+            peers (list): VirtualPeer objects to send requests for.
+            torrents (list): All info_hashes in play.
+            mix (tuple): (message types, weights) as returned by parse_mix().
+            rate (float, optional): Target requests per second over all workers; 0 for unthrottled.
+            workers (int, optional): Number of sending threads.
+            wire (str, optional): WIRE_BINARY or WIRE_PICKLE.
+        """
+        self.host = host
+        self.port = port
+        self.peers = peers
+        self.torrents = torrents
+        self.types, self.weights = mix
+        self.rate = rate
+        self.workers = workers
+        self.wire = wire
+        self.lock = threading.Lock()
+        self.tickets = 0
+        self.latencies = {name: [] for name in self.types}
+        self.errors = {name: 0 for name in self.types}
+        self.catalog_version = 0
 
-def connect_server(threadnum, host, port):
+    def request(self, message):
+        with socket.create_connection((self.host, self.port), timeout=10) as s:
+            send_msg(s, message, self.wire)
+            response = recv_msg(s, self.wire == WIRE_PICKLE)
+        if not response or 'error' in response:
+            raise RuntimeError(response.get('error') if response else 'connection closed')
+        return response
 
-    # Create "threadnum" of Thread to parallelly connnect
-    threads = [Thread(target=new_connection, args=(i, host, port)) for i in range(0,threadnum)]
-    [t.start() for t in threads]
+    def build_message(self, msg_type, peer, rng):
+        if msg_type == 'announce':
+            return {'type': 'announce', 'info_hash': rng.choice(peer.torrents), 'host': peer.host,
+                    'port': peer.port, 'event': None, 'numwant': 50, 'compact': True}
+        if msg_type == 'get_catalog':
+            # Half the clients are fresh, half are catching up from a recent version
+            since = 0 if rng.random() < 0.5 else max(0, self.catalog_version - 100)
+            return {'type': 'get_catalog', 'since': since}
+        if msg_type == 'get_torrent':
+            return {'type': 'get_torrent', 'info_hash': rng.choice(self.torrents), 'numwant': 50, 'compact': True}
+        return {'type': msg_type}
 
-    # TODO: wait for all threads to finish
-    [t.join() for t in threads]
+    def seed(self):
+        """
+        Register every torrent with the tracker, outside the measured run.
+        """
+        for number, info_hash in enumerate(self.torrents):
+            owner = self.peers[number % len(self.peers)]
+            info = {'name': f"load-{number}.bin", 'length': 1 << 20, 'piece_length': 1 << 18,
+                    'pieces': os.urandom(4 * 20)}
+            self.request({'type': 'announce', 'info_hash': info_hash, 'host': owner.host, 'port': owner.port,
+                          'event': 'completed', 'torrent_info': info})
 
-    
+    def _next_due(self, started):
+        """
+        Returns:
+            float or None: The perf_counter time the next request is due, or None when unthrottled.
+        """
+        if not self.rate:
+            return None
+        with self.lock:
+            ticket = self.tickets
+            self.tickets += 1
+        return started + ticket / self.rate
 
+    def _worker(self, number, started, deadline):
+        rng = random.Random(number)
+        while True:
+            due = self._next_due(started)
+            if due is not None:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            if sent >= deadline:
+                return
+            msg_type = rng.choices(self.types, self.weights)[0]
+            message = self.build_message(msg_type, rng.choice(self.peers), rng)
+            try:
+                response = self.request(message)
+                if msg_type == 'get_catalog':
+                    self.catalog_version = max(self.catalog_version, response.get('version', 0))
+                ok = True
+            except Exception:
+                ok = False
+            finished = time.perf_counter()
+            with self.lock:
+                if ok:
+                    self.latencies[msg_type].append(finished - (due if due is not None else sent))
+                else:
+                    self.errors[msg_type] += 1
+
+    def run(self, duration):
+        """
+        Send requests for 'duration' seconds and summarise them.
+
+        Args:
+            duration (float): Length of the measured run in seconds.
+
+        Returns:
+            dict: Per message type and overall: count, errors, throughput and
+                latency percentiles in milliseconds.
+        """
+        started = time.perf_counter()
+        deadline = started + duration
+        threads = [threading.Thread(target=self._worker, args=(i, started, deadline), daemon=True)
+                   for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        results = {}
+        everything = []
+        for msg_type in self.types:
+            samples = sorted(self.latencies[msg_type])
+            everything.extend(samples)
+            results[msg_type] = self._summary(samples, self.errors[msg_type], elapsed)
+        results['all'] = self._summary(sorted(everything), sum(self.errors.values()), elapsed)
+        return {
+            'config': {'host': self.host, 'port': self.port, 'peers': len(self.peers),
+                       'torrents': len(self.torrents), 'mix': dict(zip(self.types, self.weights)),
+                       'rate': self.rate, 'workers': self.workers, 'wire': self.wire,
+                       'duration': round(elapsed, 3)},
+            'results': results,
+        }
+
+    @staticmethod
+    def _summary(samples, errors, elapsed):
+        summary = {'count': len(samples), 'errors': errors,
+                   'throughput': round(len(samples) / elapsed, 1) if elapsed else 0.0}
+        for pct in PERCENTILES:
+            summary[f"p{pct}_ms"] = round(percentile(samples, pct) * 1000, 3)
+        summary['max_ms'] = round(samples[-1] * 1000, 3) if samples else 0.0
+        return summary
+
+def print_table(report):
+    """
+    Print the results of LoadGenerator.run() as a table.
+    """
+    print(f"{'type':<13} {'count':>8} {'errors':>7} {'req/s':>9} "
+          + ' '.join(f"{'p' + str(pct) + ' ms':>9}" for pct in PERCENTILES) + f" {'max ms':>9}")
+    for msg_type, row in report['results'].items():
+        print(f"{msg_type:<13} {row['count']:>8} {row['errors']:>7} {row['throughput']:>9.1f} "
+              + ' '.join(f"{row[f'p{pct}_ms']:>9.2f}" for pct in PERCENTILES) + f" {row['max_ms']:>9.2f}")
+
+def start_local_tracker():
+    """
+    Start a tracker in this process on a free loopback port.
+
+    Returns:
+        tuple: (host, port) of the tracker.
+    """
+    from tracker import Tracker
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    tracker = Tracker('127.0.0.1', port, data_dir=tempfile.mkdtemp(prefix='load-tracker-'))
+    tracker.start()
+    time.sleep(0.5)  # Give the server time to start
+    return '127.0.0.1', port
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
                         prog='Client',
-                        description='Connect to pre-declard server',
-                        epilog='!!!It requires the server is running and listening!!!')
-    parser.add_argument('--server-ip')
-    parser.add_argument('--server-port', type=int)
-    parser.add_argument('--client-num', type=int)
+                        description='Load-test a tracker with many virtual peers and report request latencies',
+                        epilog='!!!It requires the tracker is running and listening, unless --local-tracker is given!!!')
+    parser.add_argument('--server-ip', default='127.0.0.1')
+    parser.add_argument('--server-port', type=int, default=8000)
+    parser.add_argument('--client-num', type=int, default=1000, help='Number of virtual peers')
+    parser.add_argument('--torrents', type=int, default=100, help='Number of torrents the peers share')
+    parser.add_argument('--torrents-per-peer', type=int, default=5, help='Torrents each virtual peer announces')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"Weighted message mix, from: {', '.join(MESSAGE_TYPES)}")
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Target requests per second in total (0 sends as fast as the workers can)')
+    parser.add_argument('--workers', type=int, default=64, help='Threads sending requests')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run for')
+    parser.add_argument('--wire', choices=[WIRE_BINARY, WIRE_PICKLE], default=WIRE_BINARY,
+                        help='Framing to send requests in')
+    parser.add_argument('--json', metavar='PATH', help="Also write the results as JSON ('-' for stdout)")
+    parser.add_argument('--local-tracker', action='store_true',
+                        help='Start a tracker in this process instead of using --server-ip/--server-port')
     args = parser.parse_args()
-    host = args.server_ip
-    port = args.server_port
-    cnum = args.client_num
-    connect_server(cnum, host, port)
+
+    host, port = (start_local_tracker() if args.local_tracker else (args.server_ip, args.server_port))
+    torrents = [os.urandom(20).hex() for _ in range(args.torrents)]
+    rng = random.Random(0)
+    peers = [VirtualPeer(i, rng.sample(torrents, min(args.torrents_per_peer, len(torrents))))
+             for i in range(args.client_num)]
+    generator = LoadGenerator(host, port, peers, torrents, parse_mix(args.mix), args.rate, args.workers, args.wire)
+    print(f"Registering {len(torrents)} torrents with the tracker at {host}:{port}...")
+    generator.seed()
+    print(f"Running {args.duration:g}s with {len(peers)} virtual peers on {args.workers} workers...")
+    report = generator.run(args.duration)
+    print_table(report)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}")
@@ -0,0 +1,80 @@
+import math
+
+class TimingWheel:
+    """
+    Deadline tracker for a large number of keys that are re-armed often.
+
+    Time is cut into ticks and each key sits in the bucket of the tick it
+    expires in, so scheduling, re-scheduling and cancelling are O(1) and
+    advancing the clock only visits the buckets of the ticks that passed.
+    Deadlines further away than one turn of the wheel stay in their bucket
+    until the turn they are due in.
+
+    The wheel is not thread-safe; callers serialise access.
+    """
+    def __init__(self, tick=1.0, slots=512, now=0.0):
+        """
+        Args:
+            tick (float, optional): Resolution of the wheel in seconds.
+            slots (int, optional): Number of buckets in one turn.
+            now (float, optional): The current time on the caller's clock.
+        """
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [set() for _ in range(slots)]
+        self.deadlines = {}         # {key: tick number the key expires at}
+        self.current = int(now // tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, delay, now):
+        """
+        Arm a key to expire 'delay' seconds from now, replacing any earlier deadline.
+
+        Args:
+            key (hashable): The key to arm.
+            delay (float): Seconds until the key expires.
+            now (float): The current time on the caller's clock.
+        """
+        self.cancel(key)
+        due = max(math.ceil((now + delay) / self.tick), self.current + 1)
+        self.deadlines[key] = due
+        self.buckets[due % self.slots].add(key)
+
+    def cancel(self, key):
+        """
+        Forget a key; does nothing if it is not armed.
+
+        Args:
+            key (hashable): The key to disarm.
+        """
+        due = self.deadlines.pop(key, None)
+        if due is not None:
+            self.buckets[due % self.slots].discard(key)
+
+    def advance(self, now):
+        """
+        Move the wheel forward and collect every key whose deadline has passed.
+
+        Args:
+            now (float): The current time on the caller's clock.
+
+        Returns:
+            list: The expired keys, which are no longer armed.
+        """
+        target = int(now // self.tick)
+        expired = []
+        # One full turn visits every bucket, however long the wheel was idle
+        for number in range(self.current + 1, min(target, self.current + self.slots) + 1):
+            bucket = self.buckets[number % self.slots]
+            due_now = [key for key in bucket if self.deadlines[key] <= target]
+            for key in due_now:
+                bucket.discard(key)
+                del self.deadlines[key]
+            expired.extend(due_now)
+        self.current = max(self.current, target)
+        return expired
@@ -0,0 +1,306 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from layout import FileLayout
+
+# Amount of data each hashing task covers; large enough that task overhead
+# is negligible, small enough to keep every core busy until the end.
+BATCH_BYTES = 8 * 1024 * 1024
+
+# Automatic piece sizing: aim for about TARGET_PIECES pieces, using a power
+# of two between MIN_PIECE_LENGTH and MAX_PIECE_LENGTH.
+TARGET_PIECES = 1500
+MIN_PIECE_LENGTH = 16 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+
+# Piece hashes are stored back to back as raw SHA-1 digests of this size
+HASH_SIZE = 20
+
+# Threads checking downloaded pieces, at most one per core
+VERIFY_WORKERS = 4
+# Downloaded pieces allowed to wait for verification before receivers block
+VERIFY_QUEUE = 8
+
+def piece_count(pieces):
+    """
+    Args:
+        pieces (bytes): Concatenated piece digests.
+
+    Returns:
+        int: Number of pieces they describe.
+    """
+    return len(pieces) // HASH_SIZE
+
+def piece_hash(pieces, index):
+    """
+    Args:
+        pieces (bytes): Concatenated piece digests.
+        index (int): The piece index.
+
+    Returns:
+        bytes: The 20-byte SHA-1 digest the piece must have.
+    """
+    start = index * HASH_SIZE
+    return pieces[start:start + HASH_SIZE]
+
+def pack_piece_hashes(pieces):
+    """
+    Bring piece hashes into the concatenated binary form.
+
+    Torrents made before hashes were stored in binary carry a list of hex
+    strings instead; the JSON catalog stores them as one hex string.
+
+    Args:
+        pieces (bytes-like, str or list): Digests, in any of those forms.
+
+    Returns:
+        bytes: The concatenated 20-byte digests.
+
+    Raises:
+        ValueError: If the hashes are malformed.
+    """
+    if isinstance(pieces, list):
+        pieces = ''.join(pieces)
+    packed = bytes.fromhex(pieces) if isinstance(pieces, str) else bytes(pieces)
+    if len(packed) % HASH_SIZE:
+        raise ValueError(f"Piece hashes of {len(packed)} bytes are not a multiple of {HASH_SIZE}")
+    return packed
+
+def unpack_piece_hashes(pieces):
+    """
+    Split concatenated piece digests into the list of hex strings older
+    clients expect.
+
+    Args:
+        pieces (bytes-like): Concatenated piece digests.
+
+    Returns:
+        list: One hex string per piece.
+    """
+    return [bytes(pieces[start:start + HASH_SIZE]).hex() for start in range(0, len(pieces), HASH_SIZE)]
+
+class VerifyPool:
+    """
+    Check downloaded pieces against their hashes on a few background threads.
+
+    A receiving thread hands each complete piece to submit() and goes back
+    to its socket at once, so the next piece arrives while this one is
+    hashed; hashlib releases the GIL, so hashing runs in parallel with the
+    receive and with other pieces. A piece that matches is passed to
+    'on_verified', which stores it; one that does not is passed to
+    'on_failed', so that it can be requested again. Both callbacks run on
+    the pool's threads and must be thread-safe.
+
+    submit() blocks while 'max_pending' pieces are waiting, which bounds the
+    memory held by unverified pieces when the disk or the CPU falls behind
+    the network.
+    """
+    def __init__(self, pieces, on_verified, on_failed, workers=None, max_pending=VERIFY_QUEUE):
+        """
+        Args:
+            pieces (bytes): Concatenated piece digests of the torrent.
+            on_verified (callable): Called with (index, data) for each piece that matches its hash.
+            on_failed (callable): Called with the index of each piece that does not.
+            workers (int, optional): Number of hashing threads. Defaults to
+                the CPU count, up to VERIFY_WORKERS.
+            max_pending (int, optional): Most pieces submitted but not yet checked.
+        """
+        self.pieces = pieces
+        self.on_verified = on_verified
+        self.on_failed = on_failed
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(VERIFY_WORKERS, os.cpu_count() or 1),
+                                           thread_name_prefix='verify')
+        self.slots = threading.Semaphore(max(1, max_pending))
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.error = None       # first exception raised by a callback
+
+    def submit(self, index, data, release=None):
+        """
+        Queue a received piece for verification.
+
+        Args:
+            index (int): The piece index.
+            data (bytes-like): The piece; it must not change until 'release' is called.
+            release (callable, optional): Called without arguments once the
+                data is no longer needed, e.g. to return a receive buffer.
+        """
+        self.slots.acquire()
+        with self.cond:
+            self.pending += 1
+        try:
+            self.executor.submit(self._check, index, data, release)
+        except RuntimeError:
+            # The pool was closed under us
+            self._finished()
+            raise
+
+    def _check(self, index, data, release):
+        try:
+            if hashlib.sha1(data).digest() == piece_hash(self.pieces, index):
+                self.on_verified(index, data)
+            else:
+                self.on_failed(index)
+        except Exception as e:
+            with self.cond:
+                if self.error is None:
+                    self.error = e
+        finally:
+            if release is not None:
+                release()
+            self._finished()
+
+    def _finished(self):
+        self.slots.release()
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until every submitted piece has been checked.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            bool: True if nothing is left to check.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending, timeout)
+
+    def close(self):
+        """
+        Finish checking the submitted pieces and stop the threads.
+        """
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def choose_piece_length(total_length, target_pieces=TARGET_PIECES,
+                        min_length=MIN_PIECE_LENGTH, max_length=MAX_PIECE_LENGTH):
+    """
+    Pick a piece size for a file so that the number of pieces stays bounded.
+
+    The result is the smallest power of two that splits the file into at
+    most 'target_pieces' pieces, clamped to [min_length, max_length]. Very
+    large files can therefore still exceed the target, and small files get
+    fewer pieces than it.
+
+    Args:
+        total_length (int): Size of the file in bytes.
+        target_pieces (int, optional): Largest number of pieces wanted.
+        min_length (int, optional): Smallest piece size allowed.
+        max_length (int, optional): Largest piece size allowed.
+
+    Returns:
+        int: The piece size in bytes.
+    """
+    wanted = -(-total_length // target_pieces)
+    piece_length = min_length
+    while piece_length < wanted and piece_length < max_length:
+        piece_length *= 2
+    return min(piece_length, max_length)
+
+def hash_pieces(file_path, piece_length, workers=None, progress=None):
+    """
+    SHA-1 every piece of a single file; see hash_layout().
+
+    Args:
+        file_path (str): The file to hash.
+        piece_length (int): The length of each piece in bytes.
+        workers (int, optional): Number of hashing threads. Defaults to the CPU count.
+        progress (callable, optional): Called with the number of bytes hashed
+            as each run of pieces completes.
+
+    Returns:
+        tuple: (concatenated piece digests, total length in bytes, seconds taken).
+    """
+    layout = FileLayout([(file_path, os.path.getsize(file_path))], piece_length)
+    return hash_layout(layout, workers, progress)
+
+def hash_layout(layout, workers=None, progress=None):
+    """
+    SHA-1 every piece of a torrent's content, spreading the work over a thread pool.
+
+    Each task hashes a run of consecutive pieces straight from memory
+    mappings of the files they cover, feeding a piece that spans files to
+    the hash one segment at a time. A task maps one file at a time, so a
+    torrent of many small files does not hold them all open. hashlib
+    releases the GIL while it hashes, so this scales with the number of
+    cores. Hashes come back in piece order.
+
+    Args:
+        layout (FileLayout): The files to hash and the piece size.
+        workers (int, optional): Number of hashing threads. Defaults to the CPU count.
+        progress (callable, optional): Called with the number of bytes hashed
+            as each run of pieces completes.
+
+    Returns:
+        tuple: (bytes of the 20-byte SHA-1 digests of every piece, back to
+            back, total length in bytes, seconds taken).
+    """
+    started = time.perf_counter()
+    piece_length = layout.piece_length
+    total_length = layout.total_length
+    total_pieces = layout.num_pieces
+    if total_length == 0:
+        # Nothing to map, and no pieces anyway
+        return b'', 0, time.perf_counter() - started
+    pieces_per_task = max(1, BATCH_BYTES // piece_length)
+    pieces = []
+
+    def hash_run(first):
+        last = min(first + pieces_per_task, total_pieces)
+        hashes = []
+        current = None      # (file index, file, mmap, memoryview) of the file being read
+        try:
+            for index in range(first, last):
+                digest = hashlib.sha1()
+                for file_index, offset, length in layout.piece_segments(index):
+                    if current is None or current[0] != file_index:
+                        _close_mapping(current)
+                        current = None
+                        f = open(layout.paths[file_index], 'rb')
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        current = (file_index, f, m, memoryview(m))
+                    digest.update(current[3][offset:offset + length])
+                hashes.append(digest.digest())
+        finally:
+            _close_mapping(current)
+        return b''.join(hashes)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for first, hashes in zip(range(0, total_pieces, pieces_per_task),
+                                 executor.map(hash_run, range(0, total_pieces, pieces_per_task))):
+            pieces.append(hashes)
+            if progress is not None:
+                end = min((first + piece_count(hashes)) * piece_length, total_length)
+                progress(end - first * piece_length)
+    return b''.join(pieces), total_length, time.perf_counter() - started
+
+def _close_mapping(current):
+    if current is not None:
+        _, f, m, view = current
+        view.release()
+        m.close()
+        f.close()
+
+def format_rate(num_bytes, seconds):
+    """
+    Args:
+        num_bytes (int): Amount of data processed.
+        seconds (float): Time it took.
+
+    Returns:
+        str: The throughput in MB/s, e.g. '412.3 MB/s'.
+    """
+    return f"{num_bytes / max(seconds, 1e-9) / 1e6:.1f} MB/s"
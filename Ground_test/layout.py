@@ -0,0 +1,143 @@
+import bisect
+import os
+
+class FileLayout:
+    """
+    Where the bytes of a torrent live on disk.
+
+    A torrent's content is the concatenation of its files, cut into pieces
+    that ignore file boundaries. The start offset of every file is kept in
+    a sorted list, so the files covering any byte range are found with one
+    bisect and a walk over the files the range actually touches, however
+    many files the torrent has. A single-file torrent is a layout with one
+    file.
+    """
+    def __init__(self, files, piece_length):
+        """
+        Args:
+            files (list): (path, length) pairs in torrent order.
+            piece_length (int): Size of each piece in bytes (the last may be shorter).
+        """
+        self.paths = [path for path, _ in files]
+        self.lengths = [length for _, length in files]
+        self.piece_length = piece_length
+        self.starts = []
+        offset = 0
+        for length in self.lengths:
+            self.starts.append(offset)
+            offset += length
+        self.total_length = offset
+        self.num_pieces = -(-offset // piece_length) if piece_length else 0
+
+    @classmethod
+    def for_torrent(cls, info, root):
+        """
+        Lay out a torrent's files under a local path.
+
+        Args:
+            info (dict): The torrent's info dictionary.
+            root (str): The file itself for a single-file torrent, or the
+                directory holding a multi-file torrent's files.
+
+        Returns:
+            FileLayout: The layout.
+
+        Raises:
+            ValueError: If a file path in 'info' would escape 'root'.
+        """
+        if 'files' not in info:
+            return cls([(root, info['length'])], info['piece_length'])
+        return cls([(os.path.join(root, *safe_path(entry['path'])), entry['length'])
+                    for entry in info['files']], info['piece_length'])
+
+    def piece_size(self, index):
+        """
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            int: Length of the piece in bytes.
+        """
+        start = index * self.piece_length
+        return max(0, min(self.piece_length, self.total_length - start))
+
+    def segments(self, offset, length):
+        """
+        Split a byte range of the torrent into the file ranges that hold it.
+
+        Args:
+            offset (int): Start of the range in the torrent's content.
+            length (int): Length of the range.
+
+        Returns:
+            list: (file index, offset in that file, length) triples in order.
+                Empty files never appear.
+        """
+        result = []
+        # The last file starting at or before 'offset'; empty files share its start
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.paths):
+            file_offset = offset - self.starts[index]
+            take = min(length, self.lengths[index] - file_offset)
+            if take > 0:
+                result.append((index, file_offset, take))
+                offset += take
+                length -= take
+            index += 1
+        return result
+
+    def piece_segments(self, index, begin=0, length=None):
+        """
+        Args:
+            index (int): The piece index.
+            begin (int, optional): Offset within the piece.
+            length (int, optional): Length of the range; defaults to the rest of the piece.
+
+        Returns:
+            list: (file index, offset in that file, length) triples, as for segments().
+        """
+        if length is None:
+            length = self.piece_size(index) - begin
+        return self.segments(index * self.piece_length + begin, length)
+
+def safe_path(components):
+    """
+    Check the path of a file in a multi-file torrent.
+
+    Args:
+        components (list): Path components relative to the torrent's directory.
+
+    Returns:
+        list: The same components.
+
+    Raises:
+        ValueError: If the path is empty, absolute or climbs out of the directory.
+    """
+    if not components:
+        raise ValueError("Empty file path in torrent")
+    for part in components:
+        if not isinstance(part, str) or part in ('', '.', '..') or '/' in part or os.sep in part:
+            raise ValueError(f"Unsafe file path in torrent: {components!r}")
+    return components
+
+def list_files(root):
+    """
+    Find every regular file under a directory, in a stable order.
+
+    Args:
+        root (str): The directory to share.
+
+    Returns:
+        list: ([path components relative to root], length) pairs, sorted by path.
+    """
+    found = []
+    for directory, subdirs, names in os.walk(root):
+        subdirs.sort()
+        relative = os.path.relpath(directory, root)
+        prefix = [] if relative == '.' else relative.split(os.sep)
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                found.append((prefix + [name], os.path.getsize(path)))
+    found.sort(key=lambda entry: entry[0])
+    return found
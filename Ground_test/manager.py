@@ -0,0 +1,268 @@
+import heapq
+import itertools
+import threading
+import time
+
+# Downloads run at the same time; the rest wait in the queue
+MAX_ACTIVE_DOWNLOADS = 4
+# Peer connections open at once over all downloads
+MAX_CONNECTIONS = 64
+# Piece and block requests in flight at once over all downloads
+MAX_IN_FLIGHT_REQUESTS = 1024
+
+class TransferLimits:
+    """
+    Connection and request budgets shared by every download of a peer.
+
+    Sessions take a connection slot for as long as they are open and a
+    request slot for every request they have in flight, so however many
+    torrents are downloading, the node never holds more than
+    'max_connections' sockets to other peers or waits on more than
+    'max_requests' responses. A connection slot is waited for; a request
+    slot is not, since the caller may be the only one able to drain the
+    responses that would free one.
+    """
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_requests=MAX_IN_FLIGHT_REQUESTS):
+        """
+        Args:
+            max_connections (int, optional): Most peer connections open at once.
+            max_requests (int, optional): Most requests in flight at once.
+        """
+        self.max_connections = max(1, max_connections)
+        self.max_requests = max(1, max_requests)
+        self.connections = 0
+        self.requests = 0
+        self.cond = threading.Condition()
+
+    def acquire_connection(self):
+        """
+        Wait until a connection slot is free and take it.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.connections < self.max_connections)
+            self.connections += 1
+
+    def release_connection(self):
+        with self.cond:
+            self.connections -= 1
+            self.cond.notify()
+
+    def try_request(self):
+        """
+        Take a request slot if one is free.
+
+        Returns:
+            bool: True if a slot was taken.
+        """
+        with self.cond:
+            if self.requests >= self.max_requests:
+                return False
+            self.requests += 1
+            return True
+
+    def take_request(self):
+        """
+        Count a request that is sent whether or not a slot is free.
+        """
+        with self.cond:
+            self.requests += 1
+
+    def release_requests(self, count=1):
+        """
+        Args:
+            count (int, optional): Number of request slots to give back.
+        """
+        if count:
+            with self.cond:
+                self.requests -= count
+
+    def stats(self):
+        """
+        Returns:
+            dict: Connections and requests in use, and their limits.
+        """
+        with self.cond:
+            return {'connections': self.connections, 'max_connections': self.max_connections,
+                    'requests': self.requests, 'max_requests': self.max_requests}
+
+class DownloadJob:
+    """
+    One queued or running download, with its progress in pieces.
+
+    A job is passed to its own target, which reports progress through
+    set_total() and update(); update() matches tqdm's, so a job can stand
+    in for a progress bar, and like it may be called from several threads.
+    """
+    def __init__(self, job_id, name, target, priority):
+        self.id = job_id
+        self.name = name
+        self.target = target
+        self.priority = priority
+        self.state = 'queued'       # queued, running, done or failed
+        self.error = None
+        self.total = 0
+        self.done = 0
+        self.added = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.entry = None           # its current entry in the manager's queue
+        self.lock = threading.Lock()
+
+    def set_total(self, total, done=0):
+        """
+        Args:
+            total (int): Number of pieces in the torrent.
+            done (int, optional): Pieces already on disk.
+        """
+        self.total = total
+        self.done = done
+
+    def update(self, count=1):
+        """
+        Args:
+            count (int, optional): Pieces completed since the last call.
+        """
+        with self.lock:
+            self.done += count
+
+    def summary(self):
+        """
+        Returns:
+            dict: The job's id, name, priority, state, progress and timing.
+        """
+        end = self.finished or time.monotonic()
+        return {'id': self.id, 'name': self.name, 'priority': self.priority, 'state': self.state,
+                'done': self.done, 'total': self.total, 'error': self.error,
+                'seconds': round(end - self.started, 1) if self.started is not None else None}
+
+class DownloadManager:
+    """
+    Queue of downloads run in the background, a few at a time.
+
+    Jobs wait in a heap ordered by priority (highest first) and then by
+    the order they were added, and are started on their own thread as
+    running jobs finish, never more than 'max_active' at once. Changing
+    the priority of a queued job pushes a new heap entry and leaves the
+    old one to be skipped when it surfaces. The sessions of every
+    download share 'limits', so the node's sockets and in-flight requests
+    stay bounded however many torrents are queued.
+
+    status() only copies counters under a short lock, so it can be called
+    from a UI thread while downloads run.
+    """
+    def __init__(self, max_active=MAX_ACTIVE_DOWNLOADS, max_connections=MAX_CONNECTIONS,
+                 max_requests=MAX_IN_FLIGHT_REQUESTS):
+        """
+        Args:
+            max_active (int, optional): Most downloads running at once.
+            max_connections (int, optional): Most peer connections over all downloads.
+            max_requests (int, optional): Most requests in flight over all downloads.
+        """
+        self.max_active = max(1, max_active)
+        self.limits = TransferLimits(max_connections, max_requests)
+        self.jobs = {}              # {job id: DownloadJob}, in the order they were added
+        self.queue = []             # heap of (-priority, sequence, job), possibly with stale entries
+        self.queued = 0
+        self.running = 0
+        self.ids = itertools.count(1)
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+
+    def add(self, name, target, priority=0):
+        """
+        Queue a download.
+
+        Args:
+            name (str): What to show for the job in status().
+            target (callable): Called with the DownloadJob on a worker thread;
+                returns a true value if the download succeeded.
+            priority (int, optional): Jobs with a higher priority start first.
+
+        Returns:
+            DownloadJob: The queued job.
+        """
+        with self.cond:
+            job = DownloadJob(next(self.ids), name, target, priority)
+            self.jobs[job.id] = job
+            self.queued += 1
+            self._push(job)
+            self._dispatch()
+        return job
+
+    def set_priority(self, job_id, priority):
+        """
+        Change the priority of a job that has not started yet.
+
+        Args:
+            job_id (int): The job's id.
+            priority (int): Its new priority.
+
+        Returns:
+            bool: True if the job was still queued.
+        """
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != 'queued':
+                return False
+            job.priority = priority
+            self._push(job)
+            return True
+
+    def _push(self, job):
+        """
+        Must be called with self.cond held.
+        """
+        job.entry = (-job.priority, next(self.sequence), job)
+        heapq.heappush(self.queue, job.entry)
+
+    def _dispatch(self):
+        """
+        Start queued jobs while fewer than max_active run. Must be called with self.cond held.
+        """
+        while self.running < self.max_active and self.queue:
+            entry = heapq.heappop(self.queue)
+            job = entry[2]
+            if entry is not job.entry:
+                continue    # superseded by a priority change
+            job.state = 'running'
+            job.started = time.monotonic()
+            self.queued -= 1
+            self.running += 1
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        try:
+            ok = job.target(job)
+        except Exception as e:
+            print(f"\nDownload of '{job.name}' failed: {e}")
+            job.error = str(e)
+            ok = False
+        with self.cond:
+            job.state = 'done' if ok else 'failed'
+            job.finished = time.monotonic()
+            self.running -= 1
+            self._dispatch()
+            self.cond.notify_all()
+
+    def status(self):
+        """
+        Returns:
+            dict: 'jobs', a summary of every job in the order added, and
+                'limits', the connections and requests in use.
+        """
+        with self.cond:
+            jobs = [job.summary() for job in self.jobs.values()]
+        return {'jobs': jobs, 'limits': self.limits.stats()}
+
+    def wait(self, timeout=None):
+        """
+        Block until no job is queued or running.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            bool: True if every job has finished.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.running and not self.queued, timeout)
@@ -1,92 +1,490 @@
+import asyncio
+import selectors
 import socket
 import threading
 import argparse
 import time
-import json
 import hashlib
 import os
-import pickle
-import struct
-import mmap
+import queue
+from collections import deque
+from functools import partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm  # Import tqdm for progress bar
+from bencode import BencodeError, info_hash as compute_info_hash, read_torrent, write_torrent
+from bitfield import Bitfield
+from choker import Choker, UPLOAD_SLOTS, CHOKE_RETRY
+from peerset import peers_from_response
+from hashing import (VerifyPool, hash_layout, format_rate, choose_piece_length, pack_piece_hashes, piece_count,
+                     piece_hash, unpack_piece_hashes)
+from layout import FileLayout, list_files
+from manager import DownloadManager, MAX_ACTIVE_DOWNLOADS, MAX_CONNECTIONS, MAX_IN_FLIGHT_REQUESTS
+from protocol import (WIRE_BINARY, WIRE_BINARY_V1, WIRE_PICKLE, LEGACY_WIRES, BufferPool, send_msg, recv_msg,
+                      recv_frame, send_piece, encode_frame, read_frame)
+from resume import ResumeState
+from seed_cache import FileHandlePool, PieceCache, ReadAhead, MAX_OPEN_FILES, PIECE_CACHE_SIZE
+from storage import PieceStorage
+from swarm import SwarmDownload, SNUB_TIMEOUT, RECEIVE_POLL
 
-def send_msg(conn, obj):
-    """
-    Serialize and send a Python object with a length prefix.
-    
-    Args:
-        conn (socket.socket): The socket connection.
-        obj (Any): The Python object to send.
-    """
-    data = pickle.dumps(obj)
-    length_prefix = struct.pack('!I', len(data))
-    conn.sendall(length_prefix + data)
+# Number of piece requests kept in flight on one peer connection
+DEFAULT_PIPELINE_DEPTH = 8
+
+# Torrent summaries requested per get_catalog call
+CATALOG_PAGE_SIZE = 500
+
+# asyncio server mode: threads for blocking file I/O and the listen backlog
+IO_WORKERS = 8
+ASYNC_BACKLOG = 4096
+
+# Seconds between announces of shared files when the tracker does not say
+DEFAULT_ANNOUNCE_INTERVAL = 120
+# First wait before retrying a failed announce; doubled on every further failure
+ANNOUNCE_RETRY = 5
+
+# Peers asked for in each announce
+NUMWANT = 50
 
-def recv_all(conn, length):
+# Largest block a remote peer may ask for in one request_block
+MAX_BLOCK_LENGTH = 128 * 1024
+
+# Answer to a handshake; 'blocks' tells the remote it may request blocks of pieces
+HANDSHAKE_ACK = {'type': 'handshake_ack', 'blocks': True}
+
+# Framings tried in turn on a remote that drops the previous one unanswered.
+# Only a remote that dropped both binary versions is spoken to in pickle, and
+# pickle replies are only accepted on such connections.
+WIRE_FALLBACK = {WIRE_BINARY: WIRE_BINARY_V1, WIRE_BINARY_V1: WIRE_PICKLE}
+
+class PeerSession:
     """
-    Receive exactly 'length' bytes from the socket.
-    
-    Args:
-        conn (socket.socket): The socket connection.
-        length (int): Number of bytes to receive.
-        
-    Returns:
-        bytes or None: The received bytes or None if connection is closed.
+    A long-lived connection to a remote peer.
+
+    The handshake is done once on the same socket that carries the piece
+    requests, and up to 'pipeline_depth' requests are kept in flight so the
+    link is not idle for a full round trip between pieces. Responses carry
+    the piece index (and the block offset for block requests), which is
+    used to match them to outstanding requests.
+
+    Requests and cancels may be sent from other threads than the one
+    receiving, e.g. to cancel endgame duplicates; they are serialised by
+    'lock'.
+
+    With 'limits' given, the session holds one of its connection slots
+    while open and one of its request slots per outstanding request.
+
+    A remote that is not serving us right now answers requests with a
+    'choke' reply, which receive() returns like any other response.
     """
-    chunks = []
-    bytes_recd = 0
-    while bytes_recd < length:
-        chunk = conn.recv(length - bytes_recd)
-        if not chunk:
+    def __init__(self, peer_host, peer_port, pipeline_depth=DEFAULT_PIPELINE_DEPTH, timeout=10,
+                 wire=WIRE_BINARY, limits=None, listen_port=None, on_data=None):
+        """
+        Args:
+            peer_host (str): The peer's IP address.
+            peer_port (int): The peer's port number.
+            pipeline_depth (int, optional): Maximum number of outstanding requests.
+            timeout (float, optional): Socket timeout in seconds.
+            wire (str, optional): Wire format to try first.
+            limits (TransferLimits, optional): Budgets shared with other sessions.
+            listen_port (int, optional): Our own listening port, sent in the
+                handshake so the remote can credit what we upload to it.
+            on_data (callable, optional): Called with the size of every piece or block received.
+        """
+        self.peer_host = peer_host
+        self.peer_port = peer_port
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.timeout = timeout
+        self.wire = wire
+        self.sock = None
+        # Created by poll() and closed with the connection
+        self.selector = None
+        # Piece indices, or (index, begin) for blocks, requested but not yet received
+        self.pending = set()
+        self.buffers = BufferPool()
+        self.lock = threading.Lock()
+        # Set by open() if the remote accepts request_block
+        self.supports_blocks = False
+        self.limits = limits
+        self.listen_port = listen_port
+        self.on_data = on_data
+        self.holds_connection = False
+        # A request slot taken by reserve_request() for the next request
+        self.reserved = False
+
+    def open(self):
+        """
+        Connect to the peer and perform the handshake on the new connection.
+
+        If the peer drops a binary handshake without answering it is an old
+        peer, and the handshake is retried with the version 1 binary framing
+        and then the pickle framing.
+
+        With limits, this first waits for a free connection slot.
+
+        Returns:
+            bool: True if the peer acknowledged the handshake, False otherwise.
+        """
+        if self.limits is not None and not self.holds_connection:
+            self.limits.acquire_connection()
+            self.holds_connection = True
+        try:
+            response = self._handshake(self.wire)
+            while response is None and self.wire in WIRE_FALLBACK:
+                self.sock.close()
+                self.wire = WIRE_FALLBACK[self.wire]
+                response = self._handshake(self.wire)
+        except Exception as e:
+            print(f"Failed to open session with peer {self.peer_host}:{self.peer_port}: {e}")
+            self.close()
+            return False
+        if not response or response.get('type') != 'handshake_ack':
+            print(f"Peer {self.peer_host}:{self.peer_port} did not acknowledge the handshake.")
+            self.close()
+            return False
+        self.supports_blocks = bool(response.get('blocks'))
+        return True
+
+    def _handshake(self, wire):
+        """
+        Connect and send the handshake in the given wire format.
+
+        Returns:
+            dict or None: The peer's reply, or None if it closed the connection.
+        """
+        self.sock = socket.create_connection((self.peer_host, self.peer_port), timeout=self.timeout)
+        handshake = {'type': 'handshake_test'}
+        if self.listen_port is not None:
+            handshake['port'] = self.listen_port
+        try:
+            send_msg(self.sock, handshake, wire)
+            return recv_msg(self.sock, wire == WIRE_PICKLE)
+        except ConnectionError:
             return None
-        chunks.append(chunk)
-        bytes_recd += len(chunk)
-    return b''.join(chunks)
 
-def recv_msg(conn):
-    """
-    Receive a length-prefixed serialized Python object from the socket.
-    
-    Args:
-        conn (socket.socket): The socket connection.
-        
-    Returns:
-        Any or None: The deserialized Python object or None if failed.
-    """
-    # Read length prefix
-    length_prefix = recv_all(conn, 4)
-    if not length_prefix:
-        return None
-    msg_length = struct.unpack('!I', length_prefix)[0]
-    data = recv_all(conn, msg_length)
-    if not data:
-        return None
-    return pickle.loads(data)
+    def can_request(self):
+        """
+        Returns:
+            bool: True if another request fits in the pipeline and in the limits.
+        """
+        return len(self.pending) < self.pipeline_depth and self.reserve_request()
+
+    def reserve_request(self):
+        """
+        Make sure a request slot is free for the next request, without waiting.
+
+        The slot is kept until that request is sent and answered, or the
+        session is closed.
+
+        Returns:
+            bool: True if the next request fits in the limits.
+        """
+        with self.lock:
+            if self.limits is None or self.reserved:
+                return True
+            self.reserved = self.limits.try_request()
+            return self.reserved
+
+    def _track(self, key):
+        """
+        Record a sent request and charge it to the limits. Must be called with self.lock held.
+        """
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        if self.limits is not None:
+            if self.reserved:
+                self.reserved = False
+            else:
+                self.limits.take_request()
+
+    def _untrack(self, key):
+        """
+        Forget an answered or cancelled request. Must be called with self.lock held.
+        """
+        if key in self.pending:
+            self.pending.discard(key)
+            if self.limits is not None:
+                self.limits.release_requests()
+
+    def request_bitfield(self, info_hash, total_pieces):
+        """
+        Ask the peer which pieces of a torrent it can serve.
+
+        Must be called while no piece requests are outstanding.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            total_pieces (int): Number of pieces in the torrent.
+
+        Returns:
+            Bitfield or None: The peer's pieces, or None if it does not have the torrent.
+        """
+        send_msg(self.sock, {'type': 'bitfield', 'info_hash': info_hash}, self.wire)
+        response = recv_msg(self.sock, self.wire == WIRE_PICKLE)
+        if not response or 'error' in response:
+            return None
+        return Bitfield(total_pieces, response['bitfield'])
+
+    def request_piece(self, info_hash, index):
+        """
+        Send a piece request without waiting for the response.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            index (int): The piece index to request.
+        """
+        with self.lock:
+            send_msg(self.sock, {'type': 'request_piece', 'info_hash': info_hash, 'index': index}, self.wire)
+            self._track(index)
+
+    def request_block(self, info_hash, index, begin, length):
+        """
+        Send a request for part of a piece without waiting for the response.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            index (int): The piece index.
+            begin (int): Offset of the block within the piece.
+            length (int): Length of the block in bytes.
+        """
+        with self.lock:
+            send_msg(self.sock, {'type': 'request_block', 'info_hash': info_hash, 'index': index,
+                                 'begin': begin, 'length': length}, self.wire)
+            self._track((index, begin))
+
+    def cancel(self, info_hash, index, begin):
+        """
+        Withdraw a block request that another peer has already answered.
+
+        The remote drops the request if it has not served it yet; if it has,
+        the block still arrives and is discarded as a duplicate.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            index (int): The piece index.
+            begin (int): Offset of the block within the piece.
+        """
+        with self.lock:
+            if self.sock is None or (index, begin) not in self.pending:
+                return
+            self._untrack((index, begin))
+            send_msg(self.sock, {'type': 'cancel', 'info_hash': info_hash, 'index': index, 'begin': begin},
+                     self.wire)
+
+    def poll(self, timeout):
+        """
+        Wait until a response starts arriving.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            bool: True if receive() will not have to wait for the first byte.
+        """
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.sock, selectors.EVENT_READ)
+        return bool(self.selector.select(timeout))
+
+    def receive(self):
+        """
+        Wait for the next response and remove its piece from the pending set.
+
+        The piece data is a memoryview into one of the session's receive
+        buffers; pass the response to release() once it has been verified
+        and written.
+
+        Returns:
+            dict or None: The response, or None if the connection was closed.
+        """
+        response = recv_msg(self.sock, self.wire == WIRE_PICKLE, self.buffers)
+        if response is not None:
+            key = response.get('index')
+            if 'begin' in response:
+                key = (key, response['begin'])
+            with self.lock:
+                self._untrack(key)
+            if self.on_data is not None and 'data' in response:
+                self.on_data(len(response['data']))
+        return response
+
+    def release(self, response):
+        """
+        Hand the receive buffer of a piece response back to the session.
+
+        Args:
+            response (dict): A response returned by receive().
+        """
+        data = response.get('data')
+        if isinstance(data, memoryview):
+            self.buffers.release(data)
+
+    def close(self):
+        """
+        Close the connection, forget any outstanding requests and give back their slots.
+        """
+        with self.lock:
+            if self.selector is not None:
+                self.selector.close()
+                self.selector = None
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+                self.sock = None
+            if self.limits is not None:
+                self.limits.release_requests(len(self.pending) + self.reserved)
+                self.reserved = False
+                if self.holds_connection:
+                    self.limits.release_connection()
+                    self.holds_connection = False
+            self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 class Peer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, pipeline_depth=DEFAULT_PIPELINE_DEPTH, allow_pickle=False,
+                 verify_resume=False, download_dir='.', piece_length=None, cache_size=PIECE_CACHE_SIZE,
+                 max_downloads=MAX_ACTIVE_DOWNLOADS, max_connections=MAX_CONNECTIONS,
+                 max_requests=MAX_IN_FLIGHT_REQUESTS, upload_slots=UPLOAD_SLOTS):
         """
         Initialize the Peer with host and port.
         
         Args:
             host (str): The IP address to bind.
             port (int): The port number to bind.
+            pipeline_depth (int, optional): Piece requests kept in flight per peer connection.
+            allow_pickle (bool, optional): Serve remote peers that use the legacy
+                pickle framing. Outgoing connections fall back to it on their own
+                when the remote turns out to be a legacy peer.
+            verify_resume (bool, optional): Re-hash pieces recorded by a resume file
+                instead of trusting it.
+            download_dir (str, optional): Where downloaded files are stored.
+            piece_length (int, optional): Piece size for files shared by this peer;
+                picked per file from its size if not given.
+            cache_size (int, optional): Bytes of served piece data kept in memory.
+            max_downloads (int, optional): Queued downloads run at the same time.
+            max_connections (int, optional): Outgoing peer connections open at once.
+            max_requests (int, optional): Piece and block requests in flight at once.
+            upload_slots (int, optional): Remote peers served at once, besides
+                the optimistic unchoke.
         """
         self.host = host
         self.port = port
+        self.pipeline_depth = pipeline_depth
+        self.allow_pickle = allow_pickle
+        self.verify_resume = verify_resume
+        self.download_dir = download_dir
+        self.piece_length = piece_length
+        # Wire format that worked for each remote (host, port)
+        self.remote_wire = {}
         self.shared_files = {}      # {info_hash: torrent}
+        self.shared_layouts = {}    # {info_hash: FileLayout of the shared files on disk}
+        # Seeding I/O: shared files stay open between requests, and data read
+        # for the asyncio server and pickle peers is cached
+        self.file_handles = FileHandlePool(MAX_OPEN_FILES)
+        self.piece_cache = PieceCache(cache_size)
+        # Background downloads, and the connection and request limits every download shares
+        self.downloads = DownloadManager(max_downloads, max_connections, max_requests)
+        # Which remote peers are served, by the rate they trade with us
+        self.choker = Choker(upload_slots)
         self.tracker_host = None
         self.tracker_port = None
-        # available_torrents[torrent_id] = (info_hash, {name, length, peers, piece_length, pieces})
+        # available_torrents[torrent_id] = (info_hash, {name, length, piece_length, num_pieces, num_peers})
         self.available_torrents = {}
+        # Local copy of the tracker's catalog: {info_hash: summary}, valid up to
+        # catalog_version of the tracker run identified by catalog_epoch
+        self.catalog = {}
+        self.catalog_version = 0
+        self.catalog_epoch = None
         self.connected_trackers = set()
+        # Announce timing requested by the tracker in its last announce response
+        self.announce_interval = DEFAULT_ANNOUNCE_INTERVAL
+        self.min_announce_interval = 0
+        # Announces that failed in a row; the tracker is kept and retried
+        self.announce_failures = 0
+        # Connection counters: incoming accepted, incoming open now and at most,
+        # outgoing peer sessions opened, and requests refused with a choke
+        self.stats = {'accepted': 0, 'active': 0, 'peak_active': 0, 'opened': 0, 'choked': 0}
+        self.stats_lock = threading.Lock()
 
-    def start_server(self):
+    def start_server(self, mode='threaded'):
         """
         Start the server thread to listen for incoming connections.
+
+        Args:
+            mode (str, optional): 'threaded' to serve each connection on its own
+                thread, or 'asyncio' to serve all of them from one event loop.
+        """
+        target = self._run_async_server if mode == 'asyncio' else self._server
+        threading.Thread(target=target, daemon=True).start()
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+        print(f"Peer listening on {self.host}:{self.port} ({mode})")
+
+    def _count_connection(self, delta):
+        """
+        Track incoming connections as they open (+1) and close (-1).
         """
-        threading.Thread(target=self._server, daemon=True).start()
-        print(f"Peer listening on {self.host}:{self.port}")
+        with self.stats_lock:
+            if delta > 0:
+                self.stats['accepted'] += 1
+            self.stats['active'] += delta
+            self.stats['peak_active'] = max(self.stats['peak_active'], self.stats['active'])
+
+    def _session(self, peer_host, peer_port, timeout=10):
+        """
+        Create a PeerSession to a remote peer with this peer's settings.
+
+        Args:
+            peer_host (str): The remote peer's IP address.
+            peer_port (int): The remote peer's port number.
+            timeout (float, optional): Socket timeout in seconds.
+
+        Returns:
+            PeerSession: The session, not yet opened.
+        """
+        with self.stats_lock:
+            self.stats['opened'] += 1
+        return PeerSession(peer_host, peer_port, self.pipeline_depth, timeout=timeout,
+                           wire=self.remote_wire.get((peer_host, peer_port), WIRE_BINARY),
+                           limits=self.downloads.limits, listen_port=self.port,
+                           on_data=partial(self.choker.record_download, (peer_host, peer_port)))
+
+    def _announce_loop(self):
+        """
+        Re-announce every shared file at the tracker's interval so the
+        tracker does not expire this peer while it is still seeding.
+
+        If the tracker cannot be reached, the round stops and is tried again
+        after announce_retry_delay().
+        """
+        last_announce = time.monotonic()
+        while True:
+            time.sleep(1)
+            if time.monotonic() - last_announce < self.announce_retry_delay():
+                continue
+            last_announce = time.monotonic()
+            for info_hash in list(self.shared_files):
+                if not self.tracker_host:
+                    break
+                self.announce_to_tracker(info_hash)
+                if self.announce_failures:
+                    break
+
+    def announce_retry_delay(self):
+        """
+        Returns:
+            float: Seconds to wait before retrying after the last failed
+                announces, doubling from ANNOUNCE_RETRY up to the announce interval.
+        """
+        if not self.announce_failures:
+            return self.announce_interval
+        return min(ANNOUNCE_RETRY * 2 ** (self.announce_failures - 1), self.announce_interval)
 
     def _server(self):
         """
@@ -99,55 +497,457 @@ class Peer:
                 conn, addr = s.accept()
                 threading.Thread(target=self._handle_client, args=(conn, addr), daemon=True).start()
 
+    def _run_async_server(self):
+        """
+        Run the asyncio server on this thread's own event loop.
+        """
+        asyncio.run(self._async_server())
+
+    async def _async_server(self):
+        """
+        Serve every connection from one event loop; file I/O runs on a bounded executor.
+        """
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='peer-io')
+        server = await asyncio.start_server(self._handle_client_async, self.host, self.port,
+                                            backlog=ASYNC_BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client_async(self, reader, writer):
+        """
+        asyncio counterpart of _handle_client.
+
+        Requests are read by a separate task into the same kind of queue,
+        so cancels are seen while earlier requests are still being served.
+
+        Args:
+            reader (asyncio.StreamReader): The client's input stream.
+            writer (asyncio.StreamWriter): The client's output stream.
+        """
+        addr = writer.get_extra_info('peername')
+        self._count_connection(1)
+        queue = deque()
+        arrived = asyncio.Event()
+        readahead = ReadAhead()
+        remote = tuple(addr[:2])
+        interested = False
+        # Clients older than the choker send no port and reject the 'choke' type
+        knows_choke = False
+
+        async def read_requests():
+            try:
+                while True:
+                    message, wire = await read_frame(reader, self.allow_pickle)
+                    if not message:
+                        break
+                    if not self._queue_request(queue, message, wire):
+                        print(f"Unknown message type from {addr}")
+                        break
+                    arrived.set()
+            except Exception as e:
+                print(f"Error reading from client {addr}: {e}")
+            finally:
+                # Wake the serving loop so it notices the end of the stream
+                arrived.set()
+
+        reader_task = asyncio.create_task(read_requests())
+        try:
+            while True:
+                if not queue:
+                    if reader_task.done():
+                        break
+                    arrived.clear()
+                    await arrived.wait()
+                    continue
+                message, wire = queue.popleft()
+                msg_type = message['type']
+                if msg_type == 'handshake_test':
+                    remote = self._remote_of(addr, message, remote, interested)
+                    knows_choke = isinstance(message.get('port'), int)
+                    writer.write(encode_frame(HANDSHAKE_ACK, wire))
+                    await writer.drain()
+                elif msg_type == 'bitfield':
+                    writer.write(encode_frame(self._bitfield_response(message['info_hash']), wire))
+                    await writer.drain()
+                else:
+                    if not interested:
+                        self.choker.connect(remote)
+                        interested = True
+                    choke = self._choke_reply(remote, message, knows_choke)
+                    if choke is not None:
+                        writer.write(encode_frame(choke, wire))
+                        await writer.drain()
+                        continue
+                    sent = await self._send_piece_async(writer, message['info_hash'], message['index'], wire,
+                                                        message.get('begin'), message.get('length'), readahead)
+                    self.choker.record_upload(remote, sent)
+        except Exception as e:
+            print(f"Error handling client {addr}: {e}")
+        finally:
+            reader_task.cancel()
+            if interested:
+                self.choker.disconnect(remote)
+            self._count_connection(-1)
+            writer.close()
+
+    @staticmethod
+    def _piece_reply(piece_index, begin, **fields):
+        """
+        Build the reply to a piece or block request, keyed so the requester can match it.
+        """
+        if begin is None:
+            reply = {'type': 'piece', 'index': piece_index}
+        else:
+            reply = {'type': 'block', 'index': piece_index, 'begin': begin}
+        reply.update(fields)
+        return reply
+
+    async def _send_piece_async(self, writer, info_hash, piece_index, wire, begin=None, length=None,
+                                readahead=None):
+        """
+        asyncio counterpart of _send_piece.
+
+        Data is always sent from memory: a cache hit is written straight
+        away, without a trip to the I/O executor.
+        """
+        location = self._piece_location(info_hash, piece_index, begin, length)
+        if isinstance(location, str):
+            writer.write(encode_frame(self._piece_reply(piece_index, begin, error=location), wire))
+            await writer.drain()
+            return 0
+        layout, start, length = location
+        data = self.piece_cache.get((info_hash, start, length))
+        if data is None:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(self.io_executor, self._read_piece_data,
+                                              info_hash, layout, start, length, readahead)
+        writer.write(encode_frame(self._piece_reply(piece_index, begin, data=data), wire))
+        await writer.drain()
+        return length
+
     def _handle_client(self, conn, addr):
         """
         Handle incoming client requests.
+
+        The connection is kept open until the remote side closes it.
+        Requests are queued and served in order, but everything the client
+        has already sent is read before the next one is served, so a
+        'cancel' can still remove a block request that is waiting its turn.
+        Data requests from a peer the choker does not serve right now get an
+        immediate 'choke' reply.
         
         Args:
             conn (socket.socket): The client connection socket.
             addr (tuple): The client address.
         """
+        self._count_connection(1)
+        queue = deque()
+        readahead = ReadAhead()
+        remote = addr
+        interested = False
+        # Clients older than the choker send no port and reject the 'choke' type
+        knows_choke = False
+        # select.select() cannot watch descriptors past FD_SETSIZE, which a busy seed reaches
+        selector = selectors.DefaultSelector()
+        selector.register(conn, selectors.EVENT_READ)
         try:
-            message = recv_msg(conn)
-            if not message:
-                conn.close()
-                return
-            msg_type = message.get('type', None)
-            if msg_type == 'handshake_test':
-                response = {'type': 'handshake_ack'}
-                send_msg(conn, response)
-            elif msg_type == 'request_piece':
-                info_hash = message['info_hash']
-                piece_index = message['index']
-                if info_hash in self.shared_files:
-                    torrent_info = self.shared_files[info_hash]['info']
-                    piece_length = torrent_info['piece_length']
-                    pieces = torrent_info['pieces']
-                    if piece_index < 0 or piece_index >= len(pieces):
-                        response = {'error': 'Invalid piece index'}
-                        send_msg(conn, response)
-                    else:
-                        file_name = torrent_info['name']
-                        start = piece_index * piece_length
-                        length = piece_length
-                        if piece_index == len(pieces)-1:
-                            total_length = torrent_info['length']
-                            length = total_length - start
-                        with open(file_name, 'rb') as f:
-                            f.seek(start)
-                            piece_data = f.read(length)
-                        response = {'data': piece_data}
-                        send_msg(conn, response)
+            while True:
+                while not queue or selector.select(0):
+                    # Replies use the same framing the client chose
+                    message, wire = recv_frame(conn, self.allow_pickle)
+                    if not message:
+                        return
+                    if not self._queue_request(queue, message, wire):
+                        print(f"Unknown message type from {addr}")
+                        return
+                message, wire = queue.popleft()
+                msg_type = message['type']
+                if msg_type == 'handshake_test':
+                    remote = self._remote_of(addr, message, remote, interested)
+                    knows_choke = isinstance(message.get('port'), int)
+                    send_msg(conn, HANDSHAKE_ACK, wire)
+                elif msg_type == 'bitfield':
+                    send_msg(conn, self._bitfield_response(message['info_hash']), wire)
                 else:
-                    response = {'error': 'File not found here.'}
-                    send_msg(conn, response)
-            else:
-                print(f"Unknown message type from {addr}")
+                    if not interested:
+                        self.choker.connect(remote)
+                        interested = True
+                    choke = self._choke_reply(remote, message, knows_choke)
+                    if choke is not None:
+                        # Answered at once, so the requester can go elsewhere instead of waiting
+                        send_msg(conn, choke, wire)
+                        continue
+                    sent = self._send_piece(conn, message['info_hash'], message['index'], wire,
+                                            message.get('begin'), message.get('length'), readahead)
+                    self.choker.record_upload(remote, sent)
         except Exception as e:
             print(f"Error handling client {addr}: {e}")
         finally:
+            if interested:
+                self.choker.disconnect(remote)
+            self._count_connection(-1)
+            selector.close()
             conn.close()
 
+    @staticmethod
+    def _remote_of(addr, handshake, remote, interested):
+        """
+        Identify a client by the listening port its handshake gives, if any.
+
+        Args:
+            addr (tuple): Address of the connection.
+            handshake (dict): The client's handshake_test message.
+            remote (tuple): How the client is identified so far.
+            interested (bool): Whether the client is already known to the choker
+                under 'remote', in which case it keeps that identity.
+
+        Returns:
+            tuple: The (host, port) the choker knows the client by.
+        """
+        port = handshake.get('port')
+        if interested or not isinstance(port, int):
+            return remote
+        return (addr[0], port)
+
+    def _choke_reply(self, remote, message, knows_choke):
+        """
+        Refuse a data request from a peer that is choked.
+
+        Args:
+            remote (tuple): The requesting peer's (host, port).
+            message (dict): Its request_piece or request_block message.
+            knows_choke (bool): Whether the peer's handshake gave a port, which
+                only peers that understand the 'choke' message type send.
+                Older peers get a plain error response instead, since their
+                binary decoder rejects unknown type codes.
+
+        Returns:
+            dict or None: The reply to send instead of the data, or None if
+                the request should be served.
+        """
+        if self.choker.allowed(remote):
+            return None
+        with self.stats_lock:
+            self.stats['choked'] += 1
+        reply = {'index': message['index'], 'error': 'Choked, try again later'}
+        if knows_choke:
+            reply['type'] = 'choke'
+        if message['type'] == 'request_block':
+            reply['begin'] = message.get('begin')
+        return reply
+
+    def _queue_request(self, queue, message, wire):
+        """
+        Add a client request to a connection's queue, or apply a cancel to it.
+
+        Args:
+            queue (deque): (message, wire) pairs waiting to be served.
+            message (dict): The request.
+            wire (str): Wire format it arrived in.
+
+        Returns:
+            bool: False if the message type is not one a peer serves.
+        """
+        msg_type = message.get('type', None)
+        if msg_type == 'cancel':
+            target = (message.get('info_hash'), message.get('index'), message.get('begin'))
+            for queued in queue:
+                request = queued[0]
+                if request['type'] == 'request_block' and \
+                        (request['info_hash'], request['index'], request.get('begin')) == target:
+                    queue.remove(queued)
+                    break
+            return True
+        if msg_type not in ('handshake_test', 'bitfield', 'request_piece', 'request_block'):
+            return False
+        queue.append((message, wire))
+        return True
+
+    def _bitfield_response(self, info_hash):
+        """
+        Build the response to a bitfield request.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+
+        Returns:
+            dict: The packed bitfield of pieces we can serve, or an error.
+        """
+        if info_hash not in self.shared_files:
+            return {'type': 'bitfield', 'error': 'File not found here.'}
+        pieces = self.shared_files[info_hash]['info']['pieces']
+        return {'type': 'bitfield', 'bitfield': Bitfield.full(piece_count(pieces)).to_bytes()}
+
+    def _send_piece(self, conn, info_hash, piece_index, wire=WIRE_BINARY, begin=None, length=None,
+                    readahead=None):
+        """
+        Answer a piece or block request.
+
+        On the binary wire the data goes from the page cache to the socket
+        with sendfile on the pooled descriptors of the files it spans; the
+        pickle wire needs the data in memory and goes through the piece cache.
+
+        Args:
+            conn (socket.socket): The client connection socket.
+            info_hash (str): The hash identifying the torrent.
+            piece_index (int): The requested piece index.
+            wire (str, optional): Wire format of the connection.
+            begin (int, optional): Offset of the requested block within the piece.
+            length (int, optional): Length of the requested block.
+            readahead (ReadAhead, optional): The connection's sequential-access detector.
+
+        Returns:
+            int: Bytes of piece data sent.
+        """
+        location = self._piece_location(info_hash, piece_index, begin, length)
+        if isinstance(location, str):
+            send_msg(conn, self._piece_reply(piece_index, begin, error=location), wire)
+            return 0
+        layout, start, length = location
+        if wire != WIRE_PICKLE:
+            with ExitStack() as stack:
+                segments = self._open_segments(stack, layout, start, length, readahead)
+                send_piece(conn, piece_index, segments, wire, begin)
+            return length
+        data = self.piece_cache.get((info_hash, start, length))
+        if data is None:
+            data = self._read_piece_data(info_hash, layout, start, length, readahead)
+        send_msg(conn, self._piece_reply(piece_index, begin, data=data), wire)
+        return length
+
+    def _open_segments(self, stack, layout, start, length, readahead=None):
+        """
+        Borrow descriptors for every file a range of a shared torrent spans.
+
+        Args:
+            stack (ExitStack): Releases the descriptors when it closes.
+            layout (FileLayout): The torrent's files on disk.
+            start (int): Offset of the range in the torrent's content.
+            length (int): Length of the range.
+            readahead (ReadAhead, optional): The connection's sequential-access detector.
+
+        Returns:
+            list: (fd, offset, length) ranges in order.
+        """
+        segments = []
+        for file_index, offset, size in layout.segments(start, length):
+            path = layout.paths[file_index]
+            fd = stack.enter_context(self.file_handles.open(path))
+            if readahead is not None:
+                readahead.served(fd, path, offset, size)
+            segments.append((fd, offset, size))
+        return segments
+
+    def _read_piece_data(self, info_hash, layout, start, length, readahead=None):
+        """
+        Read a range of a shared torrent through the handle pool and add it to the piece cache.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            layout (FileLayout): The torrent's files on disk.
+            start (int): Offset of the data in the torrent's content.
+            length (int): Length of the data.
+            readahead (ReadAhead, optional): The connection's sequential-access detector.
+
+        Returns:
+            bytes: The data.
+        """
+        with ExitStack() as stack:
+            data = b''.join(os.pread(fd, size, offset)
+                            for fd, offset, size in self._open_segments(stack, layout, start, length, readahead))
+        if len(data) != length:
+            raise ConnectionError("File ended before the piece was read")
+        self.piece_cache.put((info_hash, start, length), data)
+        return data
+
+    def _piece_location(self, info_hash, piece_index, begin=None, length=None):
+        """
+        Find where a requested piece, or a block of it, lives on disk.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            piece_index (int): The requested piece index.
+            begin (int, optional): Offset of a block within the piece.
+            length (int, optional): Length of the block.
+
+        Returns:
+            tuple or str: (FileLayout, offset in the torrent's content, length),
+                or an error message.
+        """
+        if info_hash not in self.shared_files:
+            return 'File not found here.'
+        torrent_info = self.shared_files[info_hash]['info']
+        piece_length = torrent_info['piece_length']
+        total_pieces = piece_count(torrent_info['pieces'])
+        if piece_index < 0 or piece_index >= total_pieces:
+            return 'Invalid piece index'
+        layout = self.shared_layouts[info_hash]
+        start = piece_index * piece_length
+        size = piece_length
+        if piece_index == total_pieces-1:
+            total_length = torrent_info['length']
+            size = total_length - start
+        if begin is None:
+            return layout, start, size
+        if not (0 <= begin < size and 0 < length <= MAX_BLOCK_LENGTH and begin + length <= size):
+            return 'Invalid block'
+        return layout, start + begin, length
+
+    def _request(self, host, port, message, timeout=5):
+        """
+        Send one message on a new connection and wait for the reply.
+
+        The binary framing is tried first. A remote that drops it without
+        answering is an old one; the version 1 binary framing and then the
+        pickle framing are tried, and the one it answers is remembered.
+
+        Args:
+            host (str): The remote IP address.
+            port (int): The remote port number.
+            message (dict): The message to send.
+            timeout (float, optional): Socket timeout in seconds.
+
+        Returns:
+            dict or None: The reply, or None if the remote closed the connection.
+        """
+        address = (host, port)
+        if address in self.remote_wire:
+            return self._request_once(address, message, self.remote_wire[address], timeout)
+        wire = WIRE_BINARY
+        response = self._request_once(address, message, wire, timeout)
+        while response is None and wire in WIRE_FALLBACK:
+            wire = WIRE_FALLBACK[wire]
+            response = self._request_once(address, message, wire, timeout)
+        if response is not None:
+            self.remote_wire[address] = wire
+        return response
+
+    def _request_once(self, address, message, wire, timeout):
+        with socket.create_connection(address, timeout=timeout) as s:
+            try:
+                send_msg(s, self._for_wire(message, wire), wire)
+                return recv_msg(s, wire == WIRE_PICKLE)
+            except ConnectionError:
+                return None
+
+    @staticmethod
+    def _for_wire(message, wire):
+        """
+        Give remotes on a legacy framing the piece hashes of an announced
+        torrent as the list of hex strings they predate the binary form with.
+
+        Args:
+            message (dict): The message to send; left unmodified.
+            wire (str): The framing it is sent with.
+
+        Returns:
+            dict: The message to send.
+        """
+        torrent_info = message.get('torrent_info')
+        if wire not in LEGACY_WIRES or not torrent_info or 'pieces' not in torrent_info:
+            return message
+        return dict(message, torrent_info=dict(torrent_info, pieces=unpack_piece_hashes(torrent_info['pieces'])))
+
     def connect_to_tracker(self, tracker_host, tracker_port):
         """
         Connect to the tracker and perform a handshake.
@@ -157,61 +957,126 @@ class Peer:
             tracker_port (int): The tracker's port number.
         """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5)  # Set a timeout for connecting to the tracker
-                s.connect((tracker_host, tracker_port))
-
-                # Send a handshake request
-                handshake_msg = {'type': 'handshake'}
-                send_msg(s, handshake_msg)
-
-                # Wait for the handshake response
-                response = recv_msg(s)
-                if response and response.get('type') == 'handshake_ack':
-                    print(f"Handshake successful: {response.get('message', 'No message')}")
-                    self.tracker_host = tracker_host
-                    self.tracker_port = tracker_port
-                    print(f"Connected to tracker at {self.tracker_host}:{self.tracker_port}")
-                else:
-                    print("Handshake failed: Invalid tracker response.")
+            # Send a handshake request and wait for the handshake response
+            handshake_msg = {'type': 'handshake'}
+            response = self._request(tracker_host, tracker_port, handshake_msg)
+            if response and response.get('type') == 'handshake_ack':
+                print(f"Handshake successful: {response.get('message', 'No message')}")
+                if (tracker_host, tracker_port) != (self.tracker_host, self.tracker_port):
+                    # The cached catalog belongs to the previous tracker
+                    self.catalog = {}
+                    self.catalog_version = 0
+                    self.catalog_epoch = None
+                self.tracker_host = tracker_host
+                self.tracker_port = tracker_port
+                print(f"Connected to tracker at {self.tracker_host}:{self.tracker_port}")
+            else:
+                print("Handshake failed: Invalid tracker response.")
         except Exception as e:
             print(f"Failed to connect to tracker at {tracker_host}:{tracker_port}: {e}")
 
     def get_torrent_list(self):
         """
         Retrieve the list of available torrents from the tracker.
+
+        Only torrents that changed since the previous call are fetched; the
+        rest come from the local copy of the catalog.
         """
         if not self.tracker_host or not self.tracker_port:
             print("Not connected to any tracker. Please connect first.")
             return
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.tracker_host, self.tracker_port))
-                message = {'type': 'get_torrents'}
-                send_msg(s, message)
-                response = recv_msg(s)
-                torrents = response.get('torrents', {})
-                if torrents:
-                    print("Available torrents:")
-                    self.available_torrents = {}
-                    for idx, (info_hash, t_info) in enumerate(torrents.items()):
-                        self.available_torrents[idx] = (info_hash, t_info)
-                        print(f"ID: {idx}")
-                        print(f"  Info Hash: {info_hash}")
-                        print(f"  Name: {t_info['name']}")
-                        print(f"  Size: {t_info['length']} bytes")
-                        print("  Peers holding this file:")
-                        for p_host, p_port in t_info['peers']:
-                            print(f"    {p_host}:{p_port}")
-                        print()
-                else:
-                    print("No torrents available.")
+            self._sync_catalog()
+            if self.catalog:
+                print("Available torrents:")
+                self.available_torrents = {}
+                for idx, (info_hash, t_info) in enumerate(self.catalog.items()):
+                    self.available_torrents[idx] = (info_hash, t_info)
+                    print(f"ID: {idx}")
+                    print(f"  Info Hash: {info_hash}")
+                    print(f"  Name: {t_info['name']}")
+                    print(f"  Size: {t_info['length']} bytes")
+                    print(f"  Peers holding this file: {t_info['num_peers']}")
+                    print()
+            else:
+                print("No torrents available.")
         except Exception as e:
             print(f"Failed to get torrent list from tracker: {e}")
             self.connected_trackers.discard((self.tracker_host, self.tracker_port))
             self.tracker_host = None
             self.tracker_port = None
 
+    def _sync_catalog(self):
+        """
+        Bring the local catalog up to date, one page of changes at a time.
+
+        If the tracker restarted since the last sync it answers with 'reset'
+        and the whole catalog, which replaces the local copy.
+
+        Trackers that do not know get_catalog get a single get_torrents
+        request instead, and the catalog is rebuilt from its answer.
+        """
+        since = self.catalog_version
+        epoch = self.catalog_epoch
+        while True:
+            message = {'type': 'get_catalog', 'since': since, 'limit': CATALOG_PAGE_SIZE}
+            if epoch is not None:
+                message['epoch'] = epoch
+            response = self._request(self.tracker_host, self.tracker_port, message, timeout=None)
+            if not response or 'error' in response:
+                break
+            if response.get('reset'):
+                self.catalog = {}
+            epoch = response.get('epoch')
+            for summary in response['torrents']:
+                self.catalog[summary['info_hash']] = summary
+            since = response['next']
+            if not response['more']:
+                self.catalog_version = since
+                self.catalog_epoch = epoch
+                return
+        # Older tracker: fall back to the full listing
+        message = {'type': 'get_torrents'}
+        response = self._request(self.tracker_host, self.tracker_port, message, timeout=None)
+        self.catalog = {}
+        for info_hash, t_info in response.get('torrents', {}).items():
+            pieces = pack_piece_hashes(t_info['pieces'])
+            self.catalog[info_hash] = dict(t_info, info_hash=info_hash, pieces=pieces,
+                                           num_pieces=piece_count(pieces), num_peers=len(t_info['peers']))
+        self.catalog_version = 0
+        self.catalog_epoch = None
+
+    def get_torrent_details(self, info_hash):
+        """
+        Fetch the piece hashes and current peers of one torrent from the tracker.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+
+        Returns:
+            dict or None: The torrent's info dictionary with its 'peers' added, or None on failure.
+        """
+        if info_hash in self.catalog and 'pieces' in self.catalog[info_hash]:
+            # Full details are already known from an older tracker's listing
+            return self.catalog[info_hash]
+        try:
+            message = {'type': 'get_torrent', 'info_hash': info_hash, 'numwant': NUMWANT, 'compact': True}
+            response = self._request(self.tracker_host, self.tracker_port, message, timeout=None)
+        except Exception as e:
+            print(f"Failed to get torrent details from tracker: {e}")
+            return None
+        if not response or 'error' in response:
+            print(f"Tracker has no details for torrent {info_hash}.")
+            return None
+        info = dict(response['info'], peers=peers_from_response(response))
+        try:
+            # Older trackers may still hand out hex hashes
+            info['pieces'] = pack_piece_hashes(info['pieces'])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Tracker sent malformed details for torrent {info_hash}: {e}")
+            return None
+        return info
+
     def handshake_with_peer(self, peer_host, peer_port):
         """
         Perform a handshake with another peer to verify connectivity.
@@ -224,28 +1089,32 @@ class Peer:
             bool: True if handshake is successful, False otherwise.
         """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5)
-                s.connect((peer_host, peer_port))
-                message = {'type': 'handshake_test'}
-                send_msg(s, message)
-                response = recv_msg(s)
-                if not response:
-                    print("No response from peer during handshake.")
-                    return False
-                if response.get('type') == 'handshake_ack':
-                    print("Handshake successful with the peer!")
-                    return True
-                else:
-                    print("Peer did not acknowledge the handshake.")
-                    return False
+            message = {'type': 'handshake_test'}
+            response = self._request(peer_host, peer_port, message)
+            if not response:
+                print("No response from peer during handshake.")
+                return False
+            if response.get('type') == 'handshake_ack':
+                print("Handshake successful with the peer!")
+                return True
+            else:
+                print("Peer did not acknowledge the handshake.")
+                return False
         except Exception as e:
             print(f"Failed to handshake with peer {peer_host}:{peer_port}: {e}")
             return False
 
     def download_pieces(self, info_hash, info, peer_host, peer_port):
         """
-        Download all pieces of a torrent from a single peer and assemble the file using mmap.
+        Download all pieces of a torrent from a single peer, writing each to disk once verified.
+
+        All pieces are fetched over one connection with up to
+        'self.pipeline_depth' requests outstanding. Received pieces are
+        hashed and written on a VerifyPool while the next ones arrive. A
+        piece that fails verification is requested once more before the
+        download is given up. Pieces the peer refuses because it choked us
+        are requested again after CHOKE_RETRY seconds. Pieces verified by an
+        earlier, interrupted run are not fetched again.
         
         Args:
             info_hash (str): The hash identifying the torrent.
@@ -253,71 +1122,202 @@ class Peer:
             peer_host (str): The peer's IP address.
             peer_port (int): The peer's port number.
         """
-        # Perform handshake with the peer
-        if not self.handshake_with_peer(peer_host, peer_port):
-            print("Handshake failed, cannot download.")
-            return
-
-        piece_length = info['piece_length']
         pieces = info['pieces']
-        total_pieces = len(pieces)
-        file_data_map = {}
+        total_pieces = piece_count(pieces)
         file_name = info['name']
-        total_length = info['length']
 
         print(f"Starting download of '{file_name}' from {peer_host}:{peer_port}...")
 
-        # Initialize tqdm progress bar
-        with tqdm(total=total_pieces, desc=f"Downloading {file_name}", unit="piece") as pbar:
-            for i in range(total_pieces):
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(10)  # Increased timeout to accommodate slower transfers
-                        s.connect((peer_host, peer_port))
-                        req_msg = {'type': 'request_piece', 'info_hash': info_hash, 'index': i}
-                        send_msg(s, req_msg)
-                        response = recv_msg(s)
-                        if not response:
-                            print("\nNo data received for piece")
-                            return
-                        if 'error' in response:
-                            print(f"\nError receiving piece {i}: {response['error']}")
-                            return
-                        piece_data = response['data']
-                        # Verify piece hash
-                        expected_hash = pieces[i]
-                        actual_hash = hashlib.sha1(piece_data).hexdigest()
-                        if actual_hash == expected_hash:
-                            file_data_map[i] = piece_data
-                            pbar.update(1)  # Update tqdm progress bar
-                        else:
-                            print(f"\nPiece {i} hash mismatch. Download failed.")
-                            return
-                except Exception as e:
-                    print(f"\nFailed to download piece {i} from {peer_host}:{peer_port}: {e}")
+        storage, resume = self._open_download(info_hash, info)
+        if storage is None:
+            return
+        missing = [i for i in range(total_pieces) if i not in resume.bitfield]
+        session = self._session(peer_host, peer_port)
+        failed = queue.SimpleQueue()    # pieces the verifier rejected
+        retried = set()
+        choked_until = 0
+        with storage, session:
+            try:
+                # The handshake is performed on the session's own connection
+                if missing and not session.open():
+                    print("Handshake failed, cannot download.")
                     return
 
-        # All pieces downloaded and verified
-        downloaded_file_path = f"downloaded_{file_name}"
+                # Initialize tqdm progress bar
+                with tqdm(total=total_pieces, initial=total_pieces - len(missing),
+                          desc=f"Downloading {file_name}", unit="piece") as pbar:
+
+                    def on_verified(index, piece_data):
+                        storage.write_piece(index, piece_data)
+                        resume.mark(index)
+                        pbar.update(1)  # Update tqdm progress bar
+
+                    with VerifyPool(pieces, on_verified, failed.put) as verifier:
+                        next_pos = 0
+                        while True:
+                            while not failed.empty():
+                                i = failed.get()
+                                if i in retried:
+                                    print(f"\nPiece {i} hash mismatch. Download failed.")
+                                    return
+                                retried.add(i)
+                                missing.append(i)
+                            if verifier.error is not None:
+                                print(f"\nFailed to store a piece: {verifier.error}")
+                                return
+                            if next_pos == len(missing) and not session.pending:
+                                if not verifier.pending:
+                                    break
+                                # Only pieces being verified are left; some may need fetching again
+                                verifier.wait()
+                                continue
+                            try:
+                                # Keep the pipeline full before waiting on a response
+                                while next_pos < len(missing) and time.monotonic() >= choked_until \
+                                        and session.can_request():
+                                    session.request_piece(info_hash, missing[next_pos])
+                                    next_pos += 1
+                                if not session.pending:
+                                    # Choked, or other downloads hold every request slot
+                                    time.sleep(RECEIVE_POLL)
+                                    continue
+                                response = session.receive()
+                            except Exception as e:
+                                print(f"\nFailed to download pieces from {peer_host}:{peer_port}: {e}")
+                                return
+                            if not response:
+                                print("\nNo data received for piece")
+                                return
+                            i = response.get('index')
+                            if response.get('type') == 'choke':
+                                if time.monotonic() >= choked_until:
+                                    print(f"\nPeer {peer_host}:{peer_port} choked us, trying again in {CHOKE_RETRY}s.")
+                                choked_until = time.monotonic() + CHOKE_RETRY
+                                missing.append(i)
+                                continue
+                            if 'error' in response:
+                                print(f"\nError receiving piece {i}: {response['error']}")
+                                return
+                            verifier.submit(i, response['data'], partial(session.release, response))
+            finally:
+                # Keep the progress made so far for the next attempt
+                resume.save()
+
+        resume.remove()
+        print(f"\nFile '{file_name}' assembled successfully and verified as '{storage.path}'.")
+
+    def download_swarm(self, info_hash, info, peers, job=None):
+        """
+        Download a torrent from all peers holding it at the same time.
+
+        Pieces are picked rarest-first and spread over every peer returned
+        by the tracker, including peers that show up in later announces.
+        Pieces verified by an earlier, interrupted run are not fetched again.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            info (dict): The torrent's info dictionary.
+            peers (list): (host, port) pairs known to hold the torrent.
+            job (DownloadJob, optional): The background job running the
+                download, which tracks its progress instead of a progress bar.
+
+        Returns:
+            bool: True if every piece was downloaded and verified.
+        """
+        file_name = info['name']
+        total_pieces = piece_count(info['pieces'])
+        print(f"Starting swarm download of '{file_name}' from {len(peers)} peer(s)...")
+
+        def session_factory(peer_host, peer_port):
+            return self._session(peer_host, peer_port, timeout=SNUB_TIMEOUT)
+
+        storage, resume = self._open_download(info_hash, info)
+        if storage is None:
+            return False
+
+        def on_piece(index, piece_data):
+            storage.write_piece(index, piece_data)
+            resume.mark(index)
+
+        swarm = SwarmDownload(self, info_hash, info, peers, session_factory, on_piece, have=resume.bitfield)
+        progress = job
+        with storage, ExitStack() as stack:
+            if progress is None:
+                progress = stack.enter_context(tqdm(total=total_pieces, initial=resume.bitfield.count(),
+                                                    desc=f"Downloading {file_name}", unit="piece"))
+            else:
+                progress.set_total(total_pieces, resume.bitfield.count())
+            try:
+                if not swarm.run(progress=progress):
+                    print(f"\nDownload of '{file_name}' failed.")
+                    return False
+            finally:
+                # Keep the progress made so far for the next attempt
+                resume.save()
+        resume.remove()
+        print(f"\nFile '{file_name}' assembled successfully and verified as '{storage.path}'.")
+        return True
+
+    def _open_download(self, info_hash, info):
+        """
+        Preallocate 'downloaded_<name>' for a torrent and load its resume state.
+
+        For a multi-file torrent 'downloaded_<name>' is a directory holding its files.
+
+        The resume state is only trusted if the partial file from the earlier
+        run is still there. With 'self.verify_resume' set, the pieces it marks
+        are hashed again and any that do not match are fetched again.
 
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            info (dict): The torrent's info dictionary.
+
+        Returns:
+            tuple: (PieceStorage, ResumeState), or (None, None) if the file could not be created.
+        """
+        downloaded_file_path = os.path.join(self.download_dir, f"downloaded_{info['name']}")
         try:
-            # Pre-allocate the file with the total length
-            with open(downloaded_file_path, 'wb') as f:
-                f.truncate(total_length)
-
-            # Open the file in read/write binary mode
-            with open(downloaded_file_path, 'r+b') as f:
-                # Memory-map the entire file for writing
-                with mmap.mmap(f.fileno(), length=total_length, access=mmap.ACCESS_WRITE) as m:
-                    offset = 0
-                    for i in range(total_pieces):
-                        piece_data = file_data_map[i]
-                        m[offset:offset+len(piece_data)] = piece_data
-                        offset += len(piece_data)
-
-            print(f"\nFile '{file_name}' assembled successfully and verified as '{downloaded_file_path}'.")
+            storage = PieceStorage(downloaded_file_path, info['length'], info['piece_length'], info.get('files'))
         except Exception as e:
-            print(f"\nFailed to assemble the file using mmap: {e}")
+            print(f"Failed to create '{downloaded_file_path}': {e}")
+            return None, None
+        pieces = info['pieces']
+        total_pieces = piece_count(pieces)
+        resume_path = downloaded_file_path + '.resume'
+        if storage.reused:
+            resume = ResumeState.load(resume_path, info_hash, total_pieces, flush=storage.flush)
+        else:
+            resume = ResumeState(resume_path, info_hash, total_pieces, flush=storage.flush)
+        if self.verify_resume:
+            for index in list(resume.bitfield):
+                with storage.read_piece(index) as piece_data:
+                    if hashlib.sha1(piece_data).digest() != piece_hash(pieces, index):
+                        resume.discard(index)
+        done = resume.bitfield.count()
+        if done:
+            print(f"Resuming '{info['name']}': {done}/{total_pieces} pieces already downloaded.")
+        return storage, resume
+
+    def download_torrent_file(self, torrent_file_path):
+        """
+        Download the torrent described by a .torrent file from the connected tracker's peers.
+
+        Args:
+            torrent_file_path (str): A .torrent file, as written by share_file().
+        """
+        try:
+            torrent, info_hash = read_torrent(torrent_file_path)
+        except (OSError, BencodeError) as e:
+            print(f"Cannot read torrent file '{torrent_file_path}': {e}")
+            return
+        if not self.tracker_host:
+            print("Connect to a tracker first.")
+            return
+        peers = self.announce_to_tracker(info_hash)
+        if not peers:
+            print("No peers have this file.")
+            return
+        self.download_swarm(info_hash, torrent['info'], peers)
 
     def start_download_by_id(self, torrent_id):
         """
@@ -329,68 +1329,143 @@ class Peer:
         if torrent_id not in self.available_torrents:
             print("Invalid torrent ID.")
             return
-        info_hash, t_info = self.available_torrents[torrent_id]
+        info_hash, _ = self.available_torrents[torrent_id]
+        t_info = self.get_torrent_details(info_hash)
+        if t_info is None:
+            return
         if not t_info['peers']:
             print("No peers have this file.")
             return
-        print("Choose a peer to download from:")
-        for i, p in enumerate(t_info['peers']):
-            print(f"{i}. {p[0]}:{p[1]}")
-        choice_str = input("Enter peer number: ").strip()
-        if not choice_str.isdigit():
-            print("Invalid choice.")
-            return
-        choice = int(choice_str)
-        if choice < 0 or choice >= len(t_info['peers']):
-            print("Invalid choice.")
+        self.download_swarm(info_hash, t_info, t_info['peers'])
+
+    def queue_download(self, info_hash, priority=0):
+        """
+        Queue a torrent for download in the background.
+
+        Its details and peers are fetched from the tracker when the download
+        starts, so a torrent that waited in the queue starts from a fresh
+        peer list.
+
+        Args:
+            info_hash (str): The hash identifying the torrent.
+            priority (int, optional): Downloads with a higher priority start first.
+
+        Returns:
+            DownloadJob: The queued download.
+        """
+        summary = self.catalog.get(info_hash, {})
+        name = summary.get('name', info_hash)
+
+        def run(job):
+            t_info = self.get_torrent_details(info_hash)
+            if t_info is None:
+                return False
+            if not t_info['peers']:
+                print(f"No peers have '{name}'.")
+                return False
+            return self.download_swarm(info_hash, t_info, t_info['peers'], job=job)
+
+        return self.downloads.add(name, run, priority)
+
+    def queue_download_by_id(self, torrent_id, priority=0):
+        """
+        Queue a torrent from the available list for download in the background.
+
+        Args:
+            torrent_id (int): The ID of the torrent to download.
+            priority (int, optional): Downloads with a higher priority start first.
+
+        Returns:
+            DownloadJob or None: The queued download, or None if the ID is unknown.
+        """
+        if torrent_id not in self.available_torrents:
+            print(f"Invalid torrent ID {torrent_id}.")
+            return None
+        info_hash, _ = self.available_torrents[torrent_id]
+        job = self.queue_download(info_hash, priority)
+        print(f"Queued '{job.name}' as download {job.id} with priority {priority}.")
+        return job
+
+    def print_download_status(self):
+        """
+        Show every background download and the connections and requests in use.
+        """
+        status = self.downloads.status()
+        if not status['jobs']:
+            print("No downloads queued.")
             return
-        peer_host, peer_port = t_info['peers'][choice]
-        # Start downloading directly without threading
-        self.download_pieces(info_hash, t_info, peer_host, peer_port)
+        print(f"{'id':>4} {'state':<8} {'prio':>4} {'pieces':>13} {'secs':>7}  name")
+        for job in status['jobs']:
+            pieces = f"{job['done']}/{job['total']}" if job['total'] else '-'
+            seconds = job['seconds'] if job['seconds'] is not None else '-'
+            print(f"{job['id']:>4} {job['state']:<8} {job['priority']:>4} {pieces:>13} {seconds:>7}  {job['name']}")
+        limits = status['limits']
+        print(f"Connections: {limits['connections']}/{limits['max_connections']}, "
+              f"requests in flight: {limits['requests']}/{limits['max_requests']}")
 
-    def share_file(self, file_path):
+    def share_file(self, file_path, piece_length=None):
         """
         Share a file by creating a torrent and announcing it to the tracker.
+
+        A directory is shared as one multi-file torrent of every file under it.
         
         Args:
-            file_path (str): The path to the file to share.
+            file_path (str): The path to the file or directory to share.
+            piece_length (int, optional): The length of each piece in bytes; see create_torrent_file().
+
+        Returns:
+            str: The info_hash of the shared torrent.
         """
-        torrent = self.create_torrent_file(file_path)
-        info_str = json.dumps(torrent['info'], sort_keys=True)
-        info_hash = hashlib.sha1(info_str.encode()).hexdigest()
+        torrent = self.create_torrent_file(file_path, piece_length)
+        info_hash = compute_info_hash(torrent['info'])
+        layout = FileLayout.for_torrent(torrent['info'], file_path)
+        # The files may have been replaced since they were last served
+        for path in layout.paths:
+            self.file_handles.forget(path)
         self.shared_files[info_hash] = torrent
+        self.shared_layouts[info_hash] = layout
         print(f"Sharing file '{file_path}' with info_hash {info_hash}")
-        torrent_file_name = file_path + ".torrent"
-        with open(torrent_file_name, 'w') as tf:
-            json.dump(torrent, tf, indent=4)
+        torrent_file_name = file_path.rstrip(os.sep) + ".torrent"
+        write_torrent(torrent_file_name, torrent)
         print(f"Torrent file created: {torrent_file_name}")
         if not self.tracker_host or not self.tracker_port:
             tracker_host = input("Enter the tracker's IP address: ").strip()
             tracker_port = int(input("Enter the tracker's port number: ").strip())
             self.connect_to_tracker(tracker_host, tracker_port)
         self.announce_to_tracker(info_hash, event='completed')
+        return info_hash
 
-    def create_torrent_file(self, file_path, piece_length=512*1024):
+    def create_torrent_file(self, file_path, piece_length=None):
         """
-        Create a torrent file for the given file.
+        Create a torrent file for the given file or directory.
+
+        A directory becomes a multi-file torrent: its info has a 'files'
+        list of {'path': [components], 'length'} entries in the order the
+        pieces run through them, and 'length' is their total size.
         
         Args:
-            file_path (str): The path to the file to create a torrent for.
-            piece_length (int, optional): The length of each piece in bytes. Defaults to 512*1024 (512KB).
+            file_path (str): The path to the file or directory to create a torrent for.
+            piece_length (int, optional): The length of each piece in bytes. Defaults to
+                self.piece_length, or a size picked by choose_piece_length() if that is unset.
         
         Returns:
             dict: The torrent metadata dictionary.
         """
-        pieces = []
-        total_length = 0
-        with open(file_path, 'rb') as f:
-            while True:
-                piece = f.read(piece_length)
-                if not piece:
-                    break
-                piece_hash = hashlib.sha1(piece).hexdigest()
-                pieces.append(piece_hash)
-                total_length += len(piece)
+        name = os.path.basename(file_path.rstrip(os.sep))
+        files = None
+        if os.path.isdir(file_path):
+            files = [{'path': path, 'length': length} for path, length in list_files(file_path)]
+            file_size = sum(entry['length'] for entry in files)
+        else:
+            file_size = os.path.getsize(file_path)
+        piece_length = piece_length or self.piece_length or choose_piece_length(file_size)
+        info = {'name': name, 'length': file_size, 'piece_length': piece_length}
+        if files is not None:
+            info['files'] = files
+        layout = FileLayout.for_torrent(info, file_path)
+        with tqdm(total=file_size, desc=f"Hashing {name}", unit="B", unit_scale=True) as pbar:
+            pieces, total_length, elapsed = hash_layout(layout, progress=pbar.update)
+        print(f"Hashed {piece_count(pieces)} pieces in {elapsed:.2f}s ({format_rate(total_length, elapsed)})")
 
         tracker_host = self.tracker_host
         tracker_port = self.tracker_port
@@ -405,12 +1480,7 @@ class Peer:
                 "host": self.host,
                 "port": self.port,
             },
-            "info": {
-                "name": os.path.basename(file_path),
-                "length": total_length,
-                "piece_length": piece_length,
-                "pieces": pieces
-            },
+            "info": dict(info, pieces=pieces),
         }
         return torrent
 
@@ -429,46 +1499,75 @@ class Peer:
             print("Not connected to any tracker. Please connect to a tracker first.")
             return []
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5)
-                s.connect((self.tracker_host, self.tracker_port))
-                message = {
-                    'type': 'announce',
-                    'info_hash': info_hash,
-                    'host': self.host,
-                    'port': self.port,
-                    'event': event
-                }
-                if event == 'completed' and info_hash in self.shared_files:
-                    torrent_info = self.shared_files[info_hash]['info']
-                    message['torrent_info'] = torrent_info
-                send_msg(s, message)
-                response = recv_msg(s)
-                peers = response.get('peers', [])
-                self.connected_trackers.add((self.tracker_host, self.tracker_port))
-                return peers
+            message = {
+                'type': 'announce',
+                'info_hash': info_hash,
+                'host': self.host,
+                'port': self.port,
+                'event': event,
+                'numwant': NUMWANT,
+                'compact': True
+            }
+            if event == 'completed' and info_hash in self.shared_files:
+                torrent_info = self.shared_files[info_hash]['info']
+                message['torrent_info'] = torrent_info
+            response = self._request(self.tracker_host, self.tracker_port, message)
+            # Trackers that do not know 'compact' answer with a plain list
+            peers = peers_from_response(response)
+            # Trackers that predate announce intervals leave these out
+            self.announce_interval = response.get('interval', self.announce_interval)
+            self.min_announce_interval = response.get('min_interval', self.min_announce_interval)
+            self.connected_trackers.add((self.tracker_host, self.tracker_port))
+            self.announce_failures = 0
+            return peers
         except Exception as e:
+            # Keep the tracker: it may only be restarting, and dropping it would
+            # end the re-announces and let it expire this peer
+            self.announce_failures += 1
             print(f"Failed to announce to tracker at {self.tracker_host}:{self.tracker_port}: {e}")
-            self.connected_trackers.discard((self.tracker_host, self.tracker_port))
-            self.tracker_host = None
-            self.tracker_port = None
             return []
 
     def stop_all_transfers(self):
         """
-        Placeholder method to stop all ongoing transfers.
-        Currently not implemented.
+        Tell the tracker this peer stops sharing its files, so other peers
+        stop being pointed at it before its announces expire.
         """
-        pass
+        for info_hash in list(self.shared_files):
+            if not self.tracker_host:
+                break
+            self.announce_to_tracker(info_hash, event='stopped')
+        self.file_handles.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='P2P Peer')
     parser.add_argument('--host', default='127.0.0.1', help='Peer host')
     parser.add_argument('--port', type=int, required=True, help='Peer port')
+    parser.add_argument('--pipeline-depth', type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help='Piece requests kept in flight per peer connection')
+    parser.add_argument('--allow-pickle', action='store_true',
+                        help='Also serve peers that only speak the legacy pickle framing')
+    parser.add_argument('--server', choices=['threaded', 'asyncio'], default='threaded',
+                        help='Serve connections with one thread each or from one asyncio event loop')
+    parser.add_argument('--verify-resume', action='store_true',
+                        help='Re-hash pieces recorded in resume files instead of trusting them')
+    parser.add_argument('--piece-length', type=int,
+                        help='Piece size in bytes for shared files (default: chosen from each file size)')
+    parser.add_argument('--max-downloads', type=int, default=MAX_ACTIVE_DOWNLOADS,
+                        help='Queued downloads run at the same time')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='Peer connections open at once over all downloads')
+    parser.add_argument('--max-requests', type=int, default=MAX_IN_FLIGHT_REQUESTS,
+                        help='Piece and block requests in flight at once over all downloads')
+    parser.add_argument('--upload-slots', type=int, default=UPLOAD_SLOTS,
+                        help='Remote peers served at once, plus one optimistic unchoke')
     args = parser.parse_args()
 
-    peer = Peer(host=args.host, port=args.port)
-    peer.start_server()
+    peer = Peer(host=args.host, port=args.port, pipeline_depth=args.pipeline_depth,
+                allow_pickle=args.allow_pickle, verify_resume=args.verify_resume,
+                piece_length=args.piece_length, max_downloads=args.max_downloads,
+                max_connections=args.max_connections, max_requests=args.max_requests,
+                upload_slots=args.upload_slots)
+    peer.start_server(args.server)
     time.sleep(1)  # Give the server time to start
 
     try:
@@ -479,7 +1578,10 @@ if __name__ == "__main__":
             print("3. Share a file")
             print("4. Download a file by ID (multi-piece)")
             print("5. Handshake with a peer (test connectivity)")
-            print("6. Quit")
+            print("6. Download from a .torrent file")
+            print("7. Queue downloads by ID in the background")
+            print("8. Show download status")
+            print("9. Quit")
 
             choice = input("Enter your choice: ").strip()
             if choice == '1':
@@ -489,8 +1591,8 @@ if __name__ == "__main__":
             elif choice == '2':
                 peer.get_torrent_list()
             elif choice == '3':
-                file_path = input("Enter the file path to share: ").strip()
-                if os.path.isfile(file_path):
+                file_path = input("Enter the file or directory path to share: ").strip()
+                if os.path.exists(file_path):
                     peer.share_file(file_path)
                 else:
                     print("File not found.")
@@ -509,6 +1611,22 @@ if __name__ == "__main__":
                 p_port = int(input("Enter the peer's port number: ").strip())
                 peer.handshake_with_peer(p_host, p_port)
             elif choice == '6':
+                peer.download_torrent_file(input("Enter the .torrent file path: ").strip())
+            elif choice == '7':
+                if not peer.available_torrents:
+                    print("No available torrents. Please get the list first.")
+                    continue
+                ids = input("Enter the torrent IDs to download, separated by commas: ").replace(',', ' ').split()
+                priority_str = input("Enter a priority (higher starts first, default 0): ").strip()
+                valid_priority = not priority_str or priority_str.lstrip('-').isdigit()
+                if not ids or not all(t.isdigit() for t in ids) or not valid_priority:
+                    print("Invalid torrent ID or priority.")
+                    continue
+                for torrent_id in ids:
+                    peer.queue_download_by_id(int(torrent_id), int(priority_str or 0))
+            elif choice == '8':
+                peer.print_download_status()
+            elif choice == '9':
                 print("Exiting.")
                 break
             else:
@@ -0,0 +1,145 @@
+import random
+import socket
+import struct
+
+# Compact peer entries: the packed address followed by the port
+PORT = struct.Struct('!H')
+COMPACT_IPV4_SIZE = 4 + PORT.size
+COMPACT_IPV6_SIZE = 16 + PORT.size
+
+class PeerSet:
+    """
+    Set of (host, port) peers that can also be indexed.
+
+    Peers live in a list with a dict from peer to position. Removal moves
+    the last peer into the freed slot, so add, discard and membership are
+    O(1) and a random sample of k peers costs O(k) however large the
+    swarm is, with no copy of the whole set.
+    """
+    def __init__(self, peers=()):
+        """
+        Args:
+            peers (iterable, optional): Initial (host, port) pairs.
+        """
+        self.items = []
+        self.positions = {}
+        for peer in peers:
+            self.add(peer)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, peer):
+        return peer in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, peer):
+        """
+        Args:
+            peer (tuple): The peer's (host, port).
+        """
+        if peer not in self.positions:
+            self.positions[peer] = len(self.items)
+            self.items.append(peer)
+
+    def discard(self, peer):
+        """
+        Remove a peer if present.
+
+        Args:
+            peer (tuple): The peer's (host, port).
+        """
+        position = self.positions.pop(peer, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def sample(self, count, exclude=None):
+        """
+        Pick up to 'count' distinct peers at random.
+
+        Args:
+            count (int): Number of peers wanted.
+            exclude (tuple, optional): A peer never to return, usually the requester.
+
+        Returns:
+            list: The chosen (host, port) pairs.
+        """
+        skip = self.positions.get(exclude)
+        available = len(self.items) - (skip is not None)
+        if count >= available:
+            return [peer for peer in self.items if peer != exclude]
+        # Draw one extra position in case the excluded peer is among them
+        positions = random.sample(range(len(self.items)), count + (skip is not None))
+        chosen = [self.items[i] for i in positions if i != skip]
+        return chosen[:count]
+
+def pack_peers(peers):
+    """
+    Encode peers in compact form.
+
+    IPv4 peers take 6 bytes each and IPv6 peers 18 bytes. Peers whose host
+    is a name rather than an address cannot be packed and are returned
+    as they are.
+
+    Args:
+        peers (iterable): (host, port) pairs.
+
+    Returns:
+        tuple: (IPv4 bytes, IPv6 bytes, list of unpackable (host, port) pairs).
+    """
+    packed4 = []
+    packed6 = []
+    others = []
+    for host, port in peers:
+        try:
+            packed4.append(socket.inet_pton(socket.AF_INET, host) + PORT.pack(port))
+            continue
+        except OSError:
+            pass
+        try:
+            packed6.append(socket.inet_pton(socket.AF_INET6, host) + PORT.pack(port))
+        except OSError:
+            others.append((host, port))
+    return b''.join(packed4), b''.join(packed6), others
+
+def unpack_peers(peers4=b'', peers6=b''):
+    """
+    Decode compact peer lists produced by pack_peers().
+
+    Args:
+        peers4 (bytes-like, optional): Packed IPv4 peers.
+        peers6 (bytes-like, optional): Packed IPv6 peers.
+
+    Returns:
+        list: (host, port) pairs.
+    """
+    peers = []
+    for data, family, size in ((peers4, socket.AF_INET, COMPACT_IPV4_SIZE),
+                               (peers6, socket.AF_INET6, COMPACT_IPV6_SIZE)):
+        data = bytes(data)
+        if len(data) % size:
+            raise ValueError(f"Compact peer list of {len(data)} bytes is not a multiple of {size}")
+        for offset in range(0, len(data), size):
+            host = socket.inet_ntop(family, data[offset:offset + size - PORT.size])
+            port, = PORT.unpack_from(data, offset + size - PORT.size)
+            peers.append((host, port))
+    return peers
+
+def peers_from_response(response):
+    """
+    Collect the peers of a tracker response, compact or not.
+
+    Args:
+        response (dict): An announce or get_torrent response.
+
+    Returns:
+        list: (host, port) pairs.
+    """
+    peers = [tuple(peer) for peer in response.get('peers', [])]
+    return peers + unpack_peers(response.get('peers4', b''), response.get('peers6', b''))
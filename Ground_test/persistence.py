@@ -0,0 +1,190 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from bencode import write_torrent
+from hashing import pack_piece_hashes
+
+# How long the writer waits to gather more changes into one batch
+BATCH_INTERVAL = 1.0
+# A batch is written once it holds this many changes, even before its interval is up
+MAX_BATCH_SIZE = 1024
+
+class CatalogStore:
+    """
+    Durable record of the tracker's torrent catalog.
+
+    Changes are queued by the request handlers and written by a background
+    thread, so no announce ever waits for the disk. Each batch is appended
+    to 'catalog.log' (one JSON record per line) with a single fsync, and
+    the .torrent export of every torrent in the batch is rewritten once.
+    On shutdown the catalog is compacted into 'catalog.snapshot.json' and
+    the log is emptied, so a restart only has to read one file. Piece
+    hashes are kept as one hex string in the JSON files and as raw bytes
+    everywhere else.
+    """
+    def __init__(self, directory='torrents', batch_interval=BATCH_INTERVAL):
+        """
+        Args:
+            directory (str, optional): Where the log, snapshot and .torrent files live.
+            batch_interval (float, optional): Seconds to gather changes before writing.
+        """
+        self.directory = directory
+        self.batch_interval = batch_interval
+        self.log_path = os.path.join(directory, 'catalog.log')
+        self.snapshot_path = os.path.join(directory, 'catalog.snapshot.json')
+        self.queue = queue.Queue()
+        self.writer = None
+
+    def load(self):
+        """
+        Read the catalog back from the snapshot and the log written after it.
+
+        Returns:
+            dict: {info_hash: {'info': torrent_info, 'announce': {'host', 'port'}}}
+        """
+        catalog = {}
+        try:
+            with open(self.snapshot_path) as f:
+                catalog = {info_hash: dict(entry, info=_info_from_json(entry['info']))
+                           for info_hash, entry in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"Ignoring unreadable catalog snapshot {self.snapshot_path}: {e}")
+        try:
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line half-written
+                        break
+                    catalog[record['info_hash']] = {'info': _info_from_json(record['info']),
+                                                    'announce': record['announce']}
+        except FileNotFoundError:
+            pass
+        return catalog
+
+    def start(self):
+        """
+        Start the background writer.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+
+    def record(self, info_hash, torrent_info, peer_host, peer_port):
+        """
+        Queue a catalog change; returns immediately.
+
+        Args:
+            info_hash (str): The info_hash of the torrent.
+            torrent_info (dict): The torrent's info dictionary.
+            peer_host (str): The host address of the announcing peer.
+            peer_port (int): The port number of the announcing peer.
+        """
+        self.queue.put({
+            'info_hash': info_hash,
+            'info': torrent_info,
+            'announce': {'host': peer_host, 'port': peer_port},
+        })
+
+    def _writer(self):
+        """
+        Write queued changes in batches until a None sentinel arrives.
+
+        A batch is closed 'batch_interval' seconds after its first change
+        or at MAX_BATCH_SIZE changes, so a steady stream of announces is
+        still written regularly.
+        """
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_interval
+            try:
+                while batch[-1] is not None and len(batch) < MAX_BATCH_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            with open(self.log_path, 'a') as log:
+                for record in batch:
+                    record = dict(record, info=_info_to_json(record['info']))
+                    log.write(json.dumps(record, separators=(',', ':')) + '\n')
+                log.flush()
+                os.fsync(log.fileno())
+        except OSError as e:
+            print(f"Failed to append to catalog log {self.log_path}: {e}")
+        # Only the latest change of each torrent needs exporting
+        latest = {record['info_hash']: record for record in batch}
+        for record in latest.values():
+            self._save_torrent_file(record)
+
+    def _save_torrent_file(self, record):
+        """
+        Save the torrent information as a bencoded .torrent file.
+
+        Args:
+            record (dict): A catalog change as queued by record().
+        """
+        torrent = {
+            "announce": record['announce'],
+            "info": record['info'],
+            "comment": "Torrent file stored by tracker",
+            "created_by": "Tracker"
+        }
+        torrent_file_name = os.path.join(self.directory, f"{record['info_hash']}.torrent")
+        try:
+            write_torrent(torrent_file_name, torrent)
+            print(f"Tracker saved torrent file as {torrent_file_name}")
+        except Exception as e:
+            print(f"Failed to write torrent file {torrent_file_name}: {e}")
+
+    def close(self, catalog=None):
+        """
+        Flush pending changes, stop the writer and optionally compact.
+
+        Args:
+            catalog (dict, optional): The full catalog, in the form returned by
+                load(). If given it is written as the new snapshot and the log
+                is emptied.
+        """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if catalog is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({info_hash: dict(entry, info=_info_to_json(entry['info']))
+                       for info_hash, entry in catalog.items()}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Everything in the log is now part of the snapshot
+        open(self.log_path, 'w').close()
+
+def _info_to_json(info):
+    if isinstance(info.get('pieces'), (bytes, bytearray)):
+        return dict(info, pieces=info['pieces'].hex())
+    return info
+
+def _info_from_json(info):
+    if 'pieces' in info:
+        return dict(info, pieces=pack_piece_hashes(info['pieces']))
+    return info
@@ -0,0 +1,506 @@
+import asyncio
+import io
+import json
+import os
+import pickle
+import struct
+import threading
+
+# Wire formats. WIRE_PICKLE is the original length-prefixed pickle framing,
+# kept so that old peers and trackers keep working during the migration.
+WIRE_BINARY = 'binary'
+WIRE_PICKLE = 'pickle'
+# The binary framing as spoken by peers of protocol version 1, which only
+# know bytes values at the top level of a message
+WIRE_BINARY_V1 = 'binary-v1'
+# Framings of peers that predate raw piece hashes and expect a list of hex strings
+LEGACY_WIRES = (WIRE_PICKLE, WIRE_BINARY_V1)
+
+# Version 2 adds bytes nested in dicts, listed in '_raw' by their key path.
+# Frames are answered in the version they were sent with.
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+# Every binary frame starts with a fixed header:
+#   marker (4 zero bytes), version, message type, info_hash (20 raw bytes),
+#   piece index, meta length, data length
+# followed by 'meta length' bytes of JSON for the remaining fields and
+# 'data length' bytes of raw payload. An old server reads the marker as a
+# zero-length pickle message and drops the connection straight away, which
+# lets a new client fall back to WIRE_PICKLE without waiting for a timeout.
+BINARY_MARKER = b'\x00\x00\x00\x00'
+HEADER = struct.Struct('!4sBB20siII')
+LEGACY_PREFIX = struct.Struct('!I')
+NO_INDEX = -1
+NO_INFO_HASH = bytes(20)
+
+# Refuse frames that claim more than this, before allocating anything
+MAX_META_LENGTH = 64 * 1024 * 1024
+MAX_DATA_LENGTH = 256 * 1024 * 1024
+# A pickle message carries what a binary frame splits into meta and data
+MAX_LEGACY_LENGTH = MAX_META_LENGTH + MAX_DATA_LENGTH
+# recv_all() starts with a buffer this big and doubles it as data arrives
+RECV_CHUNK = 1024 * 1024
+
+# Message type codes are positions in this tuple; only ever append to it.
+# Dicts without a 'type' key (plain responses) travel as 'response'.
+MESSAGE_TYPES = (
+    'response',
+    'handshake',
+    'handshake_ack',
+    'handshake_test',
+    'announce',
+    'get_torrents',
+    'bitfield',
+    'request_piece',
+    'piece',
+    'get_catalog',
+    'get_torrent',
+    'request_block',
+    'block',
+    'cancel',
+    'choke',
+)
+MESSAGE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+# Messages whose payload can be received into a pooled buffer
+POOLED_CODES = (MESSAGE_CODES['piece'], MESSAGE_CODES['block'])
+
+class ProtocolError(Exception):
+    """
+    Raised when a frame cannot be decoded or is not allowed.
+    """
+    pass
+
+class _PlainUnpickler(pickle.Unpickler):
+    """
+    Unpickler for legacy frames that refuses to load any class or function.
+
+    Legacy messages only hold dicts, lists, tuples, strings, numbers and
+    bytes, none of which needs a global, so refusing globals keeps a
+    pickle frame from running code on the receiver.
+    """
+    def find_class(self, module, name):
+        raise ProtocolError(f"Pickle frames may not reference {module}.{name}")
+
+def _loads_legacy(data):
+    """
+    Args:
+        data (bytes-like): The body of a legacy pickle frame.
+
+    Returns:
+        object: The message it carries.
+
+    Raises:
+        ProtocolError: If the frame is malformed or references a class or function.
+    """
+    try:
+        return _PlainUnpickler(io.BytesIO(data)).load()
+    except (pickle.UnpicklingError, EOFError, ValueError, TypeError) as e:
+        raise ProtocolError(f"Malformed pickle frame: {e}")
+
+class BufferPool:
+    """
+    Receive buffers reused across the messages of one connection.
+
+    Piece payloads are read straight into a pooled bytearray and handed out
+    as a memoryview, so a piece is allocated once per connection rather than
+    once per message. The receiver must call release() once it has hashed
+    and stored the piece; the view is invalidated and its memory reused.
+    """
+    def __init__(self, max_free=4):
+        """
+        Args:
+            max_free (int, optional): Number of idle buffers to keep around.
+        """
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        """
+        Args:
+            size (int): Number of bytes needed.
+
+        Returns:
+            memoryview: A writable view of exactly 'size' bytes.
+        """
+        with self.lock:
+            for i, buf in enumerate(self.free):
+                if len(buf) >= size:
+                    del self.free[i]
+                    return memoryview(buf)[:size]
+        return memoryview(bytearray(size))
+
+    def release(self, view):
+        """
+        Return a buffer obtained from acquire().
+
+        Args:
+            view (memoryview): The view returned by acquire().
+        """
+        buf = view.obj
+        view.release()
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+def recv_into_all(conn, view):
+    """
+    Fill 'view' completely from the socket.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        view (memoryview): Writable buffer to fill.
+
+    Returns:
+        bool: False if the connection closed before the buffer was full.
+    """
+    bytes_recd = 0
+    length = len(view)
+    while bytes_recd < length:
+        n = conn.recv_into(view[bytes_recd:])
+        if not n:
+            return False
+        bytes_recd += n
+    return True
+
+def recv_all(conn, length):
+    """
+    Receive exactly 'length' bytes from the socket.
+
+    The bytes are read straight into one buffer instead of being collected
+    in chunks and joined. The buffer starts at RECV_CHUNK and doubles as it
+    fills, so memory follows the data that actually arrives rather than the
+    length the sender claims.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        length (int): Number of bytes to receive.
+
+    Returns:
+        bytearray or None: The received bytes or None if connection is closed.
+    """
+    buf = bytearray(min(length, RECV_CHUNK))
+    received = 0
+    while received < length:
+        if received == len(buf):
+            buf.extend(bytes(min(len(buf), length - len(buf))))
+        with memoryview(buf) as view:
+            n = conn.recv_into(view[received:])
+        if not n:
+            return None
+        received += n
+    return buf
+
+def encode_header(msg_type, info_hash=None, index=None, meta_length=0, data_length=0, version=PROTOCOL_VERSION):
+    """
+    Pack a binary frame header.
+
+    Args:
+        msg_type (str): One of MESSAGE_TYPES.
+        info_hash (str, optional): Hex info_hash; sent as 20 raw bytes.
+        index (int, optional): Piece index.
+        meta_length (int, optional): Length of the JSON section.
+        data_length (int, optional): Length of the raw payload.
+        version (int, optional): Protocol version the frame is written in.
+
+    Returns:
+        bytes: The packed header.
+    """
+    if msg_type not in MESSAGE_CODES:
+        raise ProtocolError(f"Unknown message type '{msg_type}'")
+    raw_hash = bytes.fromhex(info_hash) if info_hash else NO_INFO_HASH
+    return HEADER.pack(BINARY_MARKER, version, MESSAGE_CODES[msg_type], raw_hash,
+                       NO_INDEX if index is None else index, meta_length, data_length)
+
+def encode_message(obj, version=PROTOCOL_VERSION):
+    """
+    Encode a message dict as a binary frame.
+
+    'type', 'info_hash' and 'index' go into the header, bytes values are
+    carried raw in the data section and everything else is JSON. Bytes
+    nested in dicts, such as the piece hashes of a torrent's info, are
+    carried raw as well and listed in the layout by their key path, which
+    needs protocol version 2.
+
+    Args:
+        obj (dict): The message.
+        version (int, optional): Protocol version to write the frame in.
+
+    Returns:
+        bytes: The complete frame.
+
+    Raises:
+        ProtocolError: If the message has nested bytes and version is 1.
+    """
+    raw_fields = []
+    meta = _split_raw({key: value for key, value in obj.items() if key not in ('type', 'info_hash', 'index')},
+                      [], raw_fields)
+    if version < 2 and any(isinstance(key, list) for key, _ in raw_fields):
+        raise ProtocolError("Nested bytes values need protocol version 2")
+    if raw_fields and ([key for key, _ in raw_fields] != ['data'] or not len(raw_fields[0][1])):
+        # Anything but a single non-empty 'data' field needs its layout spelled out
+        meta['_raw'] = [[key, len(value)] for key, value in raw_fields]
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode() if meta else b''
+    data_length = sum(len(value) for _, value in raw_fields)
+    header = encode_header(obj.get('type', 'response'), obj.get('info_hash'), obj.get('index'),
+                           len(meta_bytes), data_length, version)
+    return b''.join([header, meta_bytes] + [value for _, value in raw_fields])
+
+def _split_raw(fields, path, raw_fields):
+    """
+    Copy a dict without its bytes values, collecting those into raw_fields.
+
+    Top-level values are listed under their key and nested ones under
+    their key path, so frames without nested bytes keep the old layout.
+
+    Returns:
+        dict: The fields that go into the JSON section.
+    """
+    meta = {}
+    for key, value in fields.items():
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            raw_fields.append((path + [key] if path else key, value))
+        elif isinstance(value, dict):
+            meta[key] = _split_raw(value, path + [key], raw_fields)
+        else:
+            meta[key] = value
+    return meta
+
+def decode_message(header, meta_bytes, data):
+    """
+    Rebuild a message dict from the parts of a binary frame.
+
+    Args:
+        header (tuple): The unpacked HEADER fields.
+        meta_bytes (bytes): The JSON section.
+        data (bytes): The raw payload.
+
+    Returns:
+        dict: The message.
+    """
+    _, version, code, raw_hash, index, _, _ = header
+    if version not in SUPPORTED_VERSIONS:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if code >= len(MESSAGE_TYPES):
+        raise ProtocolError(f"Unknown message type code {code}")
+    try:
+        message = json.loads(meta_bytes) if meta_bytes else {}
+    except ValueError as e:
+        raise ProtocolError(f"Malformed message fields: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("Malformed message fields")
+    raw_layout = message.pop('_raw', None)
+    if raw_layout is None:
+        if data:
+            message['data'] = data
+    else:
+        offset = 0
+        for key, length in raw_layout:
+            target = message
+            if isinstance(key, list):
+                # A value nested in dicts, addressed by its key path
+                if version < 2:
+                    raise ProtocolError("Malformed raw field layout")
+                try:
+                    for part in key[:-1]:
+                        target = target[part]
+                    key = key[-1]
+                except (KeyError, TypeError, IndexError):
+                    raise ProtocolError("Malformed raw field layout")
+                if not isinstance(target, dict):
+                    raise ProtocolError("Malformed raw field layout")
+            target[key] = data[offset:offset + length]
+            offset += length
+    if MESSAGE_TYPES[code] != 'response':
+        message['type'] = MESSAGE_TYPES[code]
+    if raw_hash != NO_INFO_HASH:
+        message['info_hash'] = raw_hash.hex()
+    if index != NO_INDEX:
+        message['index'] = index
+    return message
+
+def send_msg(conn, obj, wire=WIRE_BINARY):
+    """
+    Serialize and send a message.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        obj (dict): The message to send.
+        wire (str, optional): WIRE_BINARY, WIRE_BINARY_V1 or WIRE_PICKLE.
+    """
+    conn.sendall(encode_frame(obj, wire))
+
+def encode_frame(obj, wire=WIRE_BINARY):
+    """
+    Serialize a message into a complete frame.
+
+    Args:
+        obj (dict): The message to send.
+        wire (str, optional): WIRE_BINARY, WIRE_BINARY_V1 or WIRE_PICKLE.
+
+    Returns:
+        bytes: The frame, ready to be written to a socket or stream.
+    """
+    if wire == WIRE_PICKLE:
+        data = pickle.dumps(obj)
+        return LEGACY_PREFIX.pack(len(data)) + data
+    return encode_message(obj, _wire_version(wire))
+
+def _wire_version(wire):
+    """
+    Returns:
+        int: The protocol version binary frames are written in for a wire format.
+    """
+    return 1 if wire == WIRE_BINARY_V1 else PROTOCOL_VERSION
+
+def _binary_wire(header):
+    """
+    Returns:
+        str: The wire format to answer a binary frame with, from its header's version.
+    """
+    return WIRE_BINARY_V1 if header[1] == 1 else WIRE_BINARY
+
+def recv_frame(conn, allow_pickle=False, pool=None):
+    """
+    Receive one message in whichever framing the sender used.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        allow_pickle (bool, optional): Accept the legacy pickle framing; only
+            for connections known to lead to a legacy peer, or servers that
+            opted in to them.
+        pool (BufferPool, optional): If given, the payload of a binary 'piece'
+            or 'block' message is received into a pooled buffer and returned
+            as a memoryview under 'data', which the caller must release.
+
+    Returns:
+        tuple: (message, wire), or (None, None) if the connection closed.
+    """
+    prefix = recv_all(conn, LEGACY_PREFIX.size)
+    if not prefix:
+        return None, None
+    if prefix != BINARY_MARKER:
+        if not allow_pickle:
+            raise ProtocolError("Legacy pickle framing is disabled")
+        msg_length = LEGACY_PREFIX.unpack(prefix)[0]
+        if msg_length > MAX_LEGACY_LENGTH:
+            raise ProtocolError("Frame too large")
+        data = recv_all(conn, msg_length)
+        if not data:
+            return None, None
+        return _loads_legacy(data), WIRE_PICKLE
+    rest = recv_all(conn, HEADER.size - LEGACY_PREFIX.size)
+    if not rest:
+        return None, None
+    header = HEADER.unpack(prefix + rest)
+    meta_length, data_length = header[5], header[6]
+    if meta_length > MAX_META_LENGTH or data_length > MAX_DATA_LENGTH:
+        raise ProtocolError("Frame too large")
+    meta_bytes = recv_all(conn, meta_length) if meta_length else b''
+    if meta_bytes is None:
+        return None, None
+    # Only a payload that is entirely 'data' can be handed out as one view
+    if pool is not None and data_length and header[2] in POOLED_CODES and b'"_raw"' not in meta_bytes:
+        data = pool.acquire(data_length)
+        if not recv_into_all(conn, data):
+            pool.release(data)
+            return None, None
+    else:
+        data = recv_all(conn, data_length) if data_length else b''
+        if data is None:
+            return None, None
+    return decode_message(header, meta_bytes, data), _binary_wire(header)
+
+def recv_msg(conn, allow_pickle=False, pool=None):
+    """
+    Receive one message in whichever framing the sender used.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        allow_pickle (bool, optional): Accept the legacy pickle framing.
+        pool (BufferPool, optional): Receive piece payloads into pooled buffers.
+
+    Returns:
+        dict or None: The message, or None if the connection closed.
+    """
+    return recv_frame(conn, allow_pickle, pool)[0]
+
+async def read_frame(reader, allow_pickle=False):
+    """
+    Read one message from an asyncio stream, in whichever framing the sender used.
+
+    Args:
+        reader (asyncio.StreamReader): The stream to read from.
+        allow_pickle (bool, optional): Accept the legacy pickle framing.
+
+    Returns:
+        tuple: (message, wire), or (None, None) if the connection closed.
+    """
+    try:
+        prefix = await reader.readexactly(LEGACY_PREFIX.size)
+        if prefix != BINARY_MARKER:
+            if not allow_pickle:
+                raise ProtocolError("Legacy pickle framing is disabled")
+            msg_length = LEGACY_PREFIX.unpack(prefix)[0]
+            if not msg_length:
+                return None, None
+            if msg_length > MAX_LEGACY_LENGTH:
+                raise ProtocolError("Frame too large")
+            return _loads_legacy(await reader.readexactly(msg_length)), WIRE_PICKLE
+        header = HEADER.unpack(prefix + await reader.readexactly(HEADER.size - LEGACY_PREFIX.size))
+        meta_length, data_length = header[5], header[6]
+        if meta_length > MAX_META_LENGTH or data_length > MAX_DATA_LENGTH:
+            raise ProtocolError("Frame too large")
+        meta_bytes = await reader.readexactly(meta_length) if meta_length else b''
+        data = await reader.readexactly(data_length) if data_length else b''
+    except asyncio.IncompleteReadError:
+        return None, None
+    return decode_message(header, meta_bytes, data), _binary_wire(header)
+
+def _payload_header(index, begin, length, version=PROTOCOL_VERSION):
+    """
+    Build the part of a 'piece' or 'block' frame that comes before the payload.
+    """
+    if begin is None:
+        return encode_header('piece', index=index, data_length=length, version=version)
+    meta_bytes = json.dumps({'begin': begin}, separators=(',', ':')).encode()
+    return encode_header('block', index=index, meta_length=len(meta_bytes), data_length=length,
+                         version=version) + meta_bytes
+
+def send_piece(conn, index, segments, wire=WIRE_BINARY, begin=None):
+    """
+    Send a piece response whose data lies in one or more file ranges.
+
+    On the binary wire only the header is built in Python; the payload goes
+    from the page cache to the socket with os.sendfile, one range after the
+    other. The pickle wire has to read the piece into memory.
+
+    Args:
+        conn (socket.socket): The socket connection.
+        index (int): The piece index.
+        segments (list): (fd, offset, length) ranges of open files, in order.
+        wire (str, optional): WIRE_BINARY, WIRE_BINARY_V1 or WIRE_PICKLE.
+        begin (int, optional): Offset of a block within the piece; the
+            response is then a 'block' instead of a whole 'piece'.
+    """
+    if wire == WIRE_PICKLE:
+        data = b''.join(os.pread(fd, length, offset) for fd, offset, length in segments)
+        message = {'type': 'piece', 'index': index, 'data': data}
+        if begin is not None:
+            message.update(type='block', begin=begin)
+        send_msg(conn, message, wire)
+        return
+    conn.sendall(_payload_header(index, begin, sum(length for _, _, length in segments), _wire_version(wire)))
+    for fd, offset, length in segments:
+        if not hasattr(os, 'sendfile'):
+            # No sendfile on this platform; socket.sendfile falls back to read/send
+            with os.fdopen(os.dup(fd), 'rb') as f:
+                conn.sendfile(f, offset, length)
+            continue
+        sent = 0
+        while sent < length:
+            n = os.sendfile(conn.fileno(), fd, offset + sent, length - sent)
+            if n == 0:
+                raise ConnectionError("File ended before the piece was sent")
+            sent += n
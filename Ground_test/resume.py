@@ -0,0 +1,118 @@
+import os
+import struct
+import threading
+import time
+
+from bitfield import Bitfield
+
+# Resume files hold a fixed header followed by the packed bitfield:
+#   magic, format version, info_hash (20 raw bytes), number of pieces
+RESUME_HEADER = struct.Struct('!4sB20sI')
+RESUME_MAGIC = b'P2RS'
+RESUME_VERSION = 1
+# Minimum number of seconds between two writes of the resume file
+SAVE_INTERVAL = 2
+
+class ResumeState:
+    """
+    The set of verified pieces of one download, kept in a small file next
+    to the download target so an interrupted download can pick up where it
+    stopped instead of starting again from piece 0.
+    """
+    def __init__(self, path, info_hash, total_pieces, bitfield=None, flush=None):
+        """
+        Args:
+            path (str): Where the resume file lives.
+            info_hash (str): The hash identifying the torrent.
+            total_pieces (int): Number of pieces in the torrent.
+            bitfield (Bitfield, optional): Pieces already verified.
+            flush (callable, optional): Called before each save so that pieces
+                marked in the file are also on disk.
+        """
+        self.path = path
+        self.info_hash = info_hash
+        self.bitfield = bitfield if bitfield is not None else Bitfield(total_pieces)
+        self.flush = flush
+        self.lock = threading.Lock()
+        self.last_save = 0
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path, info_hash, total_pieces, flush=None):
+        """
+        Read a resume file, ignoring it if it is missing or belongs to another torrent.
+
+        Args:
+            path (str): Where the resume file lives.
+            info_hash (str): The hash identifying the torrent.
+            total_pieces (int): Number of pieces in the torrent.
+            flush (callable, optional): See __init__.
+
+        Returns:
+            ResumeState: The saved state, or an empty one.
+        """
+        bitfield = None
+        try:
+            with open(path, 'rb') as f:
+                magic, version, raw_hash, count = RESUME_HEADER.unpack(f.read(RESUME_HEADER.size))
+                if (magic, version, raw_hash.hex(), count) == (RESUME_MAGIC, RESUME_VERSION, info_hash, total_pieces):
+                    bitfield = Bitfield(total_pieces, f.read())
+        except (OSError, struct.error, ValueError):
+            bitfield = None
+        return cls(path, info_hash, total_pieces, bitfield, flush)
+
+    def mark(self, index):
+        """
+        Record a verified piece, saving the file if the last save is old enough.
+
+        Args:
+            index (int): The piece index.
+        """
+        with self.lock:
+            self.bitfield.set(index)
+            self.dirty = True
+            if time.monotonic() - self.last_save >= SAVE_INTERVAL:
+                self._save()
+
+    def discard(self, index):
+        """
+        Forget a piece that turned out not to be valid.
+
+        Args:
+            index (int): The piece index.
+        """
+        with self.lock:
+            self.bitfield.clear(index)
+            self.dirty = True
+
+    def save(self):
+        """
+        Write the state now if anything changed since the last save.
+        """
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        if self.flush is not None:
+            self.flush()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(RESUME_HEADER.pack(RESUME_MAGIC, RESUME_VERSION, bytes.fromhex(self.info_hash),
+                                       self.bitfield.length))
+            f.write(self.bitfield.to_bytes())
+        # Replace atomically so a crash never leaves a half-written file
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+        self.dirty = False
+
+    def remove(self):
+        """
+        Delete the resume file once the download is complete.
+        """
+        with self.lock:
+            self.dirty = False
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
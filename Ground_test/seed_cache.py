@@ -0,0 +1,213 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Descriptors kept open across requests, over all shared files
+MAX_OPEN_FILES = 64
+# Bytes of piece data kept in memory by default
+PIECE_CACHE_SIZE = 64 * 1024 * 1024
+# How far ahead the kernel is asked to read for a sequential requester
+READ_AHEAD_BYTES = 1024 * 1024
+
+class FileHandlePool:
+    """
+    Read-only descriptors for shared files, kept open between requests.
+
+    Pieces are read with os.pread and os.sendfile, which take an explicit
+    offset, so one descriptor per file can be used by every connection at
+    once without seeking. The least recently used file is closed once more
+    than 'max_open' are open; a descriptor still in use when it is evicted
+    is closed when its last user releases it.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        """
+        Args:
+            max_open (int, optional): Most descriptors kept open at a time.
+        """
+        self.max_open = max(1, max_open)
+        self.handles = OrderedDict()    # {path: fd}, least recently used first
+        self.users = {}                 # {fd: number of callers using it}
+        self.retired = set()            # evicted descriptors still in use
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path):
+        """
+        Borrow the descriptor of a file for the duration of a with block.
+
+        Args:
+            path (str): The file to read.
+
+        Yields:
+            int: A descriptor open for reading.
+        """
+        fd = self._acquire(path)
+        try:
+            yield fd
+        finally:
+            self._release(fd)
+
+    def _acquire(self, path):
+        with self.lock:
+            fd = self.handles.get(path)
+            if fd is None:
+                fd = os.open(path, os.O_RDONLY)
+                self.handles[path] = fd
+                while len(self.handles) > self.max_open:
+                    _, old = self.handles.popitem(last=False)
+                    self._retire(old)
+            else:
+                self.handles.move_to_end(path)
+            self.users[fd] = self.users.get(fd, 0) + 1
+            return fd
+
+    def _release(self, fd):
+        with self.lock:
+            self.users[fd] -= 1
+            if self.users[fd] == 0:
+                del self.users[fd]
+                if fd in self.retired:
+                    self.retired.discard(fd)
+                    os.close(fd)
+
+    def _retire(self, fd):
+        """
+        Close a descriptor that left the pool, or mark it for closing once released.
+        """
+        if fd in self.users:
+            self.retired.add(fd)
+        else:
+            os.close(fd)
+
+    def forget(self, path):
+        """
+        Drop the descriptor of a file, e.g. because it was replaced on disk.
+
+        Args:
+            path (str): The file.
+        """
+        with self.lock:
+            fd = self.handles.pop(path, None)
+            if fd is not None:
+                self._retire(fd)
+
+    def close(self):
+        """
+        Close every descriptor that is not in use right now.
+        """
+        with self.lock:
+            while self.handles:
+                _, fd = self.handles.popitem()
+                self._retire(fd)
+
+class PieceCache:
+    """
+    Size-bounded LRU cache of piece and block data read from shared files.
+
+    Popular pieces are requested by many leechers in a short time; the
+    cache answers the repeats from memory instead of reading the files
+    again. Entries are keyed by (info_hash, offset, length) in the
+    torrent's content, so a block is only shared between requests for
+    exactly the same range, which is the case for leechers using the same
+    block size. Content is identified by its info_hash, so a changed file
+    never hits stale entries.
+    """
+    def __init__(self, max_bytes=PIECE_CACHE_SIZE):
+        """
+        Args:
+            max_bytes (int, optional): Most bytes of data kept; 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # {(info_hash, offset, length): bytes}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+            key (tuple): (info_hash, offset, length) of the data.
+
+        Returns:
+            bytes or None: The cached data, or None on a miss.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """
+        Store data read from disk, evicting the least recently used entries to make room.
+
+        Args:
+            key (tuple): (info_hash, offset, length) of the data.
+            data (bytes): The data.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, entries and bytes currently cached.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+class ReadAhead:
+    """
+    Per-connection detector for sequential requests.
+
+    When a connection asks for the range that starts where its previous
+    request ended, the kernel is told to start reading the following
+    READ_AHEAD_BYTES, so the next request finds its data in the page cache.
+    Random access, such as rarest-first swarm downloads, never triggers it.
+    """
+    def __init__(self, window=READ_AHEAD_BYTES):
+        """
+        Args:
+            window (int, optional): Bytes to read ahead of a sequential requester.
+        """
+        self.window = window
+        self.path = None
+        self.end = None
+        self.advised = 0
+
+    def served(self, fd, path, offset, length):
+        """
+        Record a request served from a file and read ahead if it continues the previous one.
+
+        Args:
+            fd (int): Descriptor of the file.
+            path (str): The file.
+            offset (int): Start of the range served.
+            length (int): Length of the range served.
+        """
+        sequential = path == self.path and offset == self.end
+        if path != self.path:
+            self.advised = 0
+        self.path = path
+        self.end = offset + length
+        # Advise once per window rather than once per block
+        if sequential and self.end >= self.advised and hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, self.end, self.window, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                return
+            self.advised = self.end + self.window // 2
@@ -0,0 +1,154 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from layout import FileLayout
+
+# Files of a multi-file torrent kept open and mapped at once
+MAX_MAPPED_FILES = 64
+
+class PieceStorage:
+    """
+    The on-disk target of a download.
+
+    Every file of the torrent is preallocated to its final size once, and
+    every piece is written through a memory mapping at its offset as soon
+    as it has been verified, split over the files it spans. Nothing is
+    buffered beyond the piece being written, so memory use does not grow
+    with the size of the torrent. A torrent of many small files only keeps
+    the MAX_MAPPED_FILES most recently written ones mapped; the others are
+    flushed and closed.
+    """
+    def __init__(self, path, total_length, piece_length, files=None):
+        """
+        Args:
+            path (str): Where to store the file, or the directory of a multi-file torrent.
+            total_length (int): Final size of the torrent's content in bytes.
+            piece_length (int): Size of each piece in bytes (the last may be shorter).
+            files (list, optional): The 'files' list of a multi-file torrent's info.
+        """
+        self.path = path
+        self.total_length = total_length
+        self.piece_length = piece_length
+        self.lock = threading.Lock()
+        info = {'length': total_length, 'piece_length': piece_length}
+        if files is not None:
+            info['files'] = files
+        self.layout = FileLayout.for_torrent(info, path)
+        if self.layout.total_length != total_length:
+            raise ValueError(f"Files add up to {self.layout.total_length} bytes, not {total_length}")
+        # True if an earlier, possibly partial, download of this size is being reused
+        self.reused = all(os.path.exists(p) and os.path.getsize(p) == length
+                          for p, length in zip(self.layout.paths, self.layout.lengths))
+        self.mapped = OrderedDict()     # {file index: (file, mmap)}, least recently used first
+        for file_path, length in zip(self.layout.paths, self.layout.lengths):
+            self._allocate(file_path, length)
+
+    @staticmethod
+    def _allocate(file_path, length):
+        """
+        Create or reuse one file of the torrent at its final size.
+        """
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Keep whatever is already on disk; only the size is fixed up
+        with open(file_path, 'r+b' if os.path.exists(file_path) else 'w+b') as f:
+            f.truncate(length)
+            if length and hasattr(os, 'posix_fallocate'):
+                try:
+                    # Reserve the blocks now so the download cannot run out of space halfway
+                    os.posix_fallocate(f.fileno(), 0, length)
+                except OSError:
+                    pass
+
+    def _map(self, file_index):
+        """
+        Return the mapping of a file, mapping it first if needed. Must be called with self.lock held.
+        """
+        entry = self.mapped.get(file_index)
+        if entry is not None:
+            self.mapped.move_to_end(file_index)
+            return entry[1]
+        f = open(self.layout.paths[file_index], 'r+b')
+        try:
+            m = mmap.mmap(f.fileno(), self.layout.lengths[file_index], access=mmap.ACCESS_WRITE)
+        except BaseException:
+            f.close()
+            raise
+        self.mapped[file_index] = (f, m)
+        while len(self.mapped) > MAX_MAPPED_FILES:
+            _, (old_file, old_map) = self.mapped.popitem(last=False)
+            old_map.flush()
+            old_map.close()
+            old_file.close()
+        return m
+
+    def piece_size(self, index):
+        """
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            int: Length of the piece in bytes.
+        """
+        return self.layout.piece_size(index)
+
+    def write_piece(self, index, data):
+        """
+        Write a verified piece at its offset, across file boundaries if it spans them.
+
+        Args:
+            index (int): The piece index.
+            data (bytes-like): The piece contents.
+        """
+        start = index * self.piece_length
+        if start + len(data) > self.total_length:
+            raise ValueError(f"Piece {index} of {len(data)} bytes does not fit in the torrent")
+        data = memoryview(data)
+        position = 0
+        with self.lock:
+            for file_index, offset, length in self.layout.segments(start, len(data)):
+                self._map(file_index)[offset:offset + length] = data[position:position + length]
+                position += length
+
+    def read_piece(self, index):
+        """
+        Args:
+            index (int): The piece index.
+
+        Returns:
+            memoryview: The piece as currently stored on disk. Only a
+                single-file torrent, whose one mapping is never closed early,
+                gets a view into the mapping; other torrents get a copy.
+        """
+        segments = self.layout.piece_segments(index)
+        with self.lock:
+            if len(self.layout.paths) == 1 and segments:
+                _, offset, length = segments[0]
+                return memoryview(self._map(0))[offset:offset + length]
+            return memoryview(b''.join(self._map(file_index)[offset:offset + length]
+                                       for file_index, offset, length in segments))
+
+    def flush(self):
+        with self.lock:
+            for _, m in self.mapped.values():
+                m.flush()
+
+    def close(self):
+        """
+        Flush outstanding writes and release the mappings and the files.
+        """
+        with self.lock:
+            while self.mapped:
+                _, (f, m) = self.mapped.popitem()
+                m.flush()
+                m.close()
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
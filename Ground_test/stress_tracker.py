@@ -0,0 +1,108 @@
+import argparse
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+
+from protocol import send_msg, recv_msg
+from tracker import Tracker, SHARDS
+
+def free_port():
+    """
+    Returns:
+        int: A loopback port nothing is listening on right now.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def announce_over_socket(host, port, message):
+    with socket.create_connection((host, port), timeout=10) as s:
+        send_msg(s, message)
+        return recv_msg(s)
+
+def run_round(announce, threads, announces, info_hashes):
+    """
+    Announce from several threads at once and time it.
+
+    Args:
+        announce (callable): Sends one announce message.
+        threads (int): Number of concurrent announcing threads.
+        announces (int): Announces sent by each thread.
+        info_hashes (list): Torrents to announce, picked at random.
+
+    Returns:
+        tuple: (announces per second, number of failed announces).
+    """
+    failures = [0] * threads
+    start = threading.Barrier(threads + 1)
+
+    def worker(number):
+        rng = random.Random(number)
+        # Every thread is its own peer, on a port of its own
+        message = {'type': 'announce', 'host': '127.0.0.1', 'port': 20000 + number,
+                   'numwant': 50, 'compact': True}
+        start.wait()
+        for _ in range(announces):
+            message['info_hash'] = rng.choice(info_hashes)
+            try:
+                announce(message)
+            except Exception:
+                failures[number] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for w in workers:
+        w.start()
+    start.wait()
+    started = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    return threads * announces / elapsed, sum(failures)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure tracker announce throughput as the number of announcing threads grows')
+    parser.add_argument('--threads', default='1,2,4,8,16',
+                        help='Comma-separated thread counts to try')
+    parser.add_argument('--shards', default=f'1,{SHARDS}',
+                        help='Comma-separated shard counts to compare (in-process tracker only)')
+    parser.add_argument('--announces', type=int, default=1000, help='Announces sent by each thread')
+    parser.add_argument('--torrents', type=int, default=1000, help='Number of distinct torrents announced')
+    parser.add_argument('--direct', action='store_true',
+                        help='Call the announce handler in-process instead of going over sockets')
+    parser.add_argument('--tracker', metavar='HOST:PORT',
+                        help='Stress a running tracker instead of starting one (ignores --shards)')
+    args = parser.parse_args()
+
+    thread_counts = [int(n) for n in args.threads.split(',')]
+    info_hashes = [os.urandom(20).hex() for _ in range(args.torrents)]
+
+    if args.tracker:
+        host, port = args.tracker.rsplit(':', 1)
+        targets = [('-', lambda m, h=host, p=int(port): announce_over_socket(h, p, m))]
+    else:
+        targets = []
+        data_dir = tempfile.TemporaryDirectory(prefix='stress-tracker-')
+        for shards in [int(n) for n in args.shards.split(',')]:
+            tracker = Tracker('127.0.0.1', free_port(), data_dir=data_dir.name, shards=shards)
+            if args.direct:
+                announce = tracker._handle_announce
+            else:
+                tracker.start()
+                announce = lambda m, p=tracker.port: announce_over_socket('127.0.0.1', p, m)
+            targets.append((shards, announce))
+        time.sleep(0.5)  # Let the servers start listening
+
+    print(f"{'shards':>6} {'threads':>7} {'announces/s':>12} {'speedup':>8} {'failed':>7}")
+    for shards, announce in targets:
+        baseline = None
+        for threads in thread_counts:
+            rate, failed = run_round(announce, threads, args.announces, info_hashes)
+            baseline = baseline or rate
+            print(f"{shards:>6} {threads:>7} {rate:>12.0f} {rate / baseline:>7.2f}x {failed:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,576 @@
+import math
+import random
+import socket
+import threading
+import time
+from functools import partial
+
+from choker import CHOKE_RETRY
+from hashing import VerifyPool, piece_count
+
+# A peer that leaves a request unanswered this long is treated as snubbed
+# and its outstanding pieces are handed to other peers.
+SNUB_TIMEOUT = 15
+# How often the tracker is asked for new peers while a download runs
+REANNOUNCE_INTERVAL = 30
+# Seconds of requests a peer should have queued, given its measured rate
+REQUEST_QUEUE_TIME = 2
+# Pieces are requested in blocks of this size so that they can come from several peers
+BLOCK_SIZE = 16 * 1024
+# Most block requests kept outstanding on one connection
+MAX_PENDING_BLOCKS = 256
+# How long a worker waits for data before checking whether it has new work
+RECEIVE_POLL = 0.5
+
+class PieceAssembly:
+    """
+    A piece being downloaded block by block, possibly from several peers.
+    """
+    def __init__(self, size, block_size):
+        """
+        Args:
+            size (int): Length of the piece in bytes.
+            block_size (int): Length of each block (the last may be shorter).
+        """
+        self.size = size
+        self.block_size = block_size
+        self.num_blocks = max(1, -(-size // block_size))
+        # Allocated by the first block written, since whole-piece downloads never use it
+        self.buffer = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every received block, e.g. after the piece failed verification.
+        """
+        self.have = bytearray(self.num_blocks)
+        self.received = 0
+        self.requested = {}     # {block: set of peers it is requested from}
+        # Blocks neither received nor requested; popped from the end, lowest first
+        self.open = list(reversed(range(self.num_blocks)))
+
+    def block_range(self, block):
+        """
+        Returns:
+            tuple: (begin, length) of a block within the piece.
+        """
+        begin = block * self.block_size
+        return begin, min(self.block_size, self.size - begin)
+
+class PieceScheduler:
+    """
+    Rarest-first block picker shared by every peer worker of one download.
+
+    Pieces are split into BLOCK_SIZE blocks, and each block can come from
+    a different peer. Workers first finish pieces that are already under
+    way, then start new pieces in order of how few connected peers have
+    them, with random tie-breaking so that downloaders of the same torrent
+    do not all chase the same pieces. Blocks received from a peer that
+    later fails are kept; only its outstanding requests go back to the pool.
+
+    Once every missing block has been requested (endgame), idle peers are
+    given blocks already requested elsewhere, least duplicated first, so a
+    single slow peer cannot hold up the end of the download. Whichever copy
+    arrives first wins and the other requests are reported for cancelling.
+
+    Peers that cannot serve blocks are handed whole pieces instead.
+    """
+    def __init__(self, total_pieces, piece_length, total_length, have=None, block_size=BLOCK_SIZE):
+        """
+        Args:
+            total_pieces (int): Number of pieces in the torrent.
+            piece_length (int): Size of each piece in bytes (the last may be shorter).
+            total_length (int): Size of the torrent's content in bytes.
+            have (Bitfield, optional): Pieces already on disk, which are never requested.
+            block_size (int, optional): Size of the blocks pieces are requested in.
+        """
+        self.total_pieces = total_pieces
+        self.piece_length = piece_length
+        self.total_length = total_length
+        self.block_size = block_size
+        self.availability = [0] * total_pieces
+        self.missing = set(range(total_pieces))
+        if have is not None:
+            self.missing.difference_update(have)
+        self.unstarted = set(self.missing)
+        self.active = {}            # {piece_index: PieceAssembly}
+        self.peer_pieces = {}       # {peer: Bitfield}
+        self._order = []
+        self._dirty = True
+        self.cond = threading.Condition()
+
+    def add_peer(self, peer, bitfield):
+        """
+        Register the pieces a newly connected peer has.
+
+        Args:
+            peer (tuple): The peer's (host, port).
+            bitfield (Bitfield): The pieces the peer can serve.
+        """
+        with self.cond:
+            self.peer_pieces[peer] = bitfield
+            for index in bitfield:
+                self.availability[index] += 1
+            self._dirty = True
+            self.cond.notify_all()
+
+    def remove_peer(self, peer):
+        """
+        Forget a peer and return every block requested from it to the pool.
+
+        Args:
+            peer (tuple): The peer's (host, port).
+        """
+        with self.cond:
+            bitfield = self.peer_pieces.pop(peer, None)
+            if bitfield is not None:
+                for index in bitfield:
+                    self.availability[index] -= 1
+                self._dirty = True
+            for piece in self.active.values():
+                for block in [b for b, peers in piece.requested.items() if peer in peers]:
+                    peers = piece.requested[block]
+                    peers.discard(peer)
+                    if not peers:
+                        del piece.requested[block]
+                        piece.open.append(block)
+            self.cond.notify_all()
+
+    def _start_piece(self, bitfield):
+        """
+        Start the rarest piece the peer has that nobody has started. Must be called with self.cond held.
+
+        Returns:
+            int or None: The piece index, or None if there is none.
+        """
+        if self._dirty:
+            self._order = sorted(self.unstarted, key=lambda i: (self.availability[i], random.random()))
+            self._dirty = False
+        # Drop started pieces from the front so later scans stay short
+        start = 0
+        while start < len(self._order) and self._order[start] not in self.unstarted:
+            start += 1
+        del self._order[:start]
+        for index in self._order:
+            if index in self.unstarted and index in bitfield:
+                self.unstarted.discard(index)
+                offset = index * self.piece_length
+                self.active[index] = PieceAssembly(min(self.piece_length, self.total_length - offset),
+                                                   self.block_size)
+                return index
+        return None
+
+    def _assign(self, index, block, peer):
+        piece = self.active[index]
+        piece.requested.setdefault(block, set()).add(peer)
+        begin, length = piece.block_range(block)
+        return index, begin, length
+
+    def next_block(self, peer):
+        """
+        Assign the next block to request from a peer.
+
+        Args:
+            peer (tuple): The peer's (host, port).
+
+        Returns:
+            tuple or None: (index, begin, length), or None if there is nothing to assign.
+        """
+        with self.cond:
+            bitfield = self.peer_pieces.get(peer)
+            if bitfield is None:
+                return None
+            for index, piece in self.active.items():
+                if piece.open and index in bitfield:
+                    return self._assign(index, piece.open.pop(), peer)
+            index = self._start_piece(bitfield)
+            if index is not None:
+                return self._assign(index, self.active[index].open.pop(), peer)
+            if self.unstarted:
+                return None
+            # Endgame: everything is requested, so duplicate the least duplicated block
+            best = None
+            for index, piece in self.active.items():
+                if index not in bitfield:
+                    continue
+                for block, peers in piece.requested.items():
+                    if peer not in peers and (best is None or len(peers) < best[2]):
+                        best = (index, block, len(peers))
+            if best is None:
+                return None
+            return self._assign(best[0], best[1], peer)
+
+    def next_piece(self, peer):
+        """
+        Assign a whole piece to a peer that cannot serve blocks.
+
+        A started piece is only taken over once none of its blocks is
+        requested or received, as after its peer left or it failed
+        verification.
+
+        Args:
+            peer (tuple): The peer's (host, port).
+
+        Returns:
+            int or None: The piece index, or None if there is nothing to assign.
+        """
+        with self.cond:
+            bitfield = self.peer_pieces.get(peer)
+            if bitfield is None:
+                return None
+            index = next((i for i, piece in self.active.items()
+                          if len(piece.open) == piece.num_blocks and i in bitfield), None)
+            if index is None:
+                index = self._start_piece(bitfield)
+            if index is not None:
+                piece = self.active[index]
+                piece.requested = {block: {peer} for block in range(piece.num_blocks)}
+                piece.open = []
+            return index
+
+    def block_received(self, peer, index, begin, data):
+        """
+        Store a received block in its piece.
+
+        Args:
+            peer (tuple): The peer that sent it.
+            index (int): The piece index.
+            begin (int): Offset of the block within the piece.
+            data (bytes-like): The block.
+
+        Returns:
+            tuple: (bytearray or None, set). The first item is the assembled
+                piece if this block completed it, ready to be verified; the
+                second holds the other peers the block was also requested
+                from, whose requests should be cancelled.
+        """
+        with self.cond:
+            piece = self.active.get(index)
+            if piece is None or begin % self.block_size:
+                return None, set()
+            block = begin // self.block_size
+            if block >= piece.num_blocks or len(data) != piece.block_range(block)[1] or piece.have[block]:
+                # Malformed, or a duplicate that lost the race
+                return None, set()
+            others = piece.requested.pop(block, set())
+            others.discard(peer)
+            if block in piece.open:
+                piece.open.remove(block)
+            if piece.buffer is None:
+                piece.buffer = bytearray(piece.size)
+            piece.buffer[begin:begin + len(data)] = data
+            piece.have[block] = 1
+            piece.received += 1
+            if piece.received == piece.num_blocks:
+                return piece.buffer, others
+            return None, others
+
+    def piece_received(self, peer, index, data):
+        """
+        Accept a whole piece from a peer that was assigned it with next_piece().
+
+        Args:
+            peer (tuple): The peer that sent it.
+            index (int): The piece index.
+            data (bytes-like): The piece.
+
+        Returns:
+            bool: True if the piece should be verified, False if it is not wanted.
+        """
+        with self.cond:
+            piece = self.active.get(index)
+            if piece is None or piece.received == piece.num_blocks or len(data) != piece.size:
+                return False
+            piece.requested.clear()
+            piece.open = []
+            piece.received = piece.num_blocks
+            return True
+
+    def piece_failed(self, index):
+        """
+        Return a piece that failed verification to the pool, block by block.
+
+        Args:
+            index (int): The piece index.
+        """
+        with self.cond:
+            piece = self.active.get(index)
+            if piece is not None:
+                piece.reset()
+            self.cond.notify_all()
+
+    def mark_done(self, index):
+        """
+        Record a verified piece.
+
+        Args:
+            index (int): The piece index.
+        """
+        with self.cond:
+            self.active.pop(index, None)
+            self.missing.discard(index)
+            self.cond.notify_all()
+
+    def done(self):
+        with self.cond:
+            return not self.missing
+
+    def wait(self, timeout):
+        """
+        Block until blocks are released, pieces completed or peers change.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+        """
+        with self.cond:
+            if self.missing:
+                self.cond.wait(timeout)
+
+class SwarmDownload:
+    """
+    Download one torrent from every peer the tracker knows about at once.
+
+    Each remote peer gets a worker thread with its own pipelined session.
+    Workers pull blocks from a shared PieceScheduler, so fast peers end up
+    serving more of the torrent and one piece can be assembled from several
+    peers. Completed pieces are verified and stored on a VerifyPool, so
+    workers keep receiving meanwhile. A peer that chokes us is dropped and
+    tried again after CHOKE_RETRY seconds. The tracker is re-announced to periodically and any
+    new peers it returns are added while the download runs.
+    """
+    def __init__(self, peer, info_hash, info, peers, session_factory, on_piece, have=None,
+                 reannounce_interval=REANNOUNCE_INTERVAL):
+        """
+        Args:
+            peer (Peer): The local peer, used to re-announce to the tracker.
+            info_hash (str): The hash identifying the torrent.
+            info (dict): The torrent's info dictionary.
+            peers (list): Initial (host, port) pairs holding the torrent.
+            session_factory (callable): Builds a PeerSession from (host, port).
+            on_piece (callable): Called with (index, data) for each verified
+                piece, from one of the verifying threads.
+            have (Bitfield, optional): Pieces already downloaded in an earlier run.
+            reannounce_interval (float, optional): Seconds between tracker announces.
+        """
+        self.peer = peer
+        self.info_hash = info_hash
+        self.info = info
+        self.session_factory = session_factory
+        self.on_piece = on_piece
+        self.reannounce_interval = reannounce_interval
+        self.scheduler = PieceScheduler(piece_count(info['pieces']), info['piece_length'], info['length'], have)
+        self.active = set()             # peers with a running worker
+        self.sessions = {}              # {peer: open PeerSession}, for cancelling endgame duplicates
+        self.lock = threading.Lock()
+        self.progress = None
+        self.finished = False
+        self.verifier = VerifyPool(info['pieces'], self._verified, self._failed)
+        self._add_peers(peers)
+
+    def _add_peers(self, peers):
+        """
+        Start a worker for every peer that does not already have one.
+
+        Args:
+            peers (list): (host, port) pairs returned by the tracker.
+        """
+        me = (self.peer.host, self.peer.port)
+        with self.lock:
+            for p_host, p_port in peers:
+                address = (p_host, p_port)
+                if address == me or address in self.active:
+                    continue
+                self.active.add(address)
+                threading.Thread(target=self._peer_worker, args=(address,), daemon=True).start()
+
+    def _retry_peer(self, address):
+        """
+        Start a worker again for a peer that choked us, unless the download is over.
+        """
+        if not self.finished:
+            self._add_peers([address])
+
+    def run(self, progress=None):
+        """
+        Download until every piece is verified or no peer is left.
+
+        Args:
+            progress (tqdm, optional): Progress bar updated once per piece.
+
+        Returns:
+            bool: True if all pieces were downloaded.
+        """
+        self.progress = progress
+        next_announce = None
+        idle_since = None
+        try:
+            while not self.scheduler.done():
+                if self.verifier.error is not None:
+                    print(f"\nFailed to store a piece: {self.verifier.error}")
+                    return False
+                now = time.monotonic()
+                # Never announce more often than the tracker allows
+                interval = max(self.reannounce_interval, self.peer.min_announce_interval)
+                if next_announce is None or now >= next_announce:
+                    self._add_peers(self.peer.announce_to_tracker(self.info_hash))
+                    # A failed announce is retried sooner, backing off while the tracker stays down
+                    next_announce = now + (min(self.peer.announce_retry_delay(), interval)
+                                           if self.peer.announce_failures else interval)
+                with self.lock:
+                    has_workers = bool(self.active)
+                if has_workers:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = now
+                elif now - idle_since > interval:
+                    print("\nNo peers left to download from.")
+                    return False
+                self.scheduler.wait(1)
+            return True
+        finally:
+            self.finished = True
+            # Pieces still being checked are written before the caller closes the storage
+            self.verifier.close()
+
+    def _pipeline_depth(self, session, rate):
+        """
+        Scale a peer's request queue to its measured rate.
+
+        Returns:
+            int: Requests to keep outstanding. Block-capable sessions get
+                'pipeline_depth' pieces worth of blocks, up to MAX_PENDING_BLOCKS.
+        """
+        unit = BLOCK_SIZE if session.supports_blocks else self.info['piece_length']
+        limit = session.pipeline_depth
+        if session.supports_blocks:
+            limit = min(MAX_PENDING_BLOCKS, limit * max(1, self.info['piece_length'] // BLOCK_SIZE))
+        if rate <= 0:
+            return limit
+        return max(1, min(limit, math.ceil(rate * REQUEST_QUEUE_TIME / unit)))
+
+    def _fill_pipeline(self, session, address, depth):
+        """
+        Request blocks (or whole pieces from old peers) until 'depth' are
+        outstanding or the session's limits allow no more.
+        """
+        while len(session.pending) < depth and session.reserve_request():
+            if session.supports_blocks:
+                block = self.scheduler.next_block(address)
+                if block is None:
+                    return
+                session.request_block(self.info_hash, *block)
+            else:
+                index = self.scheduler.next_piece(address)
+                if index is None:
+                    return
+                session.request_piece(self.info_hash, index)
+
+    def _cancel_duplicates(self, peers, index, begin):
+        """
+        Cancel a block at every other peer it was requested from in endgame.
+        """
+        for other in peers:
+            with self.lock:
+                session = self.sessions.get(other)
+            if session is not None:
+                try:
+                    session.cancel(self.info_hash, index, begin)
+                except OSError:
+                    pass  # That peer's worker notices the broken connection itself
+
+    def _verified(self, index, data):
+        """
+        Hand on a piece that matched its hash. Runs on a verifying thread.
+        """
+        self.on_piece(index, data)
+        self.scheduler.mark_done(index)
+        if self.progress is not None:
+            self.progress.update(1)
+
+    def _failed(self, index):
+        """
+        Put a piece that did not match its hash back in the pool. Runs on a verifying thread.
+        """
+        print(f"\nPiece {index} failed verification.")
+        self.scheduler.piece_failed(index)
+
+    def _peer_worker(self, address):
+        """
+        Fetch blocks from one remote peer until the download ends or the peer fails.
+
+        Args:
+            address (tuple): The peer's (host, port).
+        """
+        scheduler = self.scheduler
+        session = self.session_factory(*address)
+        received_bytes = 0
+        started = time.monotonic()
+        last_data = started
+        choked = False
+        try:
+            if not session.open():
+                return
+            bitfield = session.request_bitfield(self.info_hash, piece_count(self.info['pieces']))
+            if bitfield is None or not bitfield.count():
+                return
+            with self.lock:
+                self.sessions[address] = session
+            scheduler.add_peer(address, bitfield)
+            while not scheduler.done():
+                now = time.monotonic()
+                elapsed = now - started
+                self._fill_pipeline(session, address,
+                                    self._pipeline_depth(session, received_bytes / elapsed if elapsed > 0 else 0))
+                if not session.pending:
+                    scheduler.wait(1)
+                    last_data = time.monotonic()
+                    continue
+                if not session.poll(RECEIVE_POLL):
+                    # Wake up now and then to pick up blocks released by other peers
+                    if time.monotonic() - last_data > SNUB_TIMEOUT:
+                        raise socket.timeout()
+                    continue
+                response = session.receive()
+                if not response:
+                    print(f"\nPeer {address[0]}:{address[1]} closed the connection.")
+                    return
+                index = response.get('index')
+                if response.get('type') == 'choke':
+                    print(f"\nPeer {address[0]}:{address[1]} choked us, trying again in {CHOKE_RETRY}s.")
+                    choked = True
+                    return
+                if 'error' in response:
+                    print(f"\nPeer {address[0]}:{address[1]} failed piece {index}: {response['error']}")
+                    return
+                last_data = time.monotonic()
+                data = response['data']
+                received_bytes += len(data)
+                if response.get('type') == 'block':
+                    begin = response.get('begin', 0)
+                    piece, others = scheduler.block_received(address, index, begin, data)
+                    session.release(response)
+                    self._cancel_duplicates(others, index, begin)
+                    if piece is not None:
+                        # The scheduler leaves a complete piece alone until it is done or failed
+                        self.verifier.submit(index, piece)
+                else:
+                    if scheduler.piece_received(address, index, data):
+                        self.verifier.submit(index, data, partial(session.release, response))
+                    else:
+                        session.release(response)
+        except socket.timeout:
+            print(f"\nPeer {address[0]}:{address[1]} is snubbing us, moving its requests elsewhere.")
+        except Exception as e:
+            print(f"\nLost peer {address[0]}:{address[1]}: {e}")
+        finally:
+            with self.lock:
+                self.sessions.pop(address, None)
+            session.close()
+            scheduler.remove_peer(address)
+            with self.lock:
+                self.active.discard(address)
+            if choked:
+                # A slot may open for us at the peer's next rechoke
+                retry = threading.Timer(CHOKE_RETRY, self._retry_peer, args=(address,))
+                retry.daemon = True
+                retry.start()
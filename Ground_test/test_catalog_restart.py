@@ -0,0 +1,61 @@
+import socket
+
+from peer import Peer
+from tracker import Tracker
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _announce(tracker, index, name=None):
+    tracker._handle_announce({'info_hash': f'{index:040x}', 'host': '127.0.0.1', 'port': 7000 + index,
+                              'torrent_info': {'name': name or f'file{index}', 'length': 1,
+                                               'piece_length': 1, 'pieces': b'\xaa' * 20}})
+
+def _start_tracker(data_dir):
+    tracker = Tracker('127.0.0.1', _free_port(), data_dir=str(data_dir))
+    tracker.start()
+    return tracker
+
+def test_get_catalog_resets_stale_since(tmp_path):
+    tracker = Tracker('127.0.0.1', 0, data_dir=str(tmp_path))
+    tracker.store.start()
+    _announce(tracker, 1)
+    response = tracker._handle_get_catalog({'since': 87})
+    assert response['reset']
+    assert [t['info_hash'] for t in response['torrents']] == [f'{1:040x}']
+    response = tracker._handle_get_catalog({'since': 0, 'epoch': 'earlier run'})
+    assert response['reset'] and len(response['torrents']) == 1
+    response = tracker._handle_get_catalog({'since': 0, 'epoch': tracker.catalog_epoch})
+    assert not response['reset']
+    tracker.stop()
+
+def test_client_catalog_survives_tracker_restart(tmp_path):
+    first = _start_tracker(tmp_path)
+    for index in range(4):
+        _announce(first, index)
+    # Re-announcing with new details pushes the version past the number of torrents
+    for round_ in range(20):
+        _announce(first, 0, name=f'renamed{round_}')
+    client = Peer('127.0.0.1', _free_port())
+    client.connect_to_tracker('127.0.0.1', first.port)
+    client._sync_catalog()
+    assert len(client.catalog) == 4
+    stale_version = client.catalog_version
+    first.stop()
+
+    second = _start_tracker(tmp_path)
+    # Announced at a version the client believes it has already seen
+    _announce(second, 9)
+    assert second.catalog_version < stale_version
+    # Same tracker address as far as the client knows, so its cache is kept
+    client.tracker_port = second.port
+    client._sync_catalog()
+    assert f'{9:040x}' in client.catalog and len(client.catalog) == 5
+    assert client.catalog_version == second.catalog_version
+
+    _announce(second, 10)
+    client._sync_catalog()
+    assert f'{10:040x}' in client.catalog
+    second.stop()
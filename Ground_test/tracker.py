@@ -1,57 +1,164 @@
+import asyncio
 import socket
 import threading
 import argparse
 import time
-import json
-import hashlib
-import os
-import pickle
-import struct
-
-def send_msg(conn, obj):
-    data = pickle.dumps(obj)
-    length_prefix = struct.pack('!I', len(data))
-    try:
-        conn.sendall(length_prefix + data)
-    except Exception as e:
-        print(f"Failed to send message: {e}")
-
-def recv_all(conn, length):
-    chunks = []
-    bytes_recd = 0
-    while bytes_recd < length:
-        chunk = conn.recv(length - bytes_recd)
-        if not chunk:
-            return None
-        chunks.append(chunk)
-        bytes_recd += len(chunk)
-    return b''.join(chunks)
-
-def recv_msg(conn):
-    length_prefix = recv_all(conn, 4)
-    if not length_prefix:
-        return None
-    msg_length = struct.unpack('!I', length_prefix)[0]
-    data = recv_all(conn, msg_length)
-    if not data:
-        return None
-    try:
-        return pickle.loads(data)
-    except Exception as e:
-        print(f"Failed to deserialize message: {e}")
-        return None
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from expiry import TimingWheel
+from hashing import pack_piece_hashes, piece_count, unpack_piece_hashes
+from peerset import PeerSet, pack_peers
+from persistence import CatalogStore
+from protocol import LEGACY_WIRES, send_msg, recv_frame, encode_frame, read_frame
+
+# asyncio server mode: threads for blocking work and the listen backlog
+IO_WORKERS = 8
+ASYNC_BACKLOG = 4096
+
+# Largest page a get_catalog request may ask for
+MAX_CATALOG_PAGE = 1000
+# Seconds peers are asked to wait between announces, and the least they must wait
+ANNOUNCE_INTERVAL = 120
+MIN_ANNOUNCE_INTERVAL = 30
+# A peer is dropped from a torrent once it misses this many announces in a row
+MISSED_ANNOUNCES = 2
+# Resolution of the expiry wheel in seconds
+REAP_TICK = 1
+# Peers returned per announce when the peer does not ask for a number, and the cap
+DEFAULT_NUMWANT = 50
+MAX_NUMWANT = 200
+# Number of independently locked slices the torrents are spread over
+SHARDS = 16
+
+class TrackerShard:
+    """
+    A slice of the tracker's torrents with its own lock.
+
+    Announces for torrents in different shards never wait for each other.
+    Each shard also keeps the reverse peer index and the expiry wheel for
+    its own torrents, so reaping and peer removal lock one shard at a time.
+    """
+    def __init__(self, peer_ttl):
+        """
+        Args:
+            peer_ttl (float): Seconds a peer stays listed without announcing.
+        """
+        self.lock = threading.Lock()
+        # {info_hash: {'peers': PeerSet, 'info': torrent_info, 'announce': {host, port}, 'version': int,
+        #              'listed': tuple of the peers as of the last listing, or None once they changed}}
+        self.torrents = {}
+        # Reverse index: {(host, port): set of info_hashes in this shard the peer is in}
+        self.peer_torrents = {}
+        # Each (info_hash, peer) pair is armed on announce and expires unless re-armed
+        self.expiry = TimingWheel(REAP_TICK, int(peer_ttl // REAP_TICK) + 2, time.monotonic())
+        # get_torrents entries of this shard; never modified once published,
+        # only dropped on change and rebuilt by the next reader
+        self.listing = None
+        # Bumped with every drop of the listing, so a rebuild that raced a change is not published
+        self.generation = 0
+
+    def listing_snapshot(self):
+        """
+        Returns:
+            dict: {info_hash: get_torrents entry} for the torrents of this shard.
+                The dict is shared between readers and must not be modified.
+        """
+        listing = self.listing
+        if listing is not None:
+            return listing
+        # Announces wait on the lock, so only references are taken under it;
+        # peers are copied again only for torrents that changed
+        with self.lock:
+            if self.listing is not None:
+                return self.listing
+            generation = self.generation
+            torrents = []
+            for info_hash, data in self.torrents.items():
+                if data['info']:
+                    if data['listed'] is None:
+                        data['listed'] = tuple(data['peers'])
+                    torrents.append((info_hash, data['info'], data['listed']))
+        listing = {
+            info_hash: {
+                'name': info.get('name', 'Unknown'),
+                'length': info.get('length', 0),
+                'peers': list(peers),
+                'piece_length': info.get('piece_length'),
+                'pieces': info.get('pieces', b'')
+            }
+            for info_hash, info, peers in torrents
+        }
+        with self.lock:
+            if self.generation == generation:
+                self.listing = listing
+        return listing
 
 class Tracker:
-    def __init__(self, host='0.0.0.0', port=8000):
+    def __init__(self, host='0.0.0.0', port=8000, allow_pickle=False, data_dir='torrents',
+                 announce_interval=ANNOUNCE_INTERVAL, shards=SHARDS):
         self.host = host
         self.port = port
-        # {info_hash: {'peers': set(), 'info': torrent_info}}
-        self.torrents = {}
-        self.lock = threading.Lock()
+        # Accept the legacy pickle framing from peers that predate the binary protocol;
+        # off unless asked for, since it lets any client feed us pickles
+        self.allow_pickle = allow_pickle
+        self.announce_interval = announce_interval
+        self.min_announce_interval = min(MIN_ANNOUNCE_INTERVAL, announce_interval)
+        self.peer_ttl = announce_interval * MISSED_ANNOUNCES
+        # Torrents are spread over the shards by info_hash
+        self.shards = [TrackerShard(self.peer_ttl) for _ in range(shards)]
+        # Bumped on every catalog change; each torrent records the version of
+        # its last change, and 'changes' keeps info_hashes ordered by it along
+        # with the catalog summary published at that version. Always taken
+        # after a shard lock, never before one.
+        self.catalog_lock = threading.Lock()
+        self.catalog_version = 0
+        # Versions restart with the process; clients holding versions of an
+        # earlier run see a different epoch and get the whole catalog again
+        self.catalog_epoch = uuid.uuid4().hex
+        self.changes = OrderedDict()    # {info_hash: (version, summary or None)}
+        # Catalog changes are persisted in the background, off the announce path
+        self.store = CatalogStore(data_dir)
+        for info_hash, record in self.store.load().items():
+            shard = self._shard(info_hash)
+            shard.torrents[info_hash] = {'peers': PeerSet(), 'info': record['info'],
+                                         'announce': record['announce'], 'version': 0, 'listed': None}
+            self._bump_version(shard, info_hash)
+
+    def _shard(self, info_hash):
+        """
+        Args:
+            info_hash (str): The info_hash of a torrent.
+
+        Returns:
+            TrackerShard: The shard holding that torrent.
+        """
+        return self.shards[hash(info_hash) % len(self.shards)]
+
+    def start(self, mode='threaded'):
+        """
+        Start serving in the background.
+
+        Args:
+            mode (str, optional): 'threaded' to serve each connection on its own
+                thread, or 'asyncio' to serve all of them from one event loop.
+        """
+        self.store.start()
+        target = self._run_async_server if mode == 'asyncio' else self._server
+        threading.Thread(target=target, daemon=True).start()
+        threading.Thread(target=self._reaper, daemon=True).start()
+        print(f"Tracker listening on {self.host}:{self.port} ({mode})")
 
-    def start(self):
-        threading.Thread(target=self._server, daemon=True).start()
-        print(f"Tracker listening on {self.host}:{self.port}")
+    def stop(self):
+        """
+        Write outstanding catalog changes and compact them into a snapshot.
+        """
+        catalog = {}
+        for shard in self.shards:
+            with shard.lock:
+                catalog.update((info_hash, {'info': data['info'], 'announce': data['announce']})
+                               for info_hash, data in shard.torrents.items() if data['info'])
+        self.store.close(catalog)
 
     def _server(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -61,121 +168,337 @@ class Tracker:
                 conn, addr = s.accept()
                 threading.Thread(target=self._handle_client, args=(conn, addr), daemon=True).start()
 
+    def _run_async_server(self):
+        asyncio.run(self._async_server())
+
+    async def _async_server(self):
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='tracker-io')
+        server = await asyncio.start_server(self._handle_client_async, self.host, self.port,
+                                            backlog=ASYNC_BACKLOG)
+        async with server:
+            await server.serve_forever()
+
     def _handle_client(self, conn, addr):
         try:
-            message = recv_msg(conn)
+            message, wire = recv_frame(conn, self.allow_pickle)
             if not message:
                 return
-            msg_type = message.get('type', None)
-            if msg_type == 'handshake':
-                # Respond to handshake
-                response = {'type': 'handshake_ack', 'message': 'Tracker is valid'}
-            elif msg_type == 'announce':
-                response = self._handle_announce(message)
-            elif msg_type == 'get_torrents':
-                response = self._handle_get_torrents()
-            else:
-                response = {'error': 'Unknown message type'}
-
-            send_msg(conn, response)
+            send_msg(conn, self._for_wire(self._dispatch(message), wire), wire)
         except Exception as e:
             print(f"Error handling client {addr}: {e}")
         finally:
             conn.close()
 
+    async def _handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            message, wire = await read_frame(reader, self.allow_pickle)
+            if not message:
+                return
+            if message.get('type') == 'announce':
+                # Announces can wait on a shard lock and re-encode large hash lists,
+                # so they run on the executor rather than on the event loop
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.io_executor, self._dispatch, message)
+            else:
+                response = self._dispatch(message)
+            writer.write(encode_frame(self._for_wire(response, wire), wire))
+            await writer.drain()
+        except Exception as e:
+            print(f"Error handling client {addr}: {e}")
+        finally:
+            writer.close()
+
+    def _dispatch(self, message):
+        msg_type = message.get('type', None)
+        if msg_type == 'handshake':
+            # Respond to handshake
+            response = {'type': 'handshake_ack', 'message': 'Tracker is valid'}
+        elif msg_type == 'announce':
+            response = self._handle_announce(message)
+        elif msg_type == 'get_torrents':
+            response = self._handle_get_torrents()
+        elif msg_type == 'get_catalog':
+            response = self._handle_get_catalog(message)
+        elif msg_type == 'get_torrent':
+            response = self._handle_get_torrent(message)
+        else:
+            response = {'error': 'Unknown message type'}
+        return response
+
+    @staticmethod
+    def _for_wire(response, wire):
+        """
+        Give clients on a legacy framing (pickle, or protocol version 1)
+        their piece hashes as the list of hex strings they predate the
+        binary form with.
+
+        Args:
+            response (dict): The response from _dispatch(); left unmodified,
+                since listings are shared between readers.
+            wire (str): The framing the client used.
+
+        Returns:
+            dict: The response to send.
+        """
+        if wire not in LEGACY_WIRES:
+            return response
+        if 'info' in response:
+            info = response['info']
+            response = dict(response, info=dict(info, pieces=unpack_piece_hashes(info.get('pieces', b''))))
+        if 'torrents' in response and isinstance(response['torrents'], dict):
+            response = dict(response, torrents={
+                info_hash: dict(entry, pieces=unpack_piece_hashes(entry['pieces']))
+                for info_hash, entry in response['torrents'].items()})
+        return response
+
     def _handle_announce(self, message):
         info_hash = message['info_hash']
         peer_host = message['host']
         peer_port = message['port']
+        peer = (peer_host, peer_port)
+        intervals = {'interval': self.announce_interval, 'min_interval': self.min_announce_interval}
+        shard = self._shard(info_hash)
+        torrent_info = message.get('torrent_info')
+        if torrent_info and 'pieces' in torrent_info:
+            # Hashes from older peers arrive as hex strings; keep every torrent in binary
+            try:
+                torrent_info = dict(torrent_info, pieces=pack_piece_hashes(torrent_info['pieces']))
+            except (TypeError, ValueError) as e:
+                return {'error': f"Malformed piece hashes: {e}"}
 
-        with self.lock:
-            if info_hash not in self.torrents:
-                self.torrents[info_hash] = {'peers': set(), 'info': None}
-            self.torrents[info_hash]['peers'].add((peer_host, peer_port))
-            torrent_info = message.get('torrent_info')
-            if torrent_info:
-                self.torrents[info_hash]['info'] = torrent_info
-                # Optionally, the tracker can save a .torrent file here if desired.
-                self._save_torrent_file(info_hash, torrent_info, peer_host, peer_port)
-
-            all_peers = self.torrents[info_hash]['peers'].copy()
-            all_peers.discard((peer_host, peer_port))
-            return {'peers': list(all_peers)}
+        with shard.lock:
+            if message.get('event') == 'stopped':
+                if info_hash in shard.torrents:
+                    self._drop_peer(shard, info_hash, peer)
+                return {'peers': [], **intervals}
+            data = shard.torrents.get(info_hash)
+            if data is None:
+                data = shard.torrents[info_hash] = {'peers': PeerSet(), 'info': None, 'announce': None, 'version': 0,
+                                                     'listed': None}
+            changed = peer not in data['peers']
+            data['peers'].add(peer)
+            shard.peer_torrents.setdefault(peer, set()).add(info_hash)
+            shard.expiry.schedule((info_hash, peer), self.peer_ttl, time.monotonic())
+            if torrent_info and data['info'] != torrent_info:
+                changed = True
+                data['info'] = torrent_info
+                data['announce'] = {'host': peer_host, 'port': peer_port}
+                # Written to disk later by the store's background thread
+                self.store.record(info_hash, torrent_info, peer_host, peer_port)
 
-    def _handle_get_torrents(self):
-        with self.lock:
-            torrents_info = {}
-            for info_hash, data in self.torrents.items():
-                t_info = data['info']
-                if t_info:
-                    peers_list = list(data['peers'])
-                    torrents_info[info_hash] = {
-                        'name': t_info.get('name', 'Unknown'),
-                        'length': t_info.get('length', 0),
-                        'peers': peers_list,
-                        'piece_length': t_info.get('piece_length'),
-                        'pieces': t_info.get('pieces', [])
-                    }
-            return {'torrents': torrents_info}
-
-    def _save_torrent_file(self, info_hash, torrent_info, peer_host, peer_port):
-        """
-        Save the torrent information as a .torrent file.
+            if changed:
+                self._bump_version(shard, info_hash)
+
+            response = self._peer_list(data['peers'], message, peer)
+        response.update(intervals)
+        return response
+
+    def _peer_list(self, peers, message, exclude=None):
+        """
+        Pick the peers to return for a request. Must be called with the shard's lock held.
+
+        A random sample of 'numwant' peers is taken, so the cost does not
+        depend on the size of the swarm. Peers that ask for 'compact' get
+        them packed into 'peers4' and 'peers6' (6 and 18 bytes per peer),
+        leaving only peers known by name in 'peers'.
+
+        Args:
+            peers (PeerSet): The torrent's peers.
+            message (dict): The request, with optional 'numwant' and 'compact'.
+            exclude (tuple, optional): The requesting peer, left out of the sample.
+
+        Returns:
+            dict: 'peers', plus 'peers4' and 'peers6' in compact form.
+        """
+        numwant = message.get('numwant')
+        numwant = DEFAULT_NUMWANT if numwant is None else max(0, min(numwant, MAX_NUMWANT))
+        chosen = peers.sample(numwant, exclude)
+        if not message.get('compact'):
+            return {'peers': chosen}
+        peers4, peers6, others = pack_peers(chosen)
+        return {'peers': others, 'peers4': peers4, 'peers6': peers6}
+
+    def _drop_peer(self, shard, info_hash, peer):
+        """
+        Remove a peer from one torrent. Must be called with the shard's lock held.
 
         Args:
+            shard (TrackerShard): The shard holding the torrent.
             info_hash (str): The info_hash of the torrent.
-            torrent_info (dict): The torrent's info dictionary.
-            peer_host (str): The host address of the peer.
-            peer_port (int): The port number of the peer.
+            peer (tuple): The peer's (host, port).
+        """
+        shard.expiry.cancel((info_hash, peer))
+        torrents = shard.peer_torrents.get(peer)
+        if torrents is not None:
+            torrents.discard(info_hash)
+            if not torrents:
+                del shard.peer_torrents[peer]
+        data = shard.torrents[info_hash]
+        if peer in data['peers']:
+            data['peers'].discard(peer)
+            self._bump_version(shard, info_hash)
+
+    def _reaper(self):
+        """
+        Drop peers that stopped announcing, once per tick of the expiry wheels.
+        """
+        while True:
+            time.sleep(REAP_TICK)
+            expired = 0
+            for shard in self.shards:
+                with shard.lock:
+                    due = shard.expiry.advance(time.monotonic())
+                    for info_hash, peer in due:
+                        self._drop_peer(shard, info_hash, peer)
+                expired += len(due)
+            if expired:
+                print(f"Expired {expired} peer announce(s) that were not renewed.")
+
+    def _bump_version(self, shard, info_hash):
+        """
+        Record a change to a torrent in the catalog. Must be called with the shard's lock held.
+
+        The torrent's catalog summary is built here, so catalog readers only
+        need the catalog lock and never touch a shard.
+
+        Args:
+            shard (TrackerShard): The shard holding the torrent.
+            info_hash (str): The info_hash of the changed torrent.
+        """
+        data = shard.torrents[info_hash]
+        data['listed'] = None
+        shard.listing = None
+        shard.generation += 1
+        with self.catalog_lock:
+            self.catalog_version += 1
+            data['version'] = self.catalog_version
+            summary = None
+            t_info = data['info']
+            if t_info:
+                summary = {
+                    'info_hash': info_hash,
+                    'name': t_info.get('name', 'Unknown'),
+                    'length': t_info.get('length', 0),
+                    'piece_length': t_info.get('piece_length'),
+                    'num_pieces': piece_count(t_info.get('pieces', b'')),
+                    'num_peers': len(data['peers']),
+                    'version': data['version'],
+                }
+            self.changes[info_hash] = (self.catalog_version, summary)
+            self.changes.move_to_end(info_hash)
+
+    def _handle_get_catalog(self, message):
+        """
+        Return summaries of the torrents changed since a catalog version.
+
+        Results are ordered by version and capped at 'limit'; when 'more' is
+        set the client asks again with 'since' set to the returned 'next'.
+        Only changed torrents are visited, newest first, so a client that is
+        up to date costs almost nothing.
+
+        A 'since' from another epoch, or past the current version, was
+        handed out before the tracker restarted. The whole catalog is then
+        sent with 'reset' set, and the client drops what it had.
+
+        Args:
+            message (dict): The request, with optional 'since', 'epoch' and 'limit'.
+
+        Returns:
+            dict: 'version', 'epoch', 'reset', 'torrents' (list of summaries),
+                'next' and 'more'.
         """
-        # Construct the torrent dictionary
-        torrent = {
-            "announce": {
-                "host": peer_host,
-                "port": peer_port
-            },
-            "info": torrent_info,
-            "comment": "Torrent file stored by tracker",
-            "created_by": "Tracker"
+        since = message.get('since', 0)
+        limit = max(1, min(message.get('limit', MAX_CATALOG_PAGE), MAX_CATALOG_PAGE))
+        with self.catalog_lock:
+            version = self.catalog_version
+            epoch = message.get('epoch')
+            reset = since > version or (epoch is not None and epoch != self.catalog_epoch)
+            if reset:
+                since = 0
+            changed = []
+            for info_hash in reversed(self.changes):
+                entry = self.changes[info_hash]
+                if entry[0] <= since:
+                    break
+                changed.append(entry)
+        changed.reverse()
+        page = changed[:limit]
+        more = len(changed) > limit
+        return {
+            'version': version,
+            'epoch': self.catalog_epoch,
+            'reset': reset,
+            'torrents': [summary for _, summary in page if summary],
+            'next': page[-1][0] if more else version,
+            'more': more,
         }
 
-        # Ensure the 'torrents' directory exists
-        os.makedirs('torrents', exist_ok=True)
+    def _handle_get_torrent(self, message):
+        """
+        Return the full details of one torrent, including its piece hashes and peers.
 
-        # Save the file as <info_hash>.torrent within the 'torrents' directory
-        torrent_file_name = os.path.join('torrents', f"{info_hash}.torrent")
-        try:
-            with open(torrent_file_name, 'w') as tf:
-                json.dump(torrent, tf, indent=4)
-            print(f"Tracker saved torrent file as {torrent_file_name}")
-        except Exception as e:
-            print(f"Failed to write torrent file {torrent_file_name}: {e}")
+        Args:
+            message (dict): The request, carrying the 'info_hash'.
+
+        Returns:
+            dict: 'info', 'version' and the peers as returned by _peer_list(), or an error.
+        """
+        info_hash = message.get('info_hash')
+        shard = self._shard(info_hash)
+        with shard.lock:
+            data = shard.torrents.get(info_hash)
+            if not data or not data['info']:
+                return {'error': 'Unknown torrent'}
+            response = self._peer_list(data['peers'], message)
+            response.update({'info': data['info'], 'version': data['version']})
+            return response
+
+    def _handle_get_torrents(self):
+        # Built from the shards' published listings, without holding any lock
+        torrents_info = {}
+        for shard in self.shards:
+            torrents_info.update(shard.listing_snapshot())
+        return {'torrents': torrents_info}
 
     def _remove_peer_from_all_torrents(self, peer_host, peer_port):
         """
         Remove a peer from all torrents it is part of.
 
+        Only the peer's own torrents are visited, through the reverse index.
+
         Args:
             peer_host (str): The host address of the peer.
             peer_port (int): The port number of the peer.
         """
-        with self.lock:
-            for info_hash, data in self.torrents.items():
-                if (peer_host, peer_port) in data['peers']:
-                    data['peers'].discard((peer_host, peer_port))
-                   # print(f"Peer {peer_host}:{peer_port} removed from torrent {data['info'].get('name')} due to disconnection.")
+        peer = (peer_host, peer_port)
+        for shard in self.shards:
+            with shard.lock:
+                for info_hash in list(shard.peer_torrents.get(peer, ())):
+                    self._drop_peer(shard, info_hash, peer)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='P2P Tracker')
     parser.add_argument('--host', default='0.0.0.0', help='Tracker host')
     parser.add_argument('--port', type=int, default=8000, help='Tracker port')
+    parser.add_argument('--allow-pickle', action='store_true',
+                        help='Also serve peers that only speak the legacy pickle framing')
+    parser.add_argument('--server', choices=['threaded', 'asyncio'], default='threaded',
+                        help='Serve connections with one thread each or from one asyncio event loop')
+    parser.add_argument('--announce-interval', type=int, default=ANNOUNCE_INTERVAL,
+                        help='Seconds between peer announces; peers missing two in a row are dropped')
+    parser.add_argument('--shards', type=int, default=SHARDS,
+                        help='Number of independently locked slices of the torrent table')
     args = parser.parse_args()
 
-    tracker = Tracker(host=args.host, port=args.port)
-    tracker.start()
+    tracker = Tracker(host=args.host, port=args.port, allow_pickle=args.allow_pickle,
+                      announce_interval=args.announce_interval, shards=args.shards)
+    tracker.start(args.server)
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nTracker shutting down.")
+    finally:
+        tracker.stop()
@@ -3,10 +3,21 @@ import threading
 import pickle
 import time
 import argparse
-import json
 import hashlib
 import os
 import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared building blocks live next to the current peer implementation
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Ground_test'))
+from storage import PieceStorage
+from hashing import hash_pieces, format_rate, choose_piece_length, piece_count, piece_hash
+from bencode import info_hash as info_hash_of, read_torrent, write_torrent
+from manager import DownloadManager
+
+# Threads fetching pieces of one torrent; sockets are also capped by the download manager
+PIECE_WORKERS = 8
 
 class Peer:
     def __init__(self, host, port):
@@ -16,6 +27,8 @@ class Peer:
         self.shared_files = {}      # {info_hash: torrent_info}
         self.lock = threading.Lock()
         self.connected_trackers = set()  # Set of trackers the peer has connected to
+        # Runs a few torrents at a time and caps the sockets they open
+        self.downloads = DownloadManager()
 
     def start_server(self):
         threading.Thread(target=self._server, daemon=True).start()
@@ -80,16 +93,15 @@ class Peer:
             print(f"Failed to announce to tracker at {tracker_host}:{tracker_port}: {e}")
             return []
 
-    def start_download(self, torrent_file_path):
-        threading.Thread(target=self.download_file, args=(torrent_file_path,), daemon=True).start()
+    def start_download(self, torrent_file_path, priority=0):
+        # Queue the download instead of starting a thread for it right away
+        return self.downloads.add(os.path.basename(torrent_file_path),
+                                  lambda job: self.download_file(torrent_file_path, job), priority)
 
-    def download_file(self, torrent_file_path):
+    def download_file(self, torrent_file_path, job=None):
         # Load the torrent file
-        with open(torrent_file_path, 'r') as tf:
-            torrent = json.load(tf)
-        # Calculate info_hash
-        info_str = json.dumps(torrent['info'], sort_keys=True)
-        info_hash = hashlib.sha1(info_str.encode()).hexdigest()
+        # The info_hash is the SHA-1 of the info dictionary as stored in the file
+        torrent, info_hash = read_torrent(torrent_file_path)
         tracker_host = torrent['announce']['host']
         tracker_port = torrent['announce']['port']
         # Register the torrent in active downloads
@@ -97,8 +109,11 @@ class Peer:
             self.active_downloads[info_hash] = {
                 'torrent': torrent,
                 'pieces_downloaded': set(),
-                'total_pieces': len(torrent['info']['pieces']),
-                'file_data': {},  # {piece_index: piece_data}
+                'total_pieces': piece_count(torrent['info']['pieces']),
+                # Verified pieces go straight to disk instead of being kept in memory
+                'storage': PieceStorage(f"downloaded_{torrent['info']['name']}",
+                                        torrent['info']['length'], torrent['info']['piece_length'],
+                                        torrent['info'].get('files')),
                 'peers': []
             }
         # Announce to tracker and get peers
@@ -106,23 +121,22 @@ class Peer:
         with self.lock:
             self.active_downloads[info_hash]['peers'] = peers
         # Start downloading pieces
-        total_pieces = len(torrent['info']['pieces'])
+        total_pieces = piece_count(torrent['info']['pieces'])
+        if job is not None:
+            job.set_total(total_pieces)
         piece_indices = list(range(total_pieces))
         random.shuffle(piece_indices)
-        threads = []
-        for piece_index in piece_indices:
-            t = threading.Thread(target=self.download_piece, args=(info_hash, piece_index), daemon=True)
-            t.start()
-            threads.append(t)
-        # Wait for all pieces to be downloaded
-        for t in threads:
-            t.join()
+        # A fixed set of threads works through the pieces; map() waits for all of them
+        with ThreadPoolExecutor(max_workers=PIECE_WORKERS) as executor:
+            list(executor.map(lambda piece_index: self.download_piece(info_hash, piece_index, job), piece_indices))
         # Assemble the file
-        self.assemble_file(info_hash)
+        if not self.assemble_file(info_hash):
+            return False
         # Announce completion to tracker
         self.announce_to_tracker(info_hash, tracker_host, tracker_port, event='completed')
+        return True
 
-    def download_piece(self, info_hash, piece_index):
+    def download_piece(self, info_hash, piece_index, job=None):
         while True:
             with self.lock:
                 if piece_index in self.active_downloads[info_hash]['pieces_downloaded']:
@@ -132,6 +146,8 @@ class Peer:
                 peer_host, peer_port = peer
                 if (peer_host, peer_port) == (self.host, self.port):
                     continue  # Skip self
+                # Wait for one of the connection slots shared by all downloads
+                self.downloads.limits.acquire_connection()
                 try:
                     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                         s.settimeout(5)  # Set a timeout for the connection
@@ -147,68 +163,63 @@ class Peer:
                         piece_data = response.get('data')
                         # Verify piece hash
                         torrent_info = self.active_downloads[info_hash]['torrent']
-                        piece_hash = torrent_info['info']['pieces'][piece_index]
-                        actual_hash = hashlib.sha1(piece_data).hexdigest()
-                        if actual_hash == piece_hash:
+                        expected_hash = piece_hash(torrent_info['info']['pieces'], piece_index)
+                        if hashlib.sha1(piece_data).digest() == expected_hash:
                             print(f"Piece {piece_index} from {peer_host}:{peer_port} verified.")
+                            self.active_downloads[info_hash]['storage'].write_piece(piece_index, piece_data)
                             with self.lock:
                                 self.active_downloads[info_hash]['pieces_downloaded'].add(piece_index)
-                                self.active_downloads[info_hash]['file_data'][piece_index] = piece_data
+                            if job is not None:
+                                job.update()
                             return
                         else:
                             print(f"Piece {piece_index} hash mismatch from {peer_host}:{peer_port}")
                 except Exception as e:
                     print(f"Failed to download piece {piece_index} from {peer_host}:{peer_port}: {e}")
+                finally:
+                    self.downloads.limits.release_connection()
             time.sleep(1)  # Wait before retrying
 
     def assemble_file(self, info_hash):
         with self.lock:
             download_info = self.active_downloads[info_hash]
             total_pieces = download_info['total_pieces']
+            # Every piece was already written at its offset when it was verified
+            download_info['storage'].close()
             if len(download_info['pieces_downloaded']) == total_pieces:
                 torrent_info = download_info['torrent']
                 file_name = torrent_info['info']['name']
-                # Write the file data
-                with open(f"downloaded_{file_name}", 'wb') as f:
-                    for piece_index in range(total_pieces):
-                        f.write(download_info['file_data'][piece_index])
                 print(f"File {file_name} assembled successfully.")
                 # Move the file to shared files
                 self.shared_files[info_hash] = torrent_info
                 # Remove from active downloads
                 del self.active_downloads[info_hash]
+                return True
             else:
                 print(f"File assembly failed. Not all pieces were downloaded.")
+                return False
 
     def share_file(self, file_path):
         # Create a torrent file and add to shared files
         torrent = self.create_torrent_file(file_path)
-        info_str = json.dumps(torrent['info'], sort_keys=True)
-        info_hash = hashlib.sha1(info_str.encode()).hexdigest()
+        info_hash = info_hash_of(torrent['info'])
         self.shared_files[info_hash] = torrent
         print(f"Sharing file {file_path} with info_hash {info_hash}")
         # Save the torrent file
         torrent_file_name = file_path + ".torrent"
-        with open(torrent_file_name, 'w') as tf:
-            json.dump(torrent, tf, indent=4)
+        write_torrent(torrent_file_name, torrent)
         print(f"Torrent file created: {torrent_file_name}")
         # Announce to tracker
         tracker_host = torrent['announce']['host']
         tracker_port = torrent['announce']['port']
         self.announce_to_tracker(info_hash, tracker_host, tracker_port, event='completed')
 
-    def create_torrent_file(self, file_path, piece_length=51200):
-        # Read the file and calculate piece hashes
-        pieces = []
-        total_length = 0
-        with open(file_path, 'rb') as f:
-            while True:
-                piece = f.read(piece_length)
-                if not piece:
-                    break
-                piece_hash = hashlib.sha1(piece).hexdigest()
-                pieces.append(piece_hash)
-                total_length += len(piece)
+    def create_torrent_file(self, file_path, piece_length=None):
+        # Size pieces to the file unless told otherwise
+        piece_length = piece_length or choose_piece_length(os.path.getsize(file_path))
+        # Calculate piece hashes on all cores
+        pieces, total_length, elapsed = hash_pieces(file_path, piece_length)
+        print(f"Hashed {piece_count(pieces)} pieces in {elapsed:.2f}s ({format_rate(total_length, elapsed)})")
         # Use tracker's IP and port (adjust as needed)
         tracker_host = '192.168.1.100'  # Replace with actual tracker IP
         tracker_port = 8000             # Replace with actual tracker port
@@ -262,7 +273,8 @@ if __name__ == "__main__":
             print("\nOptions:")
             print("1. Share a file")
             print("2. Download a file")
-            print("3. Quit")
+            print("3. Show download status")
+            print("4. Quit")
 
             choice = input("Enter your choice: ").strip()
             if choice == '1':
@@ -278,6 +290,9 @@ if __name__ == "__main__":
                 else:
                     print("Torrent file not found.")
             elif choice == '3':
+                for job in peer.downloads.status()['jobs']:
+                    print(f"{job['id']}: {job['name']} {job['state']} {job['done']}/{job['total']} pieces")
+            elif choice == '4':
                 print("Exiting.")
                 break
             else: